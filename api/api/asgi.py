@@ -8,21 +8,21 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
-import django
+from django.core.asgi import get_asgi_application
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
-django.setup()
 
-from django.core.asgi import get_asgi_application
+# Sets up Django once; the websocket routing below imports models.
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from blog import routing
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+from blog.middleware import JWTWebSocketAuthMiddleware
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+    'http': django_asgi_app,
     'websocket':
-        AuthMiddlewareStack(
+        JWTWebSocketAuthMiddleware(
             URLRouter(
                 routing.websocket_urlpatterns
             )
@@ -0,0 +1,187 @@
+"""
+Read-replica routing.
+
+Reads made while serving a safe (GET/HEAD/OPTIONS) request go to a MySQL
+replica; everything else goes to ``default``. A request switches to the
+primary for the rest of its reads as soon as it writes, and a client whose
+write succeeded recently is pinned to the primary for its next requests, so
+users always read their own writes. Reads inside ``transaction.atomic()``
+use the primary too, so they see the transaction's own rows and locks. Browsers are pinned by a short-lived cookie;
+API clients, which send a bearer token and no cookies, by the token's
+``user_id`` in the cache. Replicas lagging more than REPLICA_MAX_LAG seconds
+are skipped until they catch up.
+
+Code running outside a request (Celery, management commands) always uses
+the primary.
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'db_pin'
+
+_routing = contextvars.ContextVar('db_routing', default=None)
+_health = {}
+_health_lock = threading.Lock()
+
+
+class RequestRouting:
+    __slots__ = ('use_replica', 'wrote', 'alias', 'user_id')
+
+    def __init__(self, use_replica, user_id=None):
+        self.use_replica = use_replica
+        self.wrote = False
+        self.alias = None
+        self.user_id = user_id
+
+
+def pin_key(user_id):
+    return f'db_pin:user:{user_id}'
+
+
+def bearer_user_id(request):
+    """
+    The ``user_id`` claim of the request's bearer token, if any. It is not
+    verified: a forged one can only send its own reads to the primary.
+    """
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        claims = jwt.decode(header[len('Bearer '):], options={'verify_signature': False})
+    except jwt.InvalidTokenError:
+        return None
+    return claims.get('user_id')
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind its source, or None if replication is not running."""
+    with connections[alias].cursor() as cursor:
+        try:
+            cursor.execute('SHOW REPLICA STATUS')
+            column = 'Seconds_Behind_Source'
+        except DatabaseError:
+            # MySQL < 8.0.22
+            cursor.execute('SHOW SLAVE STATUS')
+            column = 'Seconds_Behind_Master'
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([col[0] for col in cursor.description], row)).get(column)
+
+
+def replica_is_healthy(alias):
+    now = time.monotonic()
+    with _health_lock:
+        checked = _health.get(alias)
+    if checked and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return checked[1]
+
+    try:
+        lag = replica_lag(alias)
+        healthy = lag is not None and lag <= settings.REPLICA_MAX_LAG
+        if not healthy:
+            logger.warning("Replica %s lag is %s s; reading from the primary", alias, lag)
+    except DatabaseError:
+        logger.warning("Replica %s is unreachable; reading from the primary", alias, exc_info=True)
+        healthy = False
+    with _health_lock:
+        _health[alias] = (now, healthy)
+    return healthy
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is None or not state.use_replica or state.wrote or connections['default'].in_atomic_block:
+            return 'default'
+        if state.alias is None:
+            # Stick to one replica per request so reads see a single snapshot.
+            healthy = [alias for alias in settings.REPLICA_DATABASES if replica_is_healthy(alias)]
+            state.alias = random.choice(healthy) if healthy else 'default'
+        return state.alias
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.REPLICA_DATABASES:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = asyncio.iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state = self.routing_for(request)
+        token = _routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.pin_if_written(request, state, response)
+
+    async def __acall__(self, request):
+        state = self.routing_for(request)
+        token = _routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        return self.pin_if_written(request, state, response)
+
+    def routing_for(self, request):
+        user_id = bearer_user_id(request)
+        if request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES:
+            return RequestRouting(False, user_id)
+        return RequestRouting(user_id is None or not self.pinned(user_id), user_id)
+
+    def pinned(self, user_id):
+        try:
+            return cache.get(pin_key(user_id)) is not None
+        except Exception:
+            logger.warning("Cache unavailable; reading from the primary", exc_info=True)
+            return True
+
+    def pin_if_written(self, request, state, response):
+        # A failed request most likely wrote nothing that needs reading back.
+        if response.status_code >= 400:
+            return response
+        if state.wrote or request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+            if state.user_id is not None:
+                try:
+                    cache.set(pin_key(state.user_id), 1, settings.REPLICA_PIN_SECONDS)
+                except Exception:
+                    logger.warning("Cache unavailable; user %s not pinned to the primary", state.user_id,
+                                   exc_info=True)
+        return response
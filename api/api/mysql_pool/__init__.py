@@ -0,0 +1,5 @@
+"""
+MySQL backend that keeps connections open between requests and tasks.
+Set ``ENGINE`` to ``api.mysql_pool`` and tune it with the ``POOL`` entry of
+the database settings; everything else behaves like Django's MySQL backend.
+"""
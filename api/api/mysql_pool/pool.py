@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from django.db import OperationalError
+from api.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+wait_seconds = registry.histogram(
+    'db_pool_wait_seconds', "Time to check a connection out of the pool, by database alias",
+    labels=('alias',), buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+pool_events = registry.counter(
+    'db_pool_events_total', "Connections opened and closed (by reason) and checkout timeouts, by alias",
+    labels=('alias', 'event'),
+)
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class Entry:
+    __slots__ = ('connection', 'created_at', 'idle_since', 'uses')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.idle_since = None
+        self.uses = 0
+
+
+class ConnectionPool:
+    """
+    At most `max_size` open DB-API connections for one database alias in
+    this process. Checkout reuses the most recently returned connection
+    after a health check, so idle ones at the other end of the queue age out.
+    Connections idle for `idle_timeout` seconds or older than
+    `max_lifetime` seconds are closed instead of handed out.
+    """
+
+    def __init__(self, alias, max_size, timeout, idle_timeout, max_lifetime, check, close):
+        self.alias = alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check = check
+        self.close = close
+        self.idle = deque()
+        self.in_use = {}
+        self.opened = 0
+        self.condition = threading.Condition()
+        self.pid = os.getpid()
+
+    def acquire(self, connect):
+        """Return (connection, reused). Raises PoolTimeout when every connection stays busy."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        try:
+            while True:
+                entry = self.take(deadline)
+                if entry is None:
+                    # A slot is reserved for us; open outside the lock.
+                    try:
+                        entry = Entry(connect())
+                    except Exception:
+                        self.forget()
+                        raise
+                    pool_events.inc(alias=self.alias, event='opened')
+                elif not self.healthy(entry):
+                    self.discard(entry, 'failed_check')
+                    continue
+                entry.uses += 1
+                with self.condition:
+                    self.in_use[id(entry.connection)] = entry
+                return entry.connection, entry.uses > 1
+        finally:
+            wait_seconds.observe(time.monotonic() - started, alias=self.alias)
+
+    def take(self, deadline):
+        """An idle entry, or None after reserving room for a new connection."""
+        expired = []
+        try:
+            with self.condition:
+                self.after_fork()
+                while True:
+                    # Expiring frees a slot, so there is never a wait with these still open.
+                    expired.extend(self.expire())
+                    if self.idle:
+                        return self.idle.pop()
+                    if self.opened < self.max_size:
+                        self.opened += 1
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        pool_events.inc(alias=self.alias, event='timeout')
+                        raise PoolTimeout(
+                            f"No connection to '{self.alias}' became free within {self.timeout}s "
+                            f"({self.max_size} in use)"
+                        )
+                    self.condition.wait(remaining)
+        finally:
+            for entry in expired:
+                self.close_quietly(entry, 'expired')
+
+    def release(self, connection, reusable=True):
+        with self.condition:
+            entry = self.in_use.pop(id(connection), None)
+            if entry is None:
+                # Checked out before a fork, or by an earlier pool.
+                return
+            if reusable and not self.too_old(entry):
+                entry.idle_since = time.monotonic()
+                self.idle.append(entry)
+                self.condition.notify()
+                return
+        self.discard(entry, 'recycled' if reusable else 'discarded')
+
+    def healthy(self, entry):
+        try:
+            self.check(entry.connection)
+            return True
+        except Exception:
+            logger.warning("Dropping broken connection to '%s'", self.alias, exc_info=True)
+            return False
+
+    def too_old(self, entry, now=None):
+        return (now or time.monotonic()) - entry.created_at >= self.max_lifetime
+
+    def expire(self):
+        """
+        Take idle connections past their idle timeout or lifetime out of the
+        pool and return them. Call with the lock held, and close them once it
+        is released, so other threads do not wait on the sockets.
+        """
+        now = time.monotonic()
+        keep = deque()
+        expired = []
+        while self.idle:
+            entry = self.idle.popleft()
+            if now - entry.idle_since >= self.idle_timeout or self.too_old(entry, now):
+                self.opened -= 1
+                expired.append(entry)
+            else:
+                keep.append(entry)
+        self.idle = keep
+        return expired
+
+    def discard(self, entry, reason):
+        self.close_quietly(entry, reason)
+        self.forget()
+
+    def forget(self):
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    def close_quietly(self, entry, reason):
+        pool_events.inc(alias=self.alias, event=reason)
+        try:
+            self.close(entry.connection)
+        except Exception:
+            logger.debug("Error closing connection to '%s'", self.alias, exc_info=True)
+
+    def after_fork(self):
+        """
+        In a forked child (e.g. a Celery prefork worker) the inherited sockets
+        belong to the parent; drop them without closing and start over.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle.clear()
+            self.in_use.clear()
+            self.opened = 0
@@ -0,0 +1,31 @@
+"""
+Shared Redis connections for features that need more than the Django cache
+API (sorted sets, scripts, counters). One pooled client per process for sync
+code and one per event loop for async code.
+"""
+import asyncio
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True,
+                                       socket_timeout=settings.REDIS_SOCKET_TIMEOUT)
+    return _client
+
+
+def get_async_redis():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = redis.asyncio.Redis.from_url(settings.REDIS_URL, decode_responses=True,
+                                              socket_timeout=settings.REDIS_SOCKET_TIMEOUT)
+        _async_clients[loop] = client
+    return client
@@ -0,0 +1,120 @@
+"""
+Precomputed OpenAPI document. Introspecting every view is expensive, so the
+schema is generated once per code version (``generate_openapi_schema``
+at deploy time, or on first use) and written to OPENAPI_SCHEMA_DIR. Each
+process then serves it from memory at a URL carrying its content hash,
+with long-lived cache headers.
+"""
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.urls import reverse
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.generators import OpenAPISchemaGenerator
+
+API_INFO = openapi.Info(
+    title="EZGroup Web API",
+    default_version='v1',
+    description='''This API allows users to interact with a blogging platform, providing functionalities such as creating, viewing, updating, and deleting blog posts, managing user sessions, posting comments, and handling likes and shares. The API includes endpoints for managing posts, user sessions, notifications, and media such as images. The documentation provides detailed specifications of each endpoint, request parameters, and responses, enabling users to easily explore and test the API.
+
+                        You can adjust or expand this description based on the specific features and endpoints your API supports.''',
+    terms_of_service="https://www.yourterms.com/",
+    contact=openapi.Contact(email="ezgroup.help@gmail.com"),
+    license=openapi.License(name="MIT"),
+)
+
+_lock = threading.Lock()
+_schema = None
+
+
+class Schema:
+    def __init__(self, content):
+        self.content = content
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """CODE_VERSION if set (e.g. the deployed git SHA), else a hash of the project's Python sources."""
+    if settings.CODE_VERSION:
+        return settings.CODE_VERSION
+    sources = hashlib.sha256()
+    for root, dirs, files in os.walk(settings.BASE_DIR):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '__pycache__')))
+        for name in sorted(files):
+            if name.endswith('.py'):
+                path = os.path.join(root, name)
+                sources.update(os.path.relpath(path, settings.BASE_DIR).encode())
+                with open(path, 'rb') as f:
+                    sources.update(f.read())
+    return sources.hexdigest()[:16]
+
+
+def artifact_path(version=None):
+    return os.path.join(settings.OPENAPI_SCHEMA_DIR, f'openapi-{version or code_version()}.json')
+
+
+def generate():
+    """Introspect every view and return the OpenAPI document as JSON bytes."""
+    generator = OpenAPISchemaGenerator(API_INFO)
+    return OpenAPICodecJson(validators=[]).encode(generator.get_schema(request=None, public=True))
+
+
+def write_artifact(force=False):
+    """Write the schema for the current code version unless it already exists. Returns its path."""
+    path = artifact_path()
+    if force or not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = generate()
+        # Write then rename so other processes never read a partial file.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+
+def get_schema():
+    global _schema
+    if _schema is None:
+        with _lock:
+            if _schema is None:
+                with open(write_artifact(), 'rb') as f:
+                    _schema = Schema(f.read())
+    return _schema
+
+
+def spec_url():
+    return reverse('openapi-schema', kwargs={'digest': get_schema().digest})
+
+
+def schema_view(request, digest=None):
+    schema = get_schema()
+    if digest != schema.digest:
+        # Unversioned or outdated URL: send clients to the current document.
+        response = HttpResponseRedirect(spec_url())
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    etag = f'"{schema.digest}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(schema.content, content_type='application/json')
+    response['ETag'] = etag
+    # The URL changes whenever the content does.
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def with_precomputed_spec(ui_view):
+    """Serve the UI view's own ``?format=openapi`` spec requests from the precomputed schema."""
+    def view(request, *args, **kwargs):
+        if request.GET.get('format') == 'openapi':
+            return schema_view(request)
+        return ui_view(request, *args, **kwargs)
+    return view
@@ -13,7 +13,6 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 from pathlib import Path
 from datetime import timedelta
 from dotenv import load_dotenv
-from celery.schedules import crontab
 import os
 
 load_dotenv()
@@ -42,13 +41,28 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.DjangoObjectPermissions",
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "api.renderers.TimedJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
 }
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=30),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
+    "TOKEN_REFRESH_SERIALIZER": "authen.serializers.RevocableTokenRefreshSerializer",
 }
 
+# Revoked refresh tokens (authen.revocation) are kept in Redis and mirrored in a
+# per-process Bloom filter sized for TOKEN_REVOCATION_FILTER_CAPACITY tokens at a
+# TOKEN_REVOCATION_FILTER_ERROR_RATE false-positive rate. It pulls new revocations
+# every TOKEN_REVOCATION_SYNC_INTERVAL seconds and is rebuilt without expired
+# tokens every TOKEN_REVOCATION_REBUILD_INTERVAL seconds
+TOKEN_REVOCATION_FILTER_CAPACITY = int(os.getenv('TOKEN_REVOCATION_FILTER_CAPACITY', 100000))
+TOKEN_REVOCATION_FILTER_ERROR_RATE = float(os.getenv('TOKEN_REVOCATION_FILTER_ERROR_RATE', 0.001))
+TOKEN_REVOCATION_SYNC_INTERVAL = float(os.getenv('TOKEN_REVOCATION_SYNC_INTERVAL', 5))
+TOKEN_REVOCATION_REBUILD_INTERVAL = int(os.getenv('TOKEN_REVOCATION_REBUILD_INTERVAL', 3600))
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -71,6 +85,8 @@ INSTALLED_APPS = [
 
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH': False,
+    # Swagger UI loads the precomputed schema instead of introspecting per request
+    'SPEC_URL': 'openapi-schema-latest',
     'SECURITY_DEFINITIONS': {
         'Session-Token': {
             'type': 'apiKey',
@@ -81,9 +97,13 @@ SWAGGER_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    'api.timing.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.db_router.ReplicaRoutingMiddleware',
     "corsheaders.middleware.CorsMiddleware",
+    'api.throttle.LoadSheddingMiddleware',
     'blog.middleware.JWTAuthenticationMiddleware',
+    'api.throttle.RateLimitMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -113,6 +133,16 @@ TEMPLATES = [
 WSGI_APPLICATION = 'api.wsgi.application'
 ASGI_APPLICATION = 'api.asgi.application'
 
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379')
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 2))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+}
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -122,21 +152,180 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Post lookups by id: a per-process LRU of POST_CACHE_LOCAL_SIZE rows kept for
+# POST_CACHE_LOCAL_TTL seconds, in front of the shared cache (POST_CACHE_TTL seconds)
+POST_CACHE_LOCAL_SIZE = int(os.getenv('POST_CACHE_LOCAL_SIZE', 1024))
+POST_CACHE_LOCAL_TTL = float(os.getenv('POST_CACHE_LOCAL_TTL', 5))
+POST_CACHE_TTL = int(os.getenv('POST_CACHE_TTL', 300))
+
+# Comment pushes to post_{id} groups: a post sending more than
+# COMMENT_BROADCAST_HOT_THRESHOLD events per interval gets one batched frame per interval
+COMMENT_BROADCAST_INTERVAL = float(os.getenv('COMMENT_BROADCAST_INTERVAL', 0.5))
+COMMENT_BROADCAST_HOT_THRESHOLD = int(os.getenv('COMMENT_BROADCAST_HOT_THRESHOLD', 5))
+# Like/comment count deltas are summed per post and pushed once per interval
+COUNTER_BROADCAST_INTERVAL = float(os.getenv('COUNTER_BROADCAST_INTERVAL', 0.25))
+# Upper bound on posts one socket may watch with "subscribe_counts"
+COUNTER_MAX_SUBSCRIPTIONS = int(os.getenv('COUNTER_MAX_SUBSCRIPTIONS', 200))
+# Seconds a post-room viewer stays counted without a heartbeat
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', 30))
+# Trending ranking: score added by a new post, each like and each comment.
+# Scores halve every TRENDING_HALF_LIFE seconds (applied by the decay task every
+# TRENDING_DECAY_INTERVAL seconds) and posts below TRENDING_MIN_SCORE drop out
+TRENDING_POST_WEIGHT = float(os.getenv('TRENDING_POST_WEIGHT', 5))
+TRENDING_LIKE_WEIGHT = float(os.getenv('TRENDING_LIKE_WEIGHT', 1))
+TRENDING_COMMENT_WEIGHT = float(os.getenv('TRENDING_COMMENT_WEIGHT', 3))
+TRENDING_HALF_LIFE = int(os.getenv('TRENDING_HALF_LIFE', 6 * 3600))
+TRENDING_DECAY_INTERVAL = int(os.getenv('TRENDING_DECAY_INTERVAL', 300))
+TRENDING_MIN_SCORE = float(os.getenv('TRENDING_MIN_SCORE', 0.1))
+# Deleted posts are hidden at once and purged by a Celery task, POST_PURGE_CHUNK_SIZE
+# child rows per statement. POST_DELETE_QUEUE=FALSE purges during the request.
+POST_DELETE_QUEUE = os.getenv('POST_DELETE_QUEUE', 'TRUE') == 'TRUE'
+POST_PURGE_CHUNK_SIZE = int(os.getenv('POST_PURGE_CHUNK_SIZE', 500))
+# Images are stored once per content hash (blog.media); an object no image uses is
+# deleted from S3 once it has been unreferenced for MEDIA_GC_GRACE seconds
+MEDIA_GC_GRACE = int(os.getenv('MEDIA_GC_GRACE', 86400))
+# Crawled images are copied into the bucket (blog.mirror), MIRROR_WORKERS downloads at
+# once and at most MIRROR_PER_HOST per host; each image gets MIRROR_MAX_ATTEMPTS tries
+MIRROR_WORKERS = int(os.getenv('MIRROR_WORKERS', 16))
+MIRROR_PER_HOST = int(os.getenv('MIRROR_PER_HOST', 4))
+MIRROR_TIMEOUT = float(os.getenv('MIRROR_TIMEOUT', 10))
+MIRROR_MAX_BYTES = int(os.getenv('MIRROR_MAX_BYTES', 10 * 1024 * 1024))
+MIRROR_MAX_ATTEMPTS = int(os.getenv('MIRROR_MAX_ATTEMPTS', 3))
+MIRROR_BATCH_SIZE = int(os.getenv('MIRROR_BATCH_SIZE', 200))
+# Crawled image URLs are only fetched from public addresses; TRUE lifts that for
+# local runs against a stand-in image host. Never in production.
+MIRROR_ALLOW_PRIVATE_HOSTS = os.getenv('MIRROR_ALLOW_PRIVATE_HOSTS') == 'TRUE'
+# Per-socket outgoing frame queue and what to do when it is full:
+# "drop_oldest", "drop_newest" or "close"
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 100))
+WS_OVERFLOW_POLICY = os.getenv('WS_OVERFLOW_POLICY', 'drop_oldest')
+
+# Token buckets for writes, by URL name: (requests per second, burst), per user
+# id or, for anonymous requests, per client IP. RATE_LIMIT=FALSE turns them off.
+RATE_LIMIT = os.getenv('RATE_LIMIT', 'TRUE') == 'TRUE'
+RATE_LIMITS = {
+    'like-post': (float(os.getenv('LIKE_RATE', 1)), int(os.getenv('LIKE_BURST', 10))),
+    'comment-create': (float(os.getenv('COMMENT_RATE', 0.2)), int(os.getenv('COMMENT_BURST', 5))),
+    'resend-otp': (float(os.getenv('OTP_RESEND_RATE', 0.05)), int(os.getenv('OTP_RESEND_BURST', 5))),
+}
+# Take the client IP from X-Forwarded-For. Required behind a proxy, where REMOTE_ADDR
+# is the proxy's. The entry used is the one the outermost of RATE_LIMIT_TRUSTED_PROXIES
+# proxies appended, counted from the right; entries left of it are client-supplied.
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED') == 'TRUE'
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', 1))
+# While the moving average query time is above LOAD_SHED_DB_LATENCY seconds, each
+# process serves at most LOAD_SHED_MAX_CONCURRENCY requests at once and answers 503
+LOAD_SHED = os.getenv('LOAD_SHED', 'TRUE') == 'TRUE'
+LOAD_SHED_DB_LATENCY = float(os.getenv('LOAD_SHED_DB_LATENCY', 0.2))
+LOAD_SHED_MAX_CONCURRENCY = int(os.getenv('LOAD_SHED_MAX_CONCURRENCY', 8))
+# Logins (authen.login): emails with no account are cached for LOGIN_UNKNOWN_EMAIL_TTL
+# seconds. last_login times are collected in Redis and written every
+# LOGIN_FLUSH_INTERVAL seconds; LOGIN_QUEUE=FALSE writes them during the request.
+LOGIN_UNKNOWN_EMAIL_TTL = int(os.getenv('LOGIN_UNKNOWN_EMAIL_TTL', 30))
+LOGIN_QUEUE = os.getenv('LOGIN_QUEUE', 'TRUE') == 'TRUE'
+LOGIN_FLUSH_INTERVAL = int(os.getenv('LOGIN_FLUSH_INTERVAL', 30))
+
+# Celery (api.celery reads every CELERY_* setting)
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', REDIS_URL)
+CELERY_BEAT_SCHEDULE = {
+    'decay-trending': {
+        'task': 'blog.tasks.decay_trending',
+        'schedule': TRENDING_DECAY_INTERVAL,
+    },
+    'sweep-expired-otps': {
+        'task': 'authen.tasks.sweep_expired_otps',
+        'schedule': 3600,
+    },
+    # Picks up mail whose flush task could not be scheduled or gave up retrying
+    'flush-mail-outbox': {
+        'task': 'authen.tasks.flush_outbox',
+        'schedule': 60,
+    },
+    # Purges deleted posts whose purge_post task could not be queued or gave up
+    'purge-deleted-posts': {
+        'task': 'blog.tasks.purge_deleted_posts',
+        'schedule': 3600,
+    },
+    'collect-unreferenced-images': {
+        'task': 'blog.tasks.collect_unreferenced_images',
+        'schedule': 3600,
+    },
+    # Retries crawled images whose copy failed or whose mirror_images task was never queued
+    'mirror-crawled-images': {
+        'task': 'blog.tasks.mirror_crawled_images',
+        'schedule': 3600,
+    },
+    'flush-last-logins': {
+        'task': 'authen.tasks.flush_last_logins',
+        'schedule': LOGIN_FLUSH_INTERVAL,
+    },
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Connections come from a per-process pool (api.mysql_pool) unless DB_POOL=FALSE:
+# at most DB_POOL_MAX_SIZE per database, waiting up to DB_POOL_TIMEOUT seconds for
+# a free one. Idle connections close after DB_POOL_IDLE_TIMEOUT seconds and every
+# connection is replaced after DB_POOL_MAX_LIFETIME (keep it below MySQL's wait_timeout).
+DB_POOL = os.getenv('DB_POOL', 'TRUE') == 'TRUE'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'api.mysql_pool' if DB_POOL else 'django.db.backends.mysql',
         'NAME': os.getenv('MYSQL_DBNAME'),
         'USER': os.getenv('MYSQL_USER'),
         'PASSWORD': os.getenv('MYSQL_PASS'),
         'HOST': os.getenv('MYSQL_HOST'),
         'PORT': os.getenv('MYSQL_PORT'),
+        'POOL': {
+            'MAX_SIZE': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+            'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            'IDLE_TIMEOUT': float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300)),
+            'MAX_LIFETIME': float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+        },
     }
 }
 
+# Read replicas: comma-separated host[:port] list. Safe requests read from a
+# replica unless the client wrote within REPLICA_PIN_SECONDS or the replica
+# lags more than REPLICA_MAX_LAG seconds (checked every REPLICA_LAG_CHECK_INTERVAL).
+REPLICA_DATABASES = []
+for index, replica in enumerate(filter(None, os.getenv('MYSQL_REPLICA_HOSTS', '').split(','))):
+    host, _, port = replica.strip().partition(':')
+    alias = f'replica_{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES.append(alias)
+
+DATABASE_ROUTERS = ['api.db_router.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 2))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 5))
+
+# Local runs and benchmarks can use SQLite instead of MySQL, and an in-process
+# cache instead of Redis
+USE_SQLITE = os.getenv('USE_SQLITE') == 'TRUE'
+
+if USE_SQLITE:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+    REPLICA_DATABASES = []
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -182,6 +371,7 @@ if USE_S3:
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
     AWS_STORAGE_BUCKET_NAME= os.getenv('AWS_STORAGE_BUCKET_NAME')
+    AWS_REGION = os.getenv('AWS_REGION')
     AWS_DEFAULT_ACL = 'public-read'
     AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
     AWS_S3_OBJECT_PARAMETERS = {'CacheControl': 'max-age=86400'}
@@ -213,8 +403,71 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER') 
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_APP_PASSWORD')  
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL')
+EMAIL_TIMEOUT = int(os.getenv('EMAIL_TIMEOUT', 10))
+
+# One-time passwords live in Redis (authen.otp.RedisOTPBackend) or in the
+# OneTimePassword table (authen.otp.DatabaseOTPBackend). A code expires after
+# OTP_TTL seconds and is discarded after OTP_MAX_ATTEMPTS wrong guesses.
+OTP_BACKEND = os.getenv('OTP_BACKEND', 'authen.otp.RedisOTPBackend')
+OTP_TTL = int(os.getenv('OTP_TTL', 300))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', 5))
+# Pending users may ask for a new code (verification/otp/resend/) once per
+# OTP_RESEND_INTERVAL seconds; the route is also rate limited per client below.
+OTP_RESEND_INTERVAL = int(os.getenv('OTP_RESEND_INTERVAL', 60))
+
+# Mail is queued in Redis and sent by the authen.tasks.flush_outbox Celery task,
+# MAIL_BATCH_SIZE messages per batch over one SMTP connection per worker (closed
+# after MAIL_SMTP_IDLE_TIMEOUT idle seconds). A failed send is retried after
+# MAIL_RETRY_DELAY seconds, doubling each time, and dropped after MAIL_MAX_ATTEMPTS.
+# MAIL_QUEUE=FALSE sends inline.
+MAIL_QUEUE = os.getenv('MAIL_QUEUE', 'TRUE') == 'TRUE'
+MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 50))
+MAIL_SMTP_IDLE_TIMEOUT = int(os.getenv('MAIL_SMTP_IDLE_TIMEOUT', 60))
+MAIL_RETRY_DELAY = int(os.getenv('MAIL_RETRY_DELAY', 10))
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 5))
+# A worker's in-flight batch is requeued by other workers after this many seconds
+# without a new claim; keep it above MAIL_BATCH_SIZE * EMAIL_TIMEOUT.
+MAIL_CLAIM_TIMEOUT = int(os.getenv('MAIL_CLAIM_TIMEOUT', 900))
 
 NEWSLETTER_ENDPOINT=os.getenv('NEWSLETTER_ENDPOINT')
+SSO_URL = os.getenv('SSO_URL')
+# Seconds a successful SSO token verification is reused (capped by the token's exp)
+SSO_VERIFY_CACHE_TTL = int(os.getenv('SSO_VERIFY_CACHE_TTL', 60))
+
+# Outbound HTTP (SSO, newsletter) timeout in seconds
+HTTP_CLIENT_TIMEOUT = float(os.getenv('HTTP_CLIENT_TIMEOUT', 5))
+
+# Serve the I/O-bound blog endpoints with native async views under ASGI
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS') == 'TRUE'
+
+# Identifies the deployed code (e.g. a git SHA); the OpenAPI schema is regenerated when it
+# changes. Defaults to a hash of the Python sources.
+CODE_VERSION = os.getenv('CODE_VERSION')
+OPENAPI_SCHEMA_DIR = os.getenv('OPENAPI_SCHEMA_DIR', os.path.join(BASE_DIR, 'openapi'))
+
+# Add a Server-Timing header (db, sso, s3, http, serialize) to every response
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'TRUE') == 'TRUE'
+# Fraction of requests written to the access log; slow requests and 5xx are always logged
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv('REQUEST_LOG_SAMPLE_RATE', 0.01))
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 1))
+# Bearer token Prometheus must send to scrape /metrics/; without one the endpoint is off
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'api.log.JSONFormatter'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'root': {'handlers': ['console'], 'level': LOG_LEVEL},
+    'loggers': {
+        'django': {'handlers': ['console'], 'level': LOG_LEVEL, 'propagate': False},
+    },
+}
 
 CORS_ORIGIN_ALLOW_ALL = True
 
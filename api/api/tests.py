@@ -0,0 +1,492 @@
+import json
+import logging
+import re
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+import fakeredis
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from blog.models import Post
+from perf import bench
+from perf.fakes import LOCAL_BACKENDS, FakeServices, make_token
+from . import db_router, schema, throttle, timing
+from .log import JSONFormatter
+from .mysql_pool import pool as mysql_pool
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'RATE_LIMIT': True, 'RATE_LIMITS': {'like-post': (1, 2)}})
+class RateLimitTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.object(throttle, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.post = Post.objects.create(title='Article', content='Nội dung')
+        self.url = reverse('like-post', kwargs={'post_id': self.post.id})
+
+    def like(self, user_id=None, **extra):
+        if user_id:
+            extra['HTTP_AUTHORIZATION'] = f'Bearer {make_token(user_id=user_id)}'
+        return self.client.post(self.url, **extra)
+
+    def test_bucket_refills_at_its_rate(self):
+        take = self.redis.register_script(throttle.TAKE_TOKEN)
+        results = [take(keys=['bucket'], args=[1, 2, now]) for now in (100, 100, 100, 100.5, 101)]
+        self.assertEqual(results, [[1, '0'], [1, '0'], [0, '1'], [0, '0.5'], [1, '0']])
+        # Idle buckets expire once they would be full again
+        self.assertLessEqual(self.redis.pttl('bucket'), 3000)
+
+    def test_token_holders_have_a_bucket_each(self):
+        self.assertEqual(self.like('alice').status_code, 201)
+        self.assertEqual(self.like('alice').status_code, 400)
+        response = self.like('alice')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.like('bob').status_code, 201)
+        self.assertEqual(sorted(self.redis.keys('ratelimit:*')),
+                         ['ratelimit:like-post:user:alice', 'ratelimit:like-post:user:bob'])
+
+    def test_anonymous_clients_are_keyed_by_address(self):
+        # Limits apply before the view runs, so a missing post still takes a token
+        self.url = reverse('like-post', kwargs={'post_id': 0})
+        statuses = [self.like(REMOTE_ADDR=address).status_code for address in ('10.0.0.1',) * 3 + ('10.0.0.2',)]
+        self.assertEqual(statuses, [404, 404, 429, 404])
+
+    def test_forwarded_for_is_trusted_only_when_enabled(self):
+        request = RequestFactory().post(self.url, REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='203.0.113.7')
+        middleware = throttle.RateLimitMiddleware(lambda request: None)
+        self.assertEqual(middleware.client_of(request), 'ip:10.0.0.2')
+        with override_settings(RATE_LIMIT_TRUST_FORWARDED=True):
+            self.assertEqual(middleware.client_of(request), 'ip:203.0.113.7')
+
+    @override_settings(RATE_LIMIT_TRUST_FORWARDED=True)
+    def test_client_supplied_forwarded_entries_are_ignored(self):
+        middleware = throttle.RateLimitMiddleware(lambda request: None)
+
+        def client(forwarded):
+            return middleware.client_of(RequestFactory().post(self.url, REMOTE_ADDR='10.0.0.2',
+                                                              HTTP_X_FORWARDED_FOR=forwarded))
+
+        # The client sent a random first entry; the proxy appended the real address.
+        self.assertEqual(client('198.51.100.1, 203.0.113.7'), 'ip:203.0.113.7')
+        self.assertEqual(client('198.51.100.2, 203.0.113.7'), 'ip:203.0.113.7')
+        with override_settings(RATE_LIMIT_TRUSTED_PROXIES=2):
+            self.assertEqual(client('198.51.100.1, 203.0.113.7, 10.0.0.1'), 'ip:203.0.113.7')
+            self.assertEqual(client('203.0.113.7'), 'ip:203.0.113.7')
+
+
+def timings(queries, seconds):
+    return SimpleNamespace(counts={'db': queries}, durations={'db': seconds})
+
+
+@override_settings(LOAD_SHED_DB_LATENCY=0.2, LOAD_SHED_MAX_CONCURRENCY=2)
+class LoadShedderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(throttle, 'time', SimpleNamespace(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shedder = throttle.LoadShedder()
+
+    def test_slow_queries_cap_concurrency(self):
+        self.assertTrue(self.shedder.admit())
+        self.shedder.finish(timings(2, 1.0))
+        self.assertTrue(self.shedder.degraded())
+        self.assertEqual([self.shedder.admit() for _ in range(3)], [True, True, False])
+        self.shedder.finish(None)
+        self.assertTrue(self.shedder.admit())
+
+    def test_requests_without_queries_leave_the_average(self):
+        self.shedder.admit()
+        self.shedder.finish(timings(1, 0.4))
+        self.shedder.admit()
+        self.shedder.finish(timings(0, 0.0))
+        self.assertEqual(self.shedder.current_latency(), 0.4)
+
+    def test_average_decays_while_idle(self):
+        self.shedder.admit()
+        self.shedder.finish(timings(1, 0.4))
+        self.now += throttle.LATENCY_HALF_LIFE
+        self.assertAlmostEqual(self.shedder.current_latency(), 0.2)
+        self.now += 1
+        self.assertFalse(self.shedder.degraded())
+        self.assertEqual([self.shedder.admit() for _ in range(3)], [True, True, True])
+
+    def test_new_samples_blend_with_the_decayed_average(self):
+        self.shedder.admit()
+        self.shedder.finish(timings(1, 0.4))
+        self.now += throttle.LATENCY_HALF_LIFE
+        self.shedder.admit()
+        self.shedder.finish(timings(1, 1.2))
+        self.assertAlmostEqual(self.shedder.latency, 0.2 + throttle.LATENCY_SMOOTHING * 1.0)
+
+
+@override_settings(**LOCAL_BACKENDS, METRICS_TOKEN='scrape-token')
+class LoadSheddingMiddlewareTestCase(TestCase):
+    def test_rejections_carry_cors_headers(self):
+        with mock.patch.object(throttle.LoadShedder, 'admit', return_value=False):
+            response = self.client.get(reverse('post-list'), HTTP_ORIGIN='https://ezblog.example')
+            metrics = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertIn('Access-Control-Allow-Origin', response)
+        self.assertEqual(metrics.status_code, 200)
+
+
+class FakeConnection:
+    """Stands in for a DB-API connection; the pool only checks and closes it."""
+
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(mysql_pool, 'time', SimpleNamespace(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Whether the pool's lock was free each time a connection was closed
+        self.closed_unlocked = []
+        self.pool = self.make_pool()
+
+    def make_pool(self, max_size=2, timeout=0.0):
+        return mysql_pool.ConnectionPool('default', max_size=max_size, timeout=timeout, idle_timeout=60,
+                                         max_lifetime=600, check=self.check, close=self.close)
+
+    def check(self, connection):
+        if connection.broken:
+            raise ConnectionError("server has gone away")
+
+    def close(self, connection):
+        connection.closed = True
+        self.closed_unlocked.append(self.lock_is_free())
+
+    def lock_is_free(self):
+        # The condition's lock is reentrant, so probe it from another thread.
+        free = []
+
+        def probe():
+            free.append(self.pool.condition.acquire(blocking=False))
+            if free[0]:
+                self.pool.condition.release()
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return free[0]
+
+    def test_returned_connections_are_reused(self):
+        first, reused = self.pool.acquire(FakeConnection)
+        self.assertFalse(reused)
+        self.pool.release(first)
+        self.assertEqual(self.pool.acquire(FakeConnection), (first, True))
+        self.assertEqual(self.pool.opened, 1)
+
+    def test_checkout_times_out_when_every_connection_is_busy(self):
+        self.pool.acquire(FakeConnection)
+        self.pool.acquire(FakeConnection)
+        with self.assertRaises(mysql_pool.PoolTimeout):
+            self.pool.acquire(FakeConnection)
+        self.assertEqual(self.pool.opened, 2)
+
+    def test_released_connection_goes_to_a_waiter(self):
+        patcher = mock.patch.object(mysql_pool, 'time', time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = self.make_pool(max_size=1, timeout=5)
+        held, _ = self.pool.acquire(FakeConnection)
+        handed = []
+        waiter = threading.Thread(target=lambda: handed.append(self.pool.acquire(FakeConnection)))
+        waiter.start()
+        while not self.pool.condition._waiters:
+            time.sleep(0.001)
+        self.pool.release(held)
+        waiter.join()
+        self.assertEqual(handed, [(held, True)])
+        self.assertEqual(self.pool.opened, 1)
+
+    def test_connection_failing_its_check_is_replaced(self):
+        broken, _ = self.pool.acquire(FakeConnection)
+        self.pool.release(broken)
+        broken.broken = True
+        connection, reused = self.pool.acquire(FakeConnection)
+        self.assertIsNot(connection, broken)
+        self.assertFalse(reused)
+        self.assertTrue(broken.closed)
+        self.assertEqual(self.pool.opened, 1)
+
+    def test_idle_and_old_connections_are_closed_outside_the_lock(self):
+        idle, _ = self.pool.acquire(FakeConnection)
+        old, _ = self.pool.acquire(FakeConnection)
+        self.pool.release(idle)
+        self.now += 60
+        self.pool.release(old)
+        connection, reused = self.pool.acquire(FakeConnection)
+        self.assertEqual((connection, reused), (old, True))
+        self.assertTrue(idle.closed)
+
+        self.now += 540
+        self.pool.release(old)
+        self.assertTrue(old.closed, "past its lifetime")
+        self.assertEqual(self.pool.opened, 0)
+        self.assertEqual(self.closed_unlocked, [True, True])
+
+    def test_fork_drops_inherited_connections_without_closing_them(self):
+        inherited, _ = self.pool.acquire(FakeConnection)
+        idle, _ = self.pool.acquire(FakeConnection)
+        self.pool.release(idle)
+        self.pool.pid = -1
+        connection, reused = self.pool.acquire(FakeConnection)
+        self.assertNotIn(connection, (inherited, idle))
+        self.assertFalse(reused)
+        self.pool.release(inherited)
+        self.assertFalse(inherited.closed or idle.closed)
+        self.assertEqual(self.pool.opened, 1)
+
+
+@override_settings(**LOCAL_BACKENDS, REPLICA_DATABASES=['replica_0'], REPLICA_PIN_SECONDS=5, REPLICA_MAX_LAG=2,
+                   REPLICA_LAG_CHECK_INTERVAL=5)
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Routing between the test database and an empty SQLite 'replica', so each
+    read shows where it went. Not a TestCase: its per-test transaction would
+    send every read to the primary.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test runner set up its databases, so this one is left as it is: empty.
+        connections.settings['replica_0'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        with connections['replica_0'].schema_editor() as editor:
+            editor.create_model(Post)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica_0'].close()
+        del connections['replica_0']
+        del connections.settings['replica_0']
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        db_router._health.clear()
+        # Writes commit here, so their on_commit hooks (trending) run against the fake Redis.
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.lag = 0
+        patcher = mock.patch.object(db_router, 'replica_lag', side_effect=lambda alias: self.lag)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.factory = RequestFactory()
+        self.middleware = db_router.ReplicaRoutingMiddleware(self.view)
+
+    def view(self, request):
+        params = request.GET if request.method == 'GET' else request.POST
+        if params.get('write'):
+            Post.objects.create(title='Written', content='Nội dung')
+        if params.get('atomic'):
+            with transaction.atomic():
+                return HttpResponse(str(Post.objects.count()))
+        return HttpResponse(str(Post.objects.count()), status=int(params.get('status', 200)))
+
+    def request(self, method='get', user_id=None, cookies=None, **params):
+        request = getattr(self.factory, method)('/', params)
+        if user_id:
+            request.META['HTTP_AUTHORIZATION'] = f'Bearer {make_token(user_id=user_id)}'
+        request.COOKIES.update(cookies or {})
+        return self.middleware(request)
+
+    def posts_seen(self, **kwargs):
+        return int(self.request(**kwargs).content)
+
+    def test_safe_requests_read_from_the_replica(self):
+        Post.objects.create(title='Article', content='Nội dung')
+        self.assertEqual(self.posts_seen(), 0)
+        self.assertEqual(self.posts_seen(method='post'), 1)
+
+    def test_request_reads_its_own_writes(self):
+        self.assertEqual(self.posts_seen(write='1'), 1)
+        self.assertEqual(Post.objects.count(), 1)
+        self.assertEqual(Post.objects.using('replica_0').count(), 0)
+
+    def test_writers_are_pinned_by_cookie_and_by_user_id(self):
+        response = self.request(method='post', user_id='writer', write='1')
+        self.assertEqual(response.cookies[db_router.PIN_COOKIE]['max-age'], 5)
+        self.assertEqual(self.posts_seen(cookies={db_router.PIN_COOKIE: '1'}), 1)
+        # A bearer-token client sends no cookies
+        self.assertEqual(self.posts_seen(user_id='writer'), 1)
+        self.assertEqual(self.posts_seen(user_id='reader'), 0)
+        cache.delete(db_router.pin_key('writer'))
+        self.assertEqual(self.posts_seen(user_id='writer'), 0)
+
+    def test_failed_writes_do_not_pin(self):
+        response = self.request(method='post', user_id='writer', write='1', status='400')
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+        self.assertEqual(self.posts_seen(user_id='writer'), 0)
+        response = self.request(method='post', user_id='writer', status='302')
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+        self.assertEqual(self.posts_seen(user_id='writer'), 1)
+
+    def test_reads_inside_a_transaction_use_the_primary(self):
+        Post.objects.create(title='Article', content='Nội dung')
+        self.assertEqual(self.posts_seen(atomic='1'), 1)
+        self.assertEqual(self.posts_seen(), 0)
+
+    def test_lagging_replica_is_skipped_until_it_catches_up(self):
+        Post.objects.create(title='Article', content='Nội dung')
+        for lag in (10, None):
+            with self.subTest(lag=lag):
+                db_router._health.clear()
+                self.lag = lag
+                self.assertEqual(self.posts_seen(), 1)
+        # The result is kept for REPLICA_LAG_CHECK_INTERVAL seconds
+        self.lag = 0
+        self.assertEqual(self.posts_seen(), 1)
+        db_router._health.clear()
+        self.assertEqual(self.posts_seen(), 0)
+
+    def test_code_outside_requests_uses_the_primary(self):
+        self.assertEqual(router.db_for_read(Post), 'default')
+        self.assertEqual(router.db_for_write(Post), 'default')
+
+
+class BenchmarkCompareTestCase(SimpleTestCase):
+    baseline = {'100': {'blog.post-list': {'p95_ms': 10.0, 'queries': 1, 'peak_alloc_kb': 100.0}}}
+
+    def compare(self, latency_tolerance=None, **result):
+        result = {**self.baseline['100']['blog.post-list'], **result}
+        found = bench.regressions({'100': {'blog.post-list': result}}, self.baseline, 0.25, latency_tolerance)
+        return [metric for _, _, metric, _, _ in found]
+
+    def test_any_extra_query_fails(self):
+        self.assertEqual(self.compare(queries=2), ['queries'])
+        self.assertEqual(self.compare(queries=1, peak_alloc_kb=120.0), [])
+        self.assertEqual(self.compare(peak_alloc_kb=130.0), ['peak_alloc_kb'])
+
+    def test_latency_is_compared_only_on_request(self):
+        self.assertEqual(self.compare(p95_ms=50.0), [])
+        self.assertEqual(self.compare(p95_ms=50.0, latency_tolerance=0.5), ['p95_ms'])
+        self.assertEqual(self.compare(p95_ms=14.0, latency_tolerance=0.5), [])
+
+
+@override_settings(**LOCAL_BACKENDS, SERVER_TIMING=True, METRICS_TOKEN='scrape-token', SLOW_REQUEST_SECONDS=60,
+                   REQUEST_LOG_SAMPLE_RATE=0.1)
+class RequestTimingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.post = Post.objects.create(title='Article', content='Nội dung')
+        self.url = reverse('post-details', kwargs={'post_id': self.post.id})
+        self.roll = 0.5
+        patcher = mock.patch.object(timing, 'random', SimpleNamespace(random=lambda: self.roll))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scrape(self):
+        return self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-token').content.decode()
+
+    def test_server_timing_lists_the_components_used(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        entries = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertRegex(entries['db'], r'^dur=\d+\.\d;desc="count=[1-9]\d*"$')
+        self.assertRegex(entries['serialize'], r'^dur=\d+\.\d;desc="count=[1-9]\d*"$')
+        self.assertRegex(entries['total'], r'^dur=\d+\.\d$')
+        self.assertNotIn('s3', entries)
+        with override_settings(SERVER_TIMING=False):
+            self.assertNotIn('Server-Timing', self.client.get(self.url))
+
+    def test_metrics_are_labelled_by_route(self):
+        sample = re.compile(r'^http_request_duration_seconds_count\{route="api/v1/blogs/posts/<int:post_id>/details/",'
+                            r'method="GET",status="2xx"\} (\d+)$', re.M)
+        before = sample.search(self.scrape())
+        self.client.get(self.url)
+        self.client.get(self.url)
+        after = int(sample.search(self.scrape()).group(1))
+        self.assertEqual(after - (int(before.group(1)) if before else 0), 2)
+        self.assertIn('http_request_component_seconds_count{route="api/v1/blogs/posts/<int:post_id>/details/",'
+                      'component="db"}', self.scrape())
+
+    def test_requests_are_logged_when_sampled_or_slow(self):
+        with self.assertNoLogs('api.requests'):
+            self.client.get(self.url)
+        self.roll = 0.05
+        with self.assertLogs('api.requests', 'INFO') as logs:
+            self.client.get(self.url)
+        record = logs.records[0]
+        self.assertEqual((record.levelno, record.route, record.status),
+                         (logging.INFO, 'api/v1/blogs/posts/<int:post_id>/details/', 200))
+        self.assertGreaterEqual(record.queries, 1)
+        self.roll = 0.5
+        with override_settings(SLOW_REQUEST_SECONDS=0), self.assertLogs('api.requests', 'WARNING'):
+            self.client.get(self.url)
+
+    def test_log_lines_are_json_with_extra_fields(self):
+        record = logging.LogRecord('api.requests', logging.INFO, __file__, 1, 'request', (), None)
+        record.route, record.duration_ms = 'posts/', 12.5
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual({key: entry[key] for key in ('level', 'logger', 'message', 'route', 'duration_ms')},
+                         {'level': 'INFO', 'logger': 'api.requests', 'message': 'request', 'route': 'posts/',
+                          'duration_ms': 12.5})
+        self.assertRegex(entry['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z$')
+
+
+class SchemaTestCase(SimpleTestCase):
+    document = b'{"swagger": "2.0", "paths": {}}'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(OPENAPI_SCHEMA_DIR=directory.name, CODE_VERSION='test')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        schema.code_version.cache_clear()
+        self.addCleanup(schema.code_version.cache_clear)
+        self.generate = mock.Mock(return_value=self.document)
+        for patcher in (mock.patch.object(schema, '_schema', None),
+                        mock.patch.object(schema, 'generate', self.generate)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_unversioned_url_redirects_to_the_hashed_one(self):
+        response = self.client.get('/api/docs/openapi.json')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        digest = schema.hashlib.sha256(self.document).hexdigest()[:16]
+        self.assertEqual(response['Location'], f'/api/docs/openapi.{digest}.json')
+        self.assertEqual(self.client.get('/api/docs/openapi.0123456789abcdef.json')['Location'], response['Location'])
+
+    def test_hashed_url_is_immutable_and_revalidates_by_etag(self):
+        url = schema.spec_url()
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.content), (200, self.document))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_artifact_is_generated_once_per_code_version(self):
+        self.client.get(schema.spec_url())
+        with mock.patch.object(schema, '_schema', None):
+            self.client.get(schema.spec_url())
+        self.assertEqual(self.generate.call_count, 1)
+        with open(schema.artifact_path('test'), 'rb') as f:
+            self.assertEqual(f.read(), self.document)
+
+    def test_ui_spec_requests_use_the_precomputed_schema(self):
+        response = self.client.get('/api/docs/?format=openapi')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], schema.spec_url())
+        self.assertEqual(self.client.get('/api/docs/').status_code, 200)
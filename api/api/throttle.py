@@ -0,0 +1,224 @@
+"""
+Admission control for HTTP requests.
+
+``LoadSheddingMiddleware`` keeps a moving average of query latency per
+process. While it is above LOAD_SHED_DB_LATENCY, the process serves at most
+LOAD_SHED_MAX_CONCURRENCY requests at a time and answers the rest with 503
+before any view code runs, so a slow database is not handed more work than
+it can finish. The average decays with time as well, so a process serving
+from the cache after a slow spell is not capped forever.
+
+``RateLimitMiddleware`` puts a token bucket in Redis in front of the routes
+listed in RATE_LIMITS, one bucket per route and per user id (client IP for
+anonymous requests). Each check is one atomic script call, O(1), and
+requests over the limit get 429 with a Retry-After header. If Redis is
+unreachable, requests are let through.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+import redis
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from .metrics import registry
+from .redis_client import get_async_redis, get_redis
+from .timing import current_timings
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Never shed these, so overload stays observable.
+EXEMPT_PATHS = ('/metrics/',)
+# Weight of the newest request in the query latency average.
+LATENCY_SMOOTHING = 0.1
+# Seconds without queries after which the latency average has halved.
+LATENCY_HALF_LIFE = 10.0
+
+rate_limited = registry.counter(
+    'rate_limited_total', "Requests rejected by the per-client token bucket, by route.", labels=('route',)
+)
+shed = registry.counter('load_shed_total', "Requests rejected while the database was slow.")
+
+# Take one token from the bucket in KEYS[1], refilled at ARGV[1] tokens per
+# second up to ARGV[2], as of time ARGV[3]. Returns {1, 0} when a token was
+# taken, otherwise {0, seconds until one is available}. Idle buckets expire
+# once they would be full again.
+TAKE_TOKEN = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+
+def error_response(message, status, retry_after):
+    response = JsonResponse({"EC": -1, "EM": message, "DT": ""}, status=status)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class LoadShedder:
+    def __init__(self):
+        self.latency = None
+        self.measured_at = None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def current_latency(self):
+        """The latency average, decayed by the time since its last sample."""
+        if self.latency is None:
+            return None
+        return self.latency * 0.5 ** ((time.monotonic() - self.measured_at) / LATENCY_HALF_LIFE)
+
+    def degraded(self):
+        latency = self.current_latency()
+        return latency is not None and latency > settings.LOAD_SHED_DB_LATENCY
+
+    def admit(self):
+        with self.lock:
+            if self.degraded() and self.in_flight >= settings.LOAD_SHED_MAX_CONCURRENCY:
+                return False
+            self.in_flight += 1
+            return True
+
+    def finish(self, timings):
+        with self.lock:
+            self.in_flight -= 1
+            if timings is None or not timings.counts['db']:
+                return
+            sample = timings.durations['db'] / timings.counts['db']
+            latency = self.current_latency()
+            if latency is None:
+                self.latency = sample
+            else:
+                self.latency = latency + LATENCY_SMOOTHING * (sample - latency)
+            self.measured_at = time.monotonic()
+
+
+class LoadSheddingMiddleware:
+    """
+    Install below RequestTimingMiddleware, which measures the queries, and
+    below CorsMiddleware, so that browsers can read the 503.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.LOAD_SHED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.shedder = LoadShedder()
+        self.async_mode = asyncio.iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if request.path.startswith(EXEMPT_PATHS):
+            return self.get_response(request)
+        if not self.shedder.admit():
+            return self.overloaded_response()
+        try:
+            return self.get_response(request)
+        finally:
+            self.shedder.finish(current_timings())
+
+    async def __acall__(self, request):
+        if request.path.startswith(EXEMPT_PATHS):
+            return await self.get_response(request)
+        if not self.shedder.admit():
+            return self.overloaded_response()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.shedder.finish(current_timings())
+
+    def overloaded_response(self):
+        shed.inc()
+        return error_response("Server is busy, please retry", 503, 1)
+
+
+class RateLimitMiddleware:
+    """Install after the authentication middleware, which sets ``request.user_data``."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.RATE_LIMIT or not settings.RATE_LIMITS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = asyncio.iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        check = self.bucket_for(request)
+        if check is not None:
+            route, key, args = check
+            try:
+                allowed, wait = get_redis().register_script(TAKE_TOKEN)(keys=[key], args=args)
+            except redis.RedisError:
+                logger.warning("Rate limiter unavailable; allowing request", exc_info=True)
+            else:
+                if not int(allowed):
+                    return self.limited_response(route, float(wait))
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        check = self.bucket_for(request)
+        if check is not None:
+            route, key, args = check
+            try:
+                allowed, wait = await get_async_redis().register_script(TAKE_TOKEN)(keys=[key], args=args)
+            except redis.RedisError:
+                logger.warning("Rate limiter unavailable; allowing request", exc_info=True)
+            else:
+                if not int(allowed):
+                    return self.limited_response(route, float(wait))
+        return await self.get_response(request)
+
+    def bucket_for(self, request):
+        """(route, bucket key, script args) for a limited request, else None."""
+        if request.method in SAFE_METHODS:
+            return None
+        try:
+            route = resolve(request.path_info).url_name
+        except Resolver404:
+            return None
+        if route not in settings.RATE_LIMITS:
+            return None
+        rate, burst = settings.RATE_LIMITS[route]
+        return route, f'ratelimit:{route}:{self.client_of(request)}', [rate, burst, time.time()]
+
+    def client_of(self, request):
+        user_data = getattr(request, 'user_data', None)
+        if user_data and user_data.get('id'):
+            return f"user:{user_data['id']}"
+        forwarded = [entry.strip() for entry in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        forwarded = [entry for entry in forwarded if entry]
+        if settings.RATE_LIMIT_TRUST_FORWARDED and forwarded:
+            # Each proxy appends the address it saw; anything further left may be forged.
+            return f"ip:{forwarded[-min(settings.RATE_LIMIT_TRUSTED_PROXIES, len(forwarded))]}"
+        return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+    def limited_response(self, route, wait):
+        rate_limited.inc(route=route)
+        return error_response("Too many requests, please slow down", 429, wait)
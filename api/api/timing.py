@@ -0,0 +1,166 @@
+"""
+Per-request time accounting. ``RequestTimingMiddleware`` opens a
+``Timings`` for each request; code that calls out to the database, SSO, S3,
+other HTTP services or serializes data wraps that work in ``timed(...)``.
+Outside a request (Celery, management commands) ``timed`` is a no-op.
+Models import this module, so it must not import DRF (see api.renderers).
+
+Each response gets a ``Server-Timing`` header, and durations are exported
+per route at ``/metrics/``.
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from .metrics import registry
+
+logger = logging.getLogger('api.requests')
+
+COMPONENTS = ('db', 'sso', 's3', 'http', 'serialize')
+
+_timings = contextvars.ContextVar('request_timings', default=None)
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', "Time to produce a response, by route.",
+    labels=('route', 'method', 'status'),
+)
+component_duration = registry.histogram(
+    'http_request_component_seconds', "Time a request spent in one component, by route.",
+    labels=('route', 'component'),
+)
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = dict.fromkeys(COMPONENTS, 0.0)
+        self.counts = dict.fromkeys(COMPONENTS, 0)
+        # Nested timed() blocks for the same component count once.
+        self.depth = dict.fromkeys(COMPONENTS, 0)
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+
+def current_timings():
+    """The Timings of the request being served, or None outside a request."""
+    return _timings.get()
+
+
+@contextmanager
+def timed(component):
+    timings = _timings.get()
+    if timings is None or timings.depth[component]:
+        yield
+        return
+    timings.depth[component] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.durations[component] += time.perf_counter() - started
+        timings.counts[component] += 1
+        timings.depth[component] -= 1
+
+
+def time_queries(execute, sql, params, many, context):
+    with timed('db'):
+        return execute(sql, params, many, context)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    if time_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_queries)
+
+
+connection_created.connect(install_query_timer)
+
+
+class TimedSerializerMixin:
+    """Count a serializer's ``to_representation`` work as 'serialize' time."""
+
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super().to_representation(instance)
+
+
+def server_timing(timings, total):
+    entries = [
+        f'{component};dur={timings.durations[component] * 1000:.1f};desc="count={timings.counts[component]}"'
+        for component in COMPONENTS if timings.counts[component]
+    ]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+class RequestTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = asyncio.iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings = Timings()
+        token = _timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.record(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = Timings()
+        token = _timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+        return self.record(request, response, timings)
+
+    def record(self, request, response, timings):
+        total = timings.total()
+        route = route_of(request)
+        request_duration.observe(total, route=route, method=request.method,
+                                 status=f'{response.status_code // 100}xx')
+        for component in COMPONENTS:
+            if timings.counts[component]:
+                component_duration.observe(timings.durations[component], route=route, component=component)
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = server_timing(timings, total)
+        self.log(request, response, route, timings, total)
+        return response
+
+    def log(self, request, response, route, timings, total):
+        if response.status_code >= 500:
+            level = logging.ERROR
+        elif total >= settings.SLOW_REQUEST_SECONDS:
+            level = logging.WARNING
+        elif random.random() < settings.REQUEST_LOG_SAMPLE_RATE:
+            level = logging.INFO
+        else:
+            return
+        logger.log(level, "request", extra={
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            **{f'{component}_ms': round(timings.durations[component] * 1000, 1)
+               for component in COMPONENTS if timings.counts[component]},
+            'queries': timings.counts['db'],
+        })
@@ -1,21 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include
-from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework.permissions import AllowAny
 from django.conf import settings
+from api.metrics import metrics_view
+from api.schema import API_INFO, schema_view as openapi_view, with_precomputed_spec
 
 schema_view = get_schema_view(
-    openapi.Info(
-        title="EZGroup Web API",
-        default_version='v1',
-        description='''This API allows users to interact with a blogging platform, providing functionalities such as creating, viewing, updating, and deleting blog posts, managing user sessions, posting comments, and handling likes and shares. The API includes endpoints for managing posts, user sessions, notifications, and media such as images. The documentation provides detailed specifications of each endpoint, request parameters, and responses, enabling users to easily explore and test the API.
-
-                        You can adjust or expand this description based on the specific features and endpoints your API supports.''',
-        terms_of_service="https://www.yourterms.com/",
-        contact=openapi.Contact(email="ezgroup.help@gmail.com"),
-        license=openapi.License(name="MIT"),
-    ),
+    API_INFO,
     public=True,
     permission_classes=[AllowAny],  
 )
@@ -24,5 +16,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/authen/', include('authen.urls')),
     path('api/v1/blogs/', include('blog.urls')),
-    path('api/docs/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
+    path('metrics/', metrics_view, name='metrics'),
+    # The spec is precomputed (api/schema.py); the UI page itself is cheap to render.
+    path('api/docs/openapi.json', openapi_view, name='openapi-schema-latest'),
+    path('api/docs/openapi.<str:digest>.json', openapi_view, name='openapi-schema'),
+    path('api/docs/', with_precomputed_spec(schema_view.with_ui('swagger', cache_timeout=0)), name='schema-swagger-ui'),
 ]
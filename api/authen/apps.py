@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AuthenConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authen'
+
+    def ready(self):
+        # Connect the signal that forgets cached unknown emails once they register
+        from . import login  # noqa: F401
@@ -0,0 +1,110 @@
+"""
+Password login.
+
+``authenticate`` loads only the columns a login needs. An email with no
+account is remembered in the cache for LOGIN_UNKNOWN_EMAIL_TTL seconds, so
+repeated attempts for it (typos, credential stuffing) skip the database;
+creating the account forgets it again.
+
+``record_login`` keeps ``last_login`` off the request path. It notes the
+time in the ``login:last`` Redis hash, and the ``flush_last_logins`` beat
+task writes the collected times with one single-column UPDATE per batch.
+If LOGIN_QUEUE is off or Redis is unreachable, the column is updated
+directly instead.
+"""
+import datetime
+import hashlib
+import logging
+from functools import partial
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from api.redis_client import get_redis
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+LAST_LOGIN_KEY = 'login:last'
+# What a login reads: the password to check, whether the account may log in,
+# and the token's user id
+LOGIN_FIELDS = ('id', 'password', 'is_active')
+FLUSH_BATCH_SIZE = 500
+UNKNOWN = 1
+
+
+def unknown_key(email):
+    # MySQL compares emails case-insensitively, so one entry covers every spelling.
+    return f'login:unknown:{hashlib.sha1(email.lower().encode()).hexdigest()}'
+
+
+def find_user(email):
+    """The user with `email`, with only LOGIN_FIELDS loaded, or None."""
+    try:
+        if cache.get(unknown_key(email)) == UNKNOWN:
+            return None
+    except Exception:
+        logger.warning("Login cache unavailable", exc_info=True)
+    user = User.objects.only(*LOGIN_FIELDS).filter(email=email).first()
+    if user is None:
+        try:
+            cache.set(unknown_key(email), UNKNOWN, settings.LOGIN_UNKNOWN_EMAIL_TTL)
+        except Exception:
+            logger.warning("Login cache unavailable", exc_info=True)
+    return user
+
+
+def forget_unknown(emails):
+    try:
+        cache.delete_many([unknown_key(email) for email in emails])
+    except Exception:
+        logger.warning("Login cache unavailable", exc_info=True)
+
+
+def authenticate(email, password):
+    """The user for these credentials, or None."""
+    user = find_user(email)
+    if user is None or not user.check_password(password):
+        return None
+    return user
+
+
+def record_login(user):
+    now = timezone.now()
+    if settings.LOGIN_QUEUE:
+        try:
+            get_redis().hset(LAST_LOGIN_KEY, user.pk, now.timestamp())
+            return
+        except redis.RedisError:
+            logger.warning("Login queue unavailable; updating last_login inline", exc_info=True)
+    transaction.on_commit(partial(write_last_login, user.pk, now))
+
+
+def write_last_login(pk, at):
+    User.objects.filter(pk=pk).update(last_login=at)
+
+
+def flush_last_logins():
+    """Write the login times collected in Redis. Returns how many users were updated."""
+    with get_redis().pipeline() as pipe:
+        pipe.hgetall(LAST_LOGIN_KEY)
+        pipe.delete(LAST_LOGIN_KEY)
+        collected, _ = pipe.execute()
+    if not collected:
+        return 0
+    times = {
+        int(pk): datetime.datetime.fromtimestamp(float(at), tz=datetime.timezone.utc)
+        for pk, at in collected.items()
+    }
+    User.objects.bulk_update([User(pk=pk, last_login=at) for pk, at in times.items()],
+                             ['last_login'], batch_size=FLUSH_BATCH_SIZE)
+    return len(times)
+
+
+@receiver(post_save, sender=User, dispatch_uid='login_user_created')
+def user_created(sender, instance, created=False, **kwargs):
+    if created:
+        forget_unknown([instance.email])
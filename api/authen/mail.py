@@ -0,0 +1,199 @@
+"""
+Outgoing mail, sent off the request path.
+
+``queue_mail`` pushes a message onto a Redis list once the current
+transaction commits and makes sure a ``flush_outbox`` task is scheduled.
+The worker drains the list MAIL_BATCH_SIZE messages at a time over one SMTP
+connection that it keeps open between batches. If Redis is unreachable, or
+MAIL_QUEUE is off, the message is sent inline as before.
+
+A batch is moved, not popped, onto the worker's own processing list and
+only removed from there once it has been sent, so a worker that dies
+mid-batch loses nothing: a later flush puts lists not claimed for
+MAIL_CLAIM_TIMEOUT seconds back on the outbox. A message may then be sent
+twice, never zero times.
+"""
+import json
+import logging
+import os
+import smtplib
+import socket
+import time
+from functools import partial
+import redis
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from api.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_KEY = 'mail:outbox'
+# Set while a flush task is pending, so a burst of messages schedules one task
+FLUSH_KEY = 'mail:flush-scheduled'
+FLUSH_KEY_TTL = 60
+# Each worker process moves its current batch onto its own list...
+PROCESSING_KEY = 'mail:processing:{}'
+# ...and records here, by list name, when it last claimed a batch
+CLAIMS_KEY = 'mail:processing'
+
+_smtp = None
+_smtp_used_at = 0.0
+
+
+def queue_mail(subject, recipients, body='', from_email=None):
+    """Send a message after the current transaction commits, without waiting for SMTP."""
+    message = {
+        'subject': subject,
+        'body': body,
+        'from_email': from_email or settings.DEFAULT_FROM_EMAIL,
+        'to': list(recipients),
+        'attempts': 0,
+    }
+    transaction.on_commit(partial(enqueue, message))
+
+
+def enqueue(message):
+    if not settings.MAIL_QUEUE:
+        send_now(message)
+        return
+    try:
+        client = get_redis()
+        client.rpush(OUTBOX_KEY, json.dumps(message))
+        schedule = client.set(FLUSH_KEY, 1, nx=True, ex=FLUSH_KEY_TTL)
+    except redis.RedisError:
+        logger.warning("Mail queue unavailable; sending inline", exc_info=True)
+        send_now(message)
+        return
+    if schedule:
+        from .tasks import flush_outbox
+        try:
+            flush_outbox.delay()
+        except Exception:
+            # The periodic flush sends it instead.
+            logger.warning("Could not schedule a mail flush", exc_info=True)
+
+
+def send_now(message):
+    get_connection().send_messages([build(message)])
+
+
+def build(message):
+    return EmailMessage(message['subject'], message['body'], message['from_email'], message['to'])
+
+
+def smtp_connection():
+    """This worker's open SMTP connection, reopened after MAIL_SMTP_IDLE_TIMEOUT idle seconds."""
+    global _smtp, _smtp_used_at
+    if _smtp is not None and time.monotonic() - _smtp_used_at > settings.MAIL_SMTP_IDLE_TIMEOUT:
+        close_smtp()
+    if _smtp is None:
+        _smtp = get_connection()
+        _smtp.open()
+    _smtp_used_at = time.monotonic()
+    return _smtp
+
+
+def close_smtp():
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.close()
+        except Exception:
+            pass
+        _smtp = None
+
+
+def send_batch(messages):
+    """
+    Send `messages` over the worker's SMTP connection. Returns the messages
+    to try again: the one that hit a connection or server error and every
+    message after it. Messages whose recipients are refused are dropped.
+    """
+    for index, message in enumerate(messages):
+        email = build(message)
+        try:
+            smtp_connection().send_messages([email])
+        except smtplib.SMTPRecipientsRefused:
+            logger.error("Dropping mail %r: recipients %s refused", message['subject'], message['to'])
+        except (smtplib.SMTPException, OSError):
+            logger.warning("SMTP send failed", exc_info=True)
+            close_smtp()
+            return messages[index:]
+    return []
+
+
+def requeue(messages, client=None):
+    """
+    Put `messages` back on the outbox, dropping those out of attempts.
+    Returns how many were kept. `client` may be a pipeline to push with.
+    """
+    kept = []
+    for message in messages:
+        message['attempts'] += 1
+        if message['attempts'] >= settings.MAIL_MAX_ATTEMPTS:
+            logger.error("Dropping mail %r to %s after %d attempts",
+                         message['subject'], message['to'], message['attempts'])
+        else:
+            kept.append(json.dumps(message))
+    if kept:
+        (client or get_redis()).rpush(OUTBOX_KEY, *kept)
+    return len(kept)
+
+
+def processing_key():
+    return PROCESSING_KEY.format(f'{socket.gethostname()}:{os.getpid()}')
+
+
+def recover(client, processing):
+    """
+    Requeue the batches of workers that stopped mid-send: those not claimed
+    for MAIL_CLAIM_TIMEOUT seconds, and whatever `processing`, this worker's
+    own list, still holds. Each message counts as an attempt, so one that
+    kills the worker is eventually dropped. Returns how many were kept.
+    """
+    stale = client.zrangebyscore(CLAIMS_KEY, '-inf', time.time() - settings.MAIL_CLAIM_TIMEOUT)
+    kept = 0
+    for key in {processing, *stale}:
+        pipe = client.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        pipe.zrem(CLAIMS_KEY, key)
+        # Read and deleted in one transaction, so only one flush requeues a given batch.
+        batch = pipe.execute()[0]
+        if batch:
+            logger.warning("Requeueing %d unsent mails from %s", len(batch), key)
+            kept += requeue([json.loads(raw) for raw in batch])
+    return kept
+
+
+def claim(client, processing):
+    """Move up to MAIL_BATCH_SIZE messages from the outbox onto `processing`; returns them."""
+    client.zadd(CLAIMS_KEY, {processing: time.time()})
+    pipe = client.pipeline()
+    for _ in range(settings.MAIL_BATCH_SIZE):
+        pipe.lmove(OUTBOX_KEY, processing, 'LEFT', 'RIGHT')
+    return [raw for raw in pipe.execute() if raw is not None]
+
+
+def flush():
+    """Send everything in the outbox. Returns how many messages were put back to retry."""
+    client = get_redis()
+    processing = processing_key()
+    # Messages queued from now on schedule another flush.
+    client.delete(FLUSH_KEY)
+    recover(client, processing)
+    while True:
+        batch = claim(client, processing)
+        if not batch:
+            client.zrem(CLAIMS_KEY, processing)
+            return 0
+        failed = send_batch([json.loads(raw) for raw in batch])
+        # Acknowledge the batch and requeue what failed in one step.
+        pipe = client.pipeline()
+        pipe.delete(processing)
+        kept = requeue(failed, pipe)
+        pipe.execute()
+        if failed:
+            client.zrem(CLAIMS_KEY, processing)
+            return kept
@@ -0,0 +1,42 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from authen.provisioning import Provisioner, read_csv, read_json
+
+READERS = {'csv': read_csv, 'json': read_json}
+
+
+class Command(BaseCommand):
+    help = "Create users in bulk from a CSV or JSON file (an array or one object per line)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or - for stdin.")
+        parser.add_argument('--format', choices=sorted(READERS), help="Input format; defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Users checked and inserted per batch.")
+        parser.add_argument('--workers', type=int, default=None, help="Password hashing processes (default: CPU count).")
+        parser.add_argument('--dry-run', action='store_true', help="Check and hash, but insert nothing.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or path.rsplit('.', 1)[-1].lower().replace('jsonl', 'json')
+        if fmt not in READERS:
+            raise CommandError("Cannot tell the input format; pass --format csv or --format json.")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        provisioner = Provisioner(options['batch_size'], options['workers'], options['dry_run'])
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+        with stream:
+            report = provisioner.run(READERS[fmt](stream))
+
+        if options['verbosity'] >= 2:
+            for record, reason in provisioner.skipped:
+                self.stdout.write(f"  record {record}: {reason}")
+        self.stdout.write(
+            f"{'Would create' if report['dry_run'] else 'Created'} {report['created']} of {report['read']} users, "
+            f"skipped {report['skipped']}, in {report['elapsed_s']}s ({report['users_per_s']} users/s; "
+            f"check {report['check_s']}s, waiting on hashes {report['hash_wait_s']}s, insert {report['insert_s']}s, "
+            f"{report['workers']} workers)."
+        )
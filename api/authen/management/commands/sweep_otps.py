@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from authen.otp import sweep_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired OneTimePassword rows in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows deleted per statement.")
+
+    def handle(self, *args, **options):
+        deleted = sweep_expired(options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} expired one-time passwords.")
@@ -0,0 +1,19 @@
+# Generated by Django 4.0 on 2026-10-19 14:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authen', '0010_alter_user_date_of_birth'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='onetimepassword',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-19 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authen', '0012_alter_user_last_login'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='onetimepassword',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
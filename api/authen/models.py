@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.utils.translation import gettext_lazy as _ 
@@ -49,7 +50,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_verified = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
     date_joined = models.DateTimeField(auto_now_add=True)
-    last_login = models.DateTimeField(auto_now=True)
+    # Written by authen.login.record_login, never by save()
+    last_login = models.DateTimeField(blank=True, null=True)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ['first_name', 'last_name']
@@ -82,7 +84,9 @@ class User(AbstractBaseUser, PermissionsMixin):
 class OneTimePassword(models.Model):
     user=models.OneToOneField(User, on_delete=models.CASCADE)
     code=models.CharField(max_length=6, unique=True)
-    created_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Failed guesses against this code; it is discarded at OTP_MAX_ATTEMPTS.
+    attempts = models.PositiveSmallIntegerField(default=0)
     def __str__(self) -> str:
         return f"{self.user.email}--passcode"
     
@@ -90,6 +94,6 @@ class OneTimePassword(models.Model):
         self.code = ''.join(random.choices(string.digits, k=6))
     
     def is_expired(self):
-        """Check if the OTP is expired (e.g., expires after 5 minutes)"""
-        return (self.created_at + timedelta(minutes=5)) < timezone.now()
+        """Check if the OTP is expired (after OTP_TTL seconds)"""
+        return (self.created_at + timedelta(seconds=settings.OTP_TTL)) < timezone.now()
     
@@ -0,0 +1,176 @@
+"""
+One-time passwords for account and email verification.
+
+The backend named by OTP_BACKEND keeps one live code per user. The default,
+``RedisOTPBackend``, stores it under a key that expires after OTP_TTL
+seconds and counts failed attempts: after OTP_MAX_ATTEMPTS wrong guesses
+the code is discarded. ``DatabaseOTPBackend`` keeps the OneTimePassword
+table instead, with the same attempt limit; its rows are swept once expired
+by ``sweep_expired``.
+
+Codes issued into the table before the switch to Redis still work: when
+Redis has no code for a user, a live row is moved into Redis (keeping its
+expiry) and checked there, attempt limit included.
+
+A user who used up or let expire their code asks for another one through
+``ResendOTPView``; ``resend_wait`` spaces those out per user.
+"""
+import secrets
+from datetime import timedelta
+import redis
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+from api.redis_client import get_redis
+from .models import OneTimePassword
+
+VALID = 'valid'
+INVALID = 'invalid'
+# No code for this user, or it expired
+MISSING = 'missing'
+# Too many wrong guesses; the code was discarded
+LOCKED = 'locked'
+
+
+def generate_code():
+    return f'{secrets.randbelow(10 ** 6):06d}'
+
+
+class RedisOTPBackend:
+    # Returns 'valid' and deletes the code when ARGV[1] matches it; otherwise
+    # counts the attempt and deletes the code at ARGV[2] failed attempts.
+    VERIFY = """
+    local code = redis.call('HGET', KEYS[1], 'code')
+    if not code then
+        return 'missing'
+    end
+    if code == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+        return 'valid'
+    end
+    if redis.call('HINCRBY', KEYS[1], 'attempts', 1) >= tonumber(ARGV[2]) then
+        redis.call('DEL', KEYS[1])
+        return 'locked'
+    end
+    return 'invalid'
+    """
+
+    def key(self, user):
+        return f'otp:{user.pk}'
+
+    def issue(self, user):
+        code = generate_code()
+        with get_redis().pipeline() as pipe:
+            pipe.delete(self.key(user))
+            pipe.hset(self.key(user), 'code', code)
+            pipe.expire(self.key(user), settings.OTP_TTL)
+            pipe.execute()
+        # An older code in the table must not be picked up once this one is used.
+        OneTimePassword.objects.filter(user=user).delete()
+        return code
+
+    def verify(self, user, code):
+        script = get_redis().register_script(self.VERIFY)
+        args = [str(code or ''), settings.OTP_MAX_ATTEMPTS]
+        result = script(keys=[self.key(user)], args=args)
+        if result == MISSING and self.adopt(user):
+            result = script(keys=[self.key(user)], args=args)
+        return result
+
+    def adopt(self, user):
+        """Move `user`'s live OneTimePassword row, if any, into Redis. Returns whether there was one."""
+        with transaction.atomic():
+            otp = OneTimePassword.objects.select_for_update().filter(user=user).first()
+            if otp is None:
+                return False
+            otp.delete()
+        remaining = (otp.created_at + timedelta(seconds=settings.OTP_TTL) - timezone.now()).total_seconds()
+        if remaining <= 0:
+            return False
+        with get_redis().pipeline() as pipe:
+            # Never replace a code issued meanwhile.
+            pipe.hsetnx(self.key(user), 'code', otp.code)
+            pipe.hsetnx(self.key(user), 'attempts', otp.attempts)
+            pipe.expire(self.key(user), max(1, int(remaining)), nx=True)
+            pipe.execute()
+        return True
+
+
+class DatabaseOTPBackend:
+    # OneTimePassword.code is unique across users; retry the rare collision.
+    ISSUE_TRIES = 5
+
+    def issue(self, user):
+        for attempt in range(self.ISSUE_TRIES):
+            code = generate_code()
+            try:
+                with transaction.atomic():
+                    replaced = OneTimePassword.objects.filter(user=user).update(
+                        code=code, created_at=timezone.now(), attempts=0)
+                    if not replaced:
+                        OneTimePassword.objects.create(user=user, code=code)
+                return code
+            except IntegrityError:
+                if attempt == self.ISSUE_TRIES - 1:
+                    raise
+
+    @transaction.atomic
+    def verify(self, user, code):
+        # Locked so concurrent guesses are all counted.
+        otp = OneTimePassword.objects.select_for_update().filter(user=user).first()
+        if otp is None:
+            return MISSING
+        if otp.is_expired():
+            otp.delete()
+            return MISSING
+        if constant_time_compare(otp.code, str(code or '')):
+            otp.delete()
+            return VALID
+        otp.attempts += 1
+        if otp.attempts >= settings.OTP_MAX_ATTEMPTS:
+            otp.delete()
+            return LOCKED
+        otp.save(update_fields=['attempts'])
+        return INVALID
+
+
+def get_backend():
+    return import_string(settings.OTP_BACKEND)()
+
+
+def issue(user):
+    """Create a new code for `user`, replacing any earlier one, and return it."""
+    return get_backend().issue(user)
+
+
+def verify(user, code):
+    """Check `code` for `user`: VALID (and consumed), INVALID, MISSING or LOCKED."""
+    return get_backend().verify(user, code)
+
+
+def resend_wait(user):
+    """
+    Seconds `user` must wait for another code, or 0 after starting a new
+    OTP_RESEND_INTERVAL window. Without Redis, resends are not limited.
+    """
+    key = f'otp:resend:{user.pk}'
+    try:
+        client = get_redis()
+        if client.set(key, 1, nx=True, ex=settings.OTP_RESEND_INTERVAL):
+            return 0
+        return max(1, client.ttl(key))
+    except redis.RedisError:
+        return 0
+
+
+def sweep_expired(batch_size=1000):
+    """Delete expired OneTimePassword rows, `batch_size` at a time. Returns how many were deleted."""
+    cutoff = timezone.now() - timedelta(seconds=settings.OTP_TTL)
+    deleted = 0
+    while True:
+        ids = list(OneTimePassword.objects.filter(created_at__lt=cutoff).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += OneTimePassword.objects.filter(pk__in=ids).delete()[0]
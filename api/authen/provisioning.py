@@ -0,0 +1,230 @@
+"""
+Bulk user provisioning, for migrating accounts from the SSO.
+
+Rows are streamed from CSV or JSON (an array or one object per line) and
+handled ``batch_size`` at a time. Each batch is checked field by field,
+then for duplicates within the file and against existing users with one
+``IN`` query per unique column. Passwords are hashed across a process pool
+while the previous batch is inserted with ``bulk_create``.
+
+A row may carry a plain ``password`` or an already hashed ``password_hash``,
+which must be in a format one of PASSWORD_HASHERS can check. Rows with
+neither get an unusable password (SSO-only accounts).
+
+Skipped rows are reported by record number: the position of the user in
+the input, starting at 1, whatever the format's header or layout.
+"""
+import csv
+import datetime
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from . import login
+from .models import User
+
+UNIQUE_FIELDS = ('email', 'resident_id', 'staff_id')
+REQUIRED_FIELDS = ('email', 'first_name', 'last_name')
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+def read_csv(stream):
+    yield from csv.DictReader(stream)
+
+
+def read_json(stream, chunk_size=1 << 16):
+    """Objects from a JSON array or from JSON Lines, decoded as the stream is read."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        # Skip what separates objects: whitespace, commas and the array brackets.
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                return
+            buffer, position = stream.read(chunk_size), 0
+            eof = not buffer
+            continue
+        try:
+            row, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = stream.read(chunk_size)
+            eof = not more
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield row
+        position = end
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def clean(row):
+    """User field values for `row`, or raise ValueError naming what is wrong."""
+    values = {name: (row.get(name) or '').strip() for name in REQUIRED_FIELDS}
+    missing = [name for name, value in values.items() if not value]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    values['email'] = User.objects.normalize_email(values['email'])
+    try:
+        validate_email(values['email'])
+    except ValidationError:
+        raise ValueError("invalid email")
+    # Empty ids are stored as NULL, which the unique constraints allow more than once.
+    for name in ('resident_id', 'staff_id'):
+        values[name] = str(row.get(name) or '').strip() or None
+        if values[name] and len(values[name]) > 10:
+            raise ValueError(f"{name} longer than 10 characters")
+    values['role'] = str(row.get('role') or '').strip()
+    if row.get('date_of_birth'):
+        try:
+            values['date_of_birth'] = datetime.date.fromisoformat(str(row['date_of_birth']).strip())
+        except ValueError:
+            raise ValueError("invalid date_of_birth")
+    for name in ('is_active', 'is_verified'):
+        if row.get(name) not in (None, ''):
+            values[name] = str(row[name]).strip().lower() in TRUE_VALUES
+    if row.get('password_hash'):
+        try:
+            # decode() also rejects hashes of a known algorithm that are cut short or mangled.
+            identify_hasher(row['password_hash']).decode(row['password_hash'])
+        except (ValueError, TypeError, IndexError):
+            raise ValueError("unsupported or malformed password_hash")
+    return values
+
+
+class Provisioner:
+    def __init__(self, batch_size=1000, workers=None, dry_run=False):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        self.dry_run = dry_run
+        self.seen = {name: set() for name in UNIQUE_FIELDS}
+        self.stats = Counter()
+        self.skipped = []
+        self.timings = Counter()
+
+    def skip(self, record, reason):
+        self.stats['skipped'] += 1
+        self.skipped.append((record, reason))
+
+    def check(self, batch, first_record):
+        """(record, values, password, already hashed) for the rows of `batch` that can be created."""
+        accepted = []
+        for record, row in enumerate(batch, first_record):
+            try:
+                values = clean(row)
+            except ValueError as e:
+                self.skip(record, str(e))
+                continue
+            duplicate = next((name for name in UNIQUE_FIELDS
+                              if values[name] is not None and values[name] in self.seen[name]), None)
+            if duplicate:
+                self.skip(record, f"duplicate {duplicate} in input")
+                continue
+            for name in UNIQUE_FIELDS:
+                if values[name] is not None:
+                    self.seen[name].add(values[name])
+            accepted.append((record, values, row.get('password_hash') or row.get('password') or None,
+                             bool(row.get('password_hash'))))
+
+        taken = {}
+        for name in UNIQUE_FIELDS:
+            wanted = {values[name] for _, values, _, _ in accepted if values[name] is not None}
+            taken[name] = set(User.objects.filter(**{f'{name}__in': wanted}).values_list(name, flat=True)) \
+                if wanted else set()
+        rows = []
+        for record, values, password, hashed in accepted:
+            existing = next((name for name in UNIQUE_FIELDS if values[name] in taken[name]), None)
+            if existing:
+                self.skip(record, f"{existing} already registered")
+            else:
+                rows.append((record, values, password, hashed))
+        return rows
+
+    def insert(self, rows, passwords):
+        users = []
+        for (record, values, _, _), password in zip(rows, passwords):
+            user = User(**values)
+            user.password = password
+            users.append((record, user))
+        if self.dry_run:
+            self.stats['created'] += len(users)
+            return
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                User.objects.bulk_create([user for _, user in users], batch_size=self.batch_size)
+            self.stats['created'] += len(users)
+            # bulk_create sends no post_save, which would clear these from the login cache.
+            login.forget_unknown([user.email for _, user in users])
+        except IntegrityError:
+            # Someone registered one of these since the check; find out who, row by row.
+            for record, user in users:
+                try:
+                    with transaction.atomic():
+                        user.save(force_insert=True)
+                    self.stats['created'] += 1
+                except IntegrityError as e:
+                    self.skip(record, f"conflict: {e}")
+        self.timings['insert'] += time.perf_counter() - started
+
+    def run(self, rows):
+        """Create users from `rows`; returns a report with counts, timings and throughput."""
+        started = time.perf_counter()
+        # Forked workers inherit Django's setup; spawned ones need their own.
+        with ProcessPoolExecutor(self.workers, initializer=django.setup) as pool:
+            pending = None
+            record = 1
+            for batch in batches(rows, self.batch_size):
+                self.stats['read'] += len(batch)
+                check_started = time.perf_counter()
+                checked = self.check(batch, record)
+                self.timings['check'] += time.perf_counter() - check_started
+                record += len(batch)
+                # Hashing this batch runs in the pool while the previous one is inserted.
+                to_hash = [password if not hashed else None for _, _, password, hashed in checked]
+                hashing = pool.map(make_password, to_hash, chunksize=max(1, len(to_hash) // (self.workers * 4)))
+                if pending is not None:
+                    self.insert(*pending)
+                hash_started = time.perf_counter()
+                passwords = [
+                    password if hashed else made
+                    for (_, _, password, hashed), made in zip(checked, hashing)
+                ]
+                self.timings['hash_wait'] += time.perf_counter() - hash_started
+                pending = (checked, passwords)
+            if pending is not None:
+                self.insert(*pending)
+
+        elapsed = time.perf_counter() - started
+        return {
+            'read': self.stats['read'],
+            'created': self.stats['created'],
+            'skipped': self.stats['skipped'],
+            'elapsed_s': round(elapsed, 2),
+            'users_per_s': round(self.stats['created'] / elapsed, 1) if elapsed else 0.0,
+            'check_s': round(self.timings['check'], 2),
+            'hash_wait_s': round(self.timings['hash_wait'], 2),
+            'insert_s': round(self.timings['insert'], 2),
+            'workers': self.workers,
+            'dry_run': self.dry_run,
+        }
@@ -0,0 +1,157 @@
+"""
+Refresh-token revocation.
+
+Revoking a token stores ``revoked:<jti>`` in Redis until the token would
+have expired anyway, and appends the jti to the ``revoked:log`` stream.
+Each process mirrors the log in a Bloom filter: it pulls new entries at
+most every TOKEN_REVOCATION_SYNC_INTERVAL seconds and rebuilds the filter
+every TOKEN_REVOCATION_REBUILD_INTERVAL seconds, dropping tokens that have
+since expired. A token missing from the filter is accepted without a
+network call. Only filter hits (revoked tokens and the odd false
+positive) are confirmed against Redis.
+
+A token revoked by another process can still be used here until the next
+sync. If Redis cannot confirm a filter hit, or the filter cannot be built
+at all, the token is refused.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+import redis
+from django.conf import settings
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LOG_KEY = 'revoked:log'
+# Stream entries read per XRANGE call
+PAGE_SIZE = 1000
+
+
+def revoked_key(jti):
+    return f'revoked:{jti}'
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about `error_rate` false positives at `capacity` items."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class RevocationFilter:
+    def __init__(self):
+        self.bloom = None
+        self.cursor = None
+        self.built_at = 0.0
+        self.synced_at = 0.0
+        self.lock = threading.Lock()
+
+    def read_log(self, start):
+        """(last id, jtis) for the log entries after `start` ('-' for all)."""
+        client = get_redis()
+        jtis = []
+        cursor = start
+        while True:
+            entries = client.xrange(LOG_KEY, min=cursor if cursor == '-' else f'({cursor}', count=PAGE_SIZE)
+            for entry_id, fields in entries:
+                jtis.append(fields['jti'])
+                cursor = entry_id
+            if len(entries) < PAGE_SIZE:
+                return cursor, jtis
+
+    def rebuild(self, now):
+        cursor, jtis = self.read_log('-')
+        bloom = BloomFilter(max(settings.TOKEN_REVOCATION_FILTER_CAPACITY, 2 * len(jtis)),
+                            settings.TOKEN_REVOCATION_FILTER_ERROR_RATE)
+        for jti in jtis:
+            bloom.add(jti)
+        self.bloom, self.cursor = bloom, cursor
+        self.built_at = self.synced_at = now
+
+    def catch_up(self, now):
+        self.cursor, jtis = self.read_log(self.cursor)
+        for jti in jtis:
+            self.bloom.add(jti)
+        self.synced_at = now
+
+    def current(self):
+        """The Bloom filter, brought up to date with the log when a sync is due."""
+        now = time.monotonic()
+        if self.bloom is not None and now - self.synced_at < settings.TOKEN_REVOCATION_SYNC_INTERVAL:
+            return self.bloom
+        with self.lock:
+            try:
+                if self.bloom is None or now - self.built_at >= settings.TOKEN_REVOCATION_REBUILD_INTERVAL:
+                    self.rebuild(now)
+                elif now - self.synced_at >= settings.TOKEN_REVOCATION_SYNC_INTERVAL:
+                    self.catch_up(now)
+            except redis.RedisError:
+                if self.bloom is None:
+                    raise
+                # Keep serving the last filter and try again after the next interval.
+                logger.warning("Could not sync revoked tokens", exc_info=True)
+                self.synced_at = now
+        return self.bloom
+
+    def add(self, jti):
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+
+
+_filter = RevocationFilter()
+
+
+def revoke(token):
+    """Revoke `token` (a RefreshToken) for the rest of its lifetime."""
+    jti = token.payload[api_settings.JTI_CLAIM]
+    ttl = int(token.payload['exp'] - time.time())
+    if ttl <= 0:
+        return
+    # Tokens revoked longer ago than a refresh token lives have expired.
+    oldest = int((time.time() - api_settings.REFRESH_TOKEN_LIFETIME.total_seconds()) * 1000)
+    with get_redis().pipeline() as pipe:
+        pipe.set(revoked_key(jti), 1, ex=ttl)
+        pipe.xadd(LOG_KEY, {'jti': jti}, minid=oldest, approximate=True)
+        pipe.execute()
+    _filter.add(jti)
+
+
+def is_revoked(jti):
+    try:
+        if jti not in _filter.current():
+            return False
+        return bool(get_redis().exists(revoked_key(jti)))
+    except redis.RedisError:
+        logger.warning("Could not check token revocation; refusing the token", exc_info=True)
+        return True
+
+
+class RevocableRefreshToken(RefreshToken):
+    def verify(self):
+        super().verify()
+        if is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError("Token is revoked")
+
+    def revoke(self):
+        revoke(self)
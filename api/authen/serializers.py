@@ -2,7 +2,10 @@ from rest_framework import serializers
 from .models import User
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from rest_framework_simplejwt.tokens import RefreshToken
+from .revocation import RevocableRefreshToken
+from . import login
 from rest_framework.exceptions import AuthenticationFailed
 
 class UserRegisterSerializer(serializers.ModelSerializer):
@@ -41,17 +44,15 @@ class LoginSerializer(serializers.Serializer):
         email = attrs.get('email')
         password = attrs.get('password')
 
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            raise AuthenticationFailed('Invalid credentials')
-
-        if not user.check_password(password):
+        user = login.authenticate(email, password)
+        if user is None:
             raise AuthenticationFailed('Invalid credentials')
 
         if not user.is_active:
             raise AuthenticationFailed('User is inactive')
 
+        login.record_login(user)
+
         # Generate JWT tokens for the user
         refresh = RefreshToken.for_user(user)
         access_token = refresh.access_token
@@ -87,3 +88,6 @@ class EmailVerificationSerializer(serializers.Serializer):
         return data
 
 
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refuse refresh tokens revoked by logout."""
+    token_class = RevocableRefreshToken
@@ -0,0 +1,20 @@
+from celery import shared_task
+from django.conf import settings
+from . import login, mail, otp
+
+
+@shared_task(bind=True, max_retries=settings.MAIL_MAX_ATTEMPTS)
+def flush_outbox(self):
+    if mail.flush():
+        # SMTP failed; back off before trying the requeued messages again.
+        raise self.retry(countdown=settings.MAIL_RETRY_DELAY * 2 ** self.request.retries)
+
+
+@shared_task
+def sweep_expired_otps():
+    return otp.sweep_expired()
+
+
+@shared_task
+def flush_last_logins():
+    return login.flush_last_logins()
@@ -1,3 +1,338 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import smtplib
+import time
+from unittest import mock
+import fakeredis
+from django.contrib.auth.hashers import make_password
+from django.core import mail as outbox
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import TokenError
+from perf.fakes import LOCAL_BACKENDS
+from . import login, mail, otp, provisioning, revocation
+from .models import OneTimePassword, User
 
-# Create your tests here.
+PASSWORD = 'Secret-passw0rd'
+
+
+def create_user(n, **kwargs):
+    return User.objects.create_user(email=f'user{n}@ezmail.com', first_name='Test', last_name=f'User {n}',
+                                    password=PASSWORD, resident_id=f'R{n}', staff_id=f'S{n}', **kwargs)
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'LOGIN_QUEUE': True})
+class LastLoginTestCase(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.object(login, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = create_user(1)
+
+    def test_flushed_login_survives_later_saves(self):
+        self.assertIsNone(self.user.last_login)
+        login.record_login(self.user)
+        self.assertEqual(login.flush_last_logins(), 1)
+        flushed = User.objects.get(pk=self.user.pk).last_login
+        self.assertIsNotNone(flushed)
+
+        user = User.objects.get(pk=self.user.pk)
+        user.is_verified = True
+        with mock.patch('django.utils.timezone.now', return_value=flushed + datetime.timedelta(days=1)):
+            user.save()
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_login, flushed)
+
+
+def user_row(n, **kwargs):
+    return {'email': f'import{n}@ezmail.com', 'first_name': 'Imported', 'last_name': f'User {n}',
+            'resident_id': f'IR{n}', 'staff_id': f'IS{n}', **kwargs}
+
+
+class ReadJSONTestCase(TestCase):
+    def test_array_and_json_lines(self):
+        rows = [user_row(1), user_row(2, last_name='Brace } and, comma')]
+        self.assertEqual(list(provisioning.read_json(io.StringIO(json.dumps(rows)))), rows)
+        lines = '\n'.join(json.dumps(row) for row in rows) + '\n'
+        self.assertEqual(list(provisioning.read_json(io.StringIO(lines))), rows)
+
+    def test_objects_split_across_chunks(self):
+        rows = [user_row(n) for n in range(20)]
+        for chunk_size in (1, 7, 64):
+            self.assertEqual(list(provisioning.read_json(io.StringIO(json.dumps(rows, indent=2)), chunk_size)), rows)
+
+    def test_truncated_input_raises(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(provisioning.read_json(io.StringIO('[{"email": "a@ezmail.com"'), 8))
+
+
+@override_settings(**LOCAL_BACKENDS)
+class ProvisionerTestCase(TestCase):
+    def test_duplicates_in_input_and_registered_users_are_skipped(self):
+        create_user(1)
+        rows = [user_row(1), user_row(2, email='import1@EZMAIL.com'), user_row(3, resident_id='IR1'),
+                user_row(4, email='user1@ezmail.com'), user_row(5, staff_id='S1'), user_row(6)]
+        provisioner = provisioning.Provisioner(batch_size=4, workers=1)
+        report = provisioner.run(rows)
+        self.assertEqual((report['read'], report['created'], report['skipped']), (6, 2, 4))
+        self.assertEqual(dict(provisioner.skipped), {
+            2: "duplicate email in input",
+            3: "duplicate resident_id in input",
+            4: "email already registered",
+            5: "staff_id already registered",
+        })
+        self.assertTrue(User.objects.filter(email='import6@ezmail.com').exists())
+
+    def test_conflict_after_check_skips_only_that_row(self):
+        provisioner = provisioning.Provisioner(workers=1)
+        checked = provisioner.check([user_row(1), user_row(2, email='user2@ezmail.com')], 1)
+        # Registered between the check and the insert.
+        create_user(2)
+        provisioner.insert(checked, [make_password(None)] * 2)
+        self.assertEqual(provisioner.stats['created'], 1)
+        self.assertEqual([record for record, _ in provisioner.skipped], [2])
+        self.assertTrue(provisioner.skipped[0][1].startswith("conflict: "))
+        self.assertTrue(User.objects.filter(email='import1@ezmail.com').exists())
+
+    def test_password_hashes_must_be_checkable(self):
+        good = make_password(PASSWORD)
+        rows = [user_row(1, password_hash=good), user_row(2, password_hash='md5crypt$xyz'),
+                user_row(3, password_hash=good.rsplit('$', 2)[0]), user_row(4, password=PASSWORD)]
+        provisioner = provisioning.Provisioner(workers=1)
+        provisioner.run(rows)
+        self.assertEqual(dict(provisioner.skipped), {
+            2: "unsupported or malformed password_hash",
+            3: "unsupported or malformed password_hash",
+        })
+        self.assertTrue(User.objects.get(email='import1@ezmail.com').check_password(PASSWORD))
+        self.assertTrue(User.objects.get(email='import4@ezmail.com').check_password(PASSWORD))
+
+
+def message(n, attempts=0):
+    return {'subject': f'Mail {n}', 'body': 'Body', 'from_email': 'no-reply@ezmail.com',
+            'to': [f'user{n}@ezmail.com'], 'attempts': attempts}
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'MAIL_QUEUE': True, 'MAIL_BATCH_SIZE': 2, 'MAIL_MAX_ATTEMPTS': 3})
+class MailOutboxTestCase(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.object(mail, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(mail.close_smtp)
+
+    def queued(self):
+        return [json.loads(raw) for raw in self.redis.lrange(mail.OUTBOX_KEY, 0, -1)]
+
+    def test_send_batch_stops_at_a_failure_and_drops_refused_recipients(self):
+        connection = mock.Mock()
+        connection.send_messages.side_effect = [
+            1, smtplib.SMTPRecipientsRefused({}), smtplib.SMTPServerDisconnected(), 1]
+        messages = [message(n) for n in range(4)]
+        with mock.patch.object(mail, 'get_connection', return_value=connection):
+            self.assertEqual(mail.send_batch(messages), messages[2:])
+        connection.close.assert_called_once()
+
+    def test_requeue_counts_attempts_and_drops_the_exhausted(self):
+        self.assertEqual(mail.requeue([message(1), message(2, attempts=2)]), 1)
+        self.assertEqual(self.queued(), [message(1, attempts=1)])
+
+    def test_flush_sends_in_batches_and_acknowledges(self):
+        self.redis.rpush(mail.OUTBOX_KEY, *[json.dumps(message(n)) for n in range(5)])
+        self.assertEqual(mail.flush(), 0)
+        self.assertEqual([email.subject for email in outbox.outbox], [f'Mail {n}' for n in range(5)])
+        self.assertEqual(self.redis.keys('mail:*'), [])
+
+    def test_batch_of_a_crashed_flush_is_not_lost(self):
+        self.redis.rpush(mail.OUTBOX_KEY, *[json.dumps(message(n)) for n in range(3)])
+        with mock.patch.object(mail, 'send_batch', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                mail.flush()
+        self.assertEqual(self.redis.llen(mail.processing_key()), 2)
+        # The next flush in this process picks up its own unfinished batch first.
+        self.assertEqual(mail.flush(), 0)
+        self.assertEqual(sorted(email.subject for email in outbox.outbox), [f'Mail {n}' for n in range(3)])
+
+    def test_stale_batches_of_other_workers_are_requeued(self):
+        other = mail.PROCESSING_KEY.format('other-host:1')
+        live = mail.PROCESSING_KEY.format('other-host:2')
+        self.redis.rpush(other, json.dumps(message(1)))
+        self.redis.rpush(live, json.dumps(message(2)))
+        self.redis.zadd(mail.CLAIMS_KEY, {other: 0, live: mail.time.time()})
+        self.assertEqual(mail.flush(), 0)
+        self.assertEqual([email.subject for email in outbox.outbox], ['Mail 1'])
+        self.assertEqual(self.redis.llen(live), 1)
+
+
+class BloomFilterTestCase(TestCase):
+    def test_no_false_negatives_and_few_false_positives(self):
+        bloom = revocation.BloomFilter(1000, 0.01)
+        added = [f'jti-{n}' for n in range(1000)]
+        for jti in added:
+            bloom.add(jti)
+        self.assertTrue(all(jti in bloom for jti in added))
+        false_positives = sum(f'other-{n}' in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'TOKEN_REVOCATION_SYNC_INTERVAL': 0})
+class RevocationTestCase(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        for patcher in (mock.patch.object(revocation, 'get_redis', return_value=self.redis),
+                        mock.patch.object(revocation, '_filter', revocation.RevocationFilter())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = create_user(1, is_active=True)
+
+    def test_verify_rejects_a_revoked_jti(self):
+        token = revocation.RevocableRefreshToken.for_user(self.user)
+        other = revocation.RevocableRefreshToken.for_user(self.user)
+        token.revoke()
+        with self.assertRaisesMessage(TokenError, "Token is revoked"):
+            revocation.RevocableRefreshToken(str(token))
+        revocation.RevocableRefreshToken(str(other))
+
+    def test_revocation_by_another_process_is_seen_after_a_sync(self):
+        token = revocation.RevocableRefreshToken.for_user(self.user)
+        revocation.RevocableRefreshToken(str(token))
+        with mock.patch.object(revocation, '_filter', revocation.RevocationFilter()):
+            revocation.revoke(token)
+        with self.assertRaises(TokenError):
+            revocation.RevocableRefreshToken(str(token))
+
+    def test_unconfirmed_filter_hit_is_refused(self):
+        token = revocation.RevocableRefreshToken.for_user(self.user)
+        token.revoke()
+        with mock.patch.object(self.redis, 'exists', side_effect=revocation.redis.ConnectionError):
+            with self.assertRaises(TokenError):
+                revocation.RevocableRefreshToken(str(token))
+
+    def test_logout_revokes_the_refresh_token(self):
+        token = revocation.RevocableRefreshToken.for_user(self.user)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post('/api/v1/authen/accounts/logout/', {'refresh': str(token)}, format='json')
+        self.assertEqual(response.status_code, 205)
+        response = APIClient().post('/api/v1/authen/token/refresh/', {'refresh': str(token)}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'OTP_BACKEND': 'authen.otp.RedisOTPBackend', 'OTP_MAX_ATTEMPTS': 3})
+class OTPTestCase(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.object(otp, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = create_user(1, is_active=False)
+        self.client = APIClient()
+
+    def wrong(self, code):
+        return f'{(int(code) + 1) % 10 ** 6:06d}'
+
+    def test_code_expires(self):
+        code = otp.issue(self.user)
+        self.assertTrue(0 < self.redis.ttl(f'otp:{self.user.pk}') <= 300)
+        self.redis.pexpire(f'otp:{self.user.pk}', 1)
+        time.sleep(0.01)
+        self.assertEqual(otp.verify(self.user, code), otp.MISSING)
+
+    def test_code_is_discarded_after_too_many_misses(self):
+        code = otp.issue(self.user)
+        self.assertEqual(otp.verify(self.user, self.wrong(code)), otp.INVALID)
+        self.assertEqual(otp.verify(self.user, self.wrong(code)), otp.INVALID)
+        self.assertEqual(otp.verify(self.user, self.wrong(code)), otp.LOCKED)
+        self.assertEqual(otp.verify(self.user, code), otp.MISSING)
+
+    def test_live_database_code_is_moved_to_redis(self):
+        OneTimePassword.objects.create(user=self.user, code='123456')
+        self.assertEqual(otp.verify(self.user, '654321'), otp.INVALID)
+        self.assertFalse(OneTimePassword.objects.filter(user=self.user).exists())
+        # Misses on an adopted code count towards the limit like any other.
+        self.assertEqual(self.redis.hget(f'otp:{self.user.pk}', 'attempts'), '1')
+        self.assertEqual(otp.verify(self.user, '123456'), otp.VALID)
+
+    def test_expired_database_code_is_not_moved(self):
+        OneTimePassword.objects.create(user=self.user, code='123456',
+                                       created_at=timezone.now() - datetime.timedelta(seconds=301))
+        self.assertEqual(otp.verify(self.user, '123456'), otp.MISSING)
+        self.assertFalse(OneTimePassword.objects.filter(user=self.user).exists())
+
+    def test_new_code_replaces_a_database_code(self):
+        OneTimePassword.objects.create(user=self.user, code='123456')
+        code = otp.issue(self.user)
+        self.assertFalse(OneTimePassword.objects.filter(user=self.user).exists())
+        self.assertEqual(otp.verify(self.user, code), otp.VALID)
+        self.assertEqual(otp.verify(self.user, '123456'), otp.MISSING)
+
+    def resend(self, email='user1@ezmail.com'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/v1/authen/verification/otp/resend/', {'email': email}, format='json')
+
+    def verify(self, code):
+        return self.client.post('/api/v1/authen/verification/otp/', {'email': 'user1@ezmail.com', 'otp': code},
+                                format='json')
+
+    def test_locked_out_user_can_resend_and_activate(self):
+        code = otp.issue(self.user)
+        for _ in range(3):
+            response = self.verify(self.wrong(code))
+        self.assertEqual(response.status_code, 429)
+
+        response = self.resend()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(outbox.outbox), 1)
+        new_code = outbox.outbox[0].body.rsplit(' ', 1)[1]
+        self.assertEqual(self.verify(new_code).status_code, 200)
+        self.assertTrue(User.objects.get(pk=self.user.pk).is_active)
+
+    def test_resend_is_limited_per_user(self):
+        self.assertEqual(self.resend().status_code, 202)
+        response = self.resend()
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response['Retry-After']) <= 60)
+        self.assertEqual(len(outbox.outbox), 1)
+
+    def test_resend_needs_a_pending_account(self):
+        self.assertEqual(self.resend('nobody@ezmail.com').status_code, 404)
+        create_user(2, is_active=True)
+        self.assertEqual(self.resend('user2@ezmail.com').status_code, 400)
+        self.assertEqual(outbox.outbox, [])
+
+    def test_redis_outage_answers_503(self):
+        with mock.patch.object(self.redis, 'pipeline', side_effect=otp.redis.ConnectionError), \
+                mock.patch.object(self.redis, 'register_script', side_effect=otp.redis.ConnectionError):
+            self.assertEqual(self.verify('123456').status_code, 503)
+            response = self.client.post('/api/v1/authen/register/', {
+                'email': 'user2@ezmail.com', 'first_name': 'Test', 'last_name': 'User 2',
+                'date_of_birth': '2000-01-01', 'resident_id': 'R2', 'staff_id': 'S2', 'role': 'member',
+                'password': PASSWORD, 'password2': PASSWORD,
+            }, format='json')
+        self.assertEqual(response.status_code, 503)
+        # The account is rolled back along with the code, so registering again works.
+        self.assertFalse(User.objects.filter(email='user2@ezmail.com').exists())
+
+
+@override_settings(**{**LOCAL_BACKENDS, 'OTP_BACKEND': 'authen.otp.DatabaseOTPBackend', 'OTP_MAX_ATTEMPTS': 3})
+class DatabaseOTPTestCase(TestCase):
+    def setUp(self):
+        self.user = create_user(1, is_active=False)
+
+    def test_code_is_discarded_after_too_many_misses(self):
+        code = otp.issue(self.user)
+        wrong = f'{(int(code) + 1) % 10 ** 6:06d}'
+        self.assertEqual(otp.verify(self.user, wrong), otp.INVALID)
+        self.assertEqual(otp.verify(self.user, wrong), otp.INVALID)
+        self.assertEqual(otp.verify(self.user, wrong), otp.LOCKED)
+        self.assertEqual(otp.verify(self.user, code), otp.MISSING)
+
+    def test_new_code_resets_the_attempts(self):
+        code = otp.issue(self.user)
+        otp.verify(self.user, f'{(int(code) + 1) % 10 ** 6:06d}')
+        code = otp.issue(self.user)
+        self.assertEqual(OneTimePassword.objects.get(user=self.user).attempts, 0)
+        self.assertEqual(otp.verify(self.user, code), otp.VALID)
@@ -2,14 +2,16 @@ from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, AllowAny
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.response import Response
-from .models import User, OneTimePassword
+from .models import User
+from . import otp, revocation
 from rest_framework.views import APIView
 from .serializers import UserRegisterSerializer, UserUpdateSerializer, PasswordVerificationSerializer, EmailVerificationSerializer, LoginSerializer
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.core.mail import send_mail
-from django.utils.crypto import get_random_string
+from .mail import queue_mail
 from django.contrib.auth import get_user_model, authenticate
-from django.conf import settings
+from django.db import transaction
+import redis
 
 class UserRegisterView(generics.CreateAPIView):
     permission_classes=[AllowAny]
@@ -17,16 +19,17 @@ class UserRegisterView(generics.CreateAPIView):
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid(raise_exception=True):
-            user = serializer.save(is_active=False)
-            
-            otp_code = get_random_string(length=6, allowed_chars='0123456789')
-            OneTimePassword.objects.create(user=user, code=otp_code)
+            try:
+                with transaction.atomic():
+                    user = serializer.save(is_active=False)
+                    otp_code = otp.issue(user)
+            except redis.RedisError:
+                return Response({"detail": "Could not send an OTP, please try again"}, status=503)
 
-            send_mail(
+            queue_mail(
                 'Account Verification OTP',
-                f'Your OTP code to EZGROUP is: {otp_code}',
-                settings.DEFAULT_FROM_EMAIL, 
-                [user.email]
+                [user.email],
+                body=f'Your OTP code to EZGROUP is: {otp_code}',
             )
             refresh = RefreshToken.for_user(user)
             access_token = str(refresh.access_token)
@@ -48,14 +51,20 @@ class VerifyOTPView(APIView):
         user = User.objects.filter(email=email).first()
         if not user:
             return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
-        otp_entry = OneTimePassword.objects.filter(user=user).last()
-        if otp_entry is None:
-            return Response({"detail": "No OTP found for this user."}, status=status.HTTP_400_BAD_REQUEST)
-        if otp_code != otp_entry.code:
+        try:
+            result = otp.verify(user, otp_code)
+        except redis.RedisError:
+            return Response({"detail": "Could not check the OTP, please try again"}, status=503)
+        if result == otp.MISSING:
+            return Response({"detail": "No OTP found for this user. Please request a new OTP."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if result == otp.LOCKED:
+            return Response({"detail": "Too many invalid attempts. Please request a new OTP."},
+                            status=status.HTTP_429_TOO_MANY_REQUESTS)
+        if result != otp.VALID:
             return Response({"detail": "Invalid OTP."}, status=status.HTTP_400_BAD_REQUEST)
         user.is_active = True
         user.save()
-        otp_entry.delete()
 
         refresh = RefreshToken.for_user(user)
         access_token = str(refresh.access_token)
@@ -68,6 +77,33 @@ class VerifyOTPView(APIView):
             "accept": True,
         }, status=status.HTTP_200_OK)
 
+class ResendOTPView(APIView):
+    permission_classes=[AllowAny]
+    def post(self, request, *args, **kwargs):
+        User = get_user_model()
+        user = User.objects.filter(email=request.data.get('email')).first()
+        if not user:
+            return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+        if user.is_active:
+            return Response({"detail": "Account is already activated."}, status=status.HTTP_400_BAD_REQUEST)
+        wait = otp.resend_wait(user)
+        if wait:
+            response = Response({"detail": "An OTP was sent recently. Please wait before requesting another."},
+                                status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = str(wait)
+            return response
+        try:
+            otp_code = otp.issue(user)
+        except redis.RedisError:
+            return Response({"detail": "Could not send an OTP, please try again"}, status=503)
+
+        queue_mail(
+            'Account Verification OTP',
+            [user.email],
+            body=f'Your OTP code to EZGROUP is: {otp_code}',
+        )
+        return Response({"detail": "A new OTP has been sent to your email."}, status=status.HTTP_202_ACCEPTED)
+
 class VerifyEmailView(APIView):
     permission_classes=[IsAuthenticated]
     def post(self, request, *args, **kwargs):
@@ -82,20 +118,20 @@ class VerifyEmailView(APIView):
             if not user_authenticated:
                 return Response({"detail": "Current password is incorrect."}, status=400)
 
-            otp_code = get_random_string(length=6, allowed_chars='0123456789')
-    
-            otp = OneTimePassword.objects.create(user=user, code=otp_code)
-
-            send_mail(
-                subject="Your OTP Code for Email Verification",
-                message=f"Your OTP code is {otp_code}",
+            try:
+                otp_code = otp.issue(user)
+            except redis.RedisError:
+                return Response({"detail": "Could not send an OTP, please try again"}, status=503)
+
+            queue_mail(
+                "Your OTP Code for Email Verification",
+                [new_email],
+                body=f"Your OTP code is {otp_code}",
                 from_email="no-reply@yourdomain.com",
-                recipient_list=[new_email],  
             )
 
             return Response({
                 "detail": "OTP sent to your new email address. Please verify.",
-                "otp_id": otp.id 
             }, status=202)
         else:
             return Response(serializer.errors, status=400)
@@ -125,7 +161,7 @@ class UserUpdateView(generics.RetrieveUpdateAPIView):
     
     def put(self, request, *args, **kwargs):
         serializer = self.get_serializer(instance=self.get_object(), data=request.data, partial=True)
-        if serializer.is_valid(raise_exeption=True):
+        if serializer.is_valid(raise_exception=True):
             serializer.save()
             return Response({"message": "User details updated successfully"}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -149,11 +185,12 @@ class LogoutView(APIView):
         refresh_token = request.data.get('refresh')
         if refresh_token:
             try:
-                token = RefreshToken(refresh_token)
-                token.blacklist()
+                revocation.revoke(RefreshToken(refresh_token))
                 return Response({"detail": "Successfully logged out"}, status=205)
-            except Exception as e:
+            except TokenError:
                 return Response({"detail": "Invalid refresh token"}, status=400)
+            except redis.RedisError:
+                return Response({"detail": "Could not log out, please try again"}, status=503)
         return Response({"detail": "No refresh token provided"}, status=400)
     
 class ProtectedView(APIView):
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 class BlogConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blog'
+
+    def ready(self):
+        # Connect the signals that keep cached posts and trending scores
+        # current, in every process that writes posts, likes or comments
+        from . import post_cache, trending  # noqa: F401
@@ -0,0 +1,311 @@
+"""
+Native async versions of the I/O-bound blog endpoints, served when
+``settings.ASYNC_VIEWS`` is on and the app runs under ASGI.
+
+Each view keeps the request/response contract of its counterpart in
+``blog.views``. Outbound HTTP (newsletter) is awaited on the event loop and
+S3 uploads run on a worker thread, so neither holds the thread that Django
+uses for ORM work. All queries of a request are grouped into a single
+``sync_to_async`` hop rather than one thread switch per query.
+"""
+import json
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import JsonResponse, QueryDict
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from . import media, post_cache, views
+from .broadcast import broadcast_comment, count_changed
+from .clients import DEFAULT_POST_IMAGE, ServiceError, apublish_to_newsletter
+from .models import Image, Like, Comment
+from .serializers import PostSerializer, ImageSerializer, LikeSerializer, CommentSerializer
+
+
+class AsyncAPIView:
+    http_method_names = ['get', 'post', 'put', 'patch', 'delete']
+    # Sync APIView documented by Swagger in place of this view
+    schema_view = None
+
+    @classmethod
+    def as_view(cls):
+        async def view(request, *args, **kwargs):
+            return await cls().dispatch(request, *args, **kwargs)
+
+        view.csrf_exempt = True
+        if cls.schema_view is not None:
+            view.cls = cls.schema_view
+            view.initkwargs = {}
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        method = request.method.lower()
+        handler = getattr(self, method, None) if method in self.http_method_names else None
+        if handler is None:
+            return JsonResponse({"detail": f'Method "{request.method}" not allowed.'},
+                                status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        try:
+            return await handler(request, *args, **kwargs)
+        except ParseError as e:
+            return JsonResponse({"detail": str(e.detail)}, status=status.HTTP_400_BAD_REQUEST)
+
+    def get_data(self, request):
+        """Parse the body the way DRF's default JSON/form/multipart parsers would."""
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError as e:
+                raise ParseError(f"JSON parse error - {e}")
+        if request.method == 'POST':
+            data = request.POST.copy()
+            data.update(request.FILES)
+            return data
+        return QueryDict(request.body, mutable=True)
+
+
+def attach_user(data, user_data, anonymous=False):
+    if user_data:
+        data['user_id'] = user_data.get('id')
+        data['user_name'] = user_data.get('full_name')
+        data['user_email'] = user_data.get('email')
+    elif anonymous:
+        data['user_id'] = 'anonymous'
+        data['user_name'] = 'Anonymous'
+        data['user_email'] = 'anonymous@gmail.com'
+
+
+class PostCreateView(AsyncAPIView):
+    schema_view = views.PostCreateView
+
+    def create_post(self, data):
+        serializer = PostSerializer(data=data)
+        if not serializer.is_valid():
+            return None, serializer.errors, []
+        with transaction.atomic():
+            post = serializer.save()
+            images = [Image.objects.create(post=post, **image_data) for image_data in data.get('images', [])]
+            media.adopt([image.image_url for image in images])
+        return post, serializer.data, images
+
+    async def post(self, request, *args, **kwargs):
+        data = self.get_data(request)
+        attach_user(data, getattr(request, 'user_data', None))
+
+        post, serializer_data, images = await sync_to_async(self.create_post)(data)
+        if post is None:
+            return JsonResponse(serializer_data, status=status.HTTP_400_BAD_REQUEST)
+
+        sending_data = data.dict() if isinstance(data, QueryDict) else dict(data)
+        sending_data['created_at'] = post.created_at.isoformat()
+        sending_data['id'] = post.id
+        sending_data['first_image'] = post.cover_image_url or DEFAULT_POST_IMAGE
+        try:
+            published, response_text = await apublish_to_newsletter(sending_data)
+        except ServiceError as e:
+            return JsonResponse({
+                "EC": 0,
+                "EM": f"Error while sending post to FastAPI server: {e}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if published:
+            return JsonResponse({
+                "EC": 1,
+                "EM": "Success",
+                "DT": serializer_data
+            }, status=status.HTTP_200_OK)
+        return JsonResponse({
+            "EC": 1,
+            "EM": f"Failed to add post to newsletter. Yet, saved post. Error: {response_text}",
+            "DT": serializer_data
+        }, status=status.HTTP_201_CREATED)
+
+
+class ImageCreateView(AsyncAPIView):
+    schema_view = views.ImageCreateView
+
+    def validate(self, request, post_id):
+        post = post_cache.get_post(post_id)
+        if post is None:
+            return None, None
+        request_data = self.get_data(request)
+        request_data["post"] = post.id
+        serializer = ImageSerializer(data=request_data)
+        serializer.is_valid()
+        return post, serializer
+
+    async def post(self, request, post_id, *args, **kwargs):
+        try:
+            post, serializer = await sync_to_async(self.validate)(request, post_id)
+            if post is None:
+                return JsonResponse(
+                    {"EC": -1, "EM": "Post not found", "DT": ""},
+                    status=status.HTTP_404_NOT_FOUND,
+                )
+            if serializer.errors:
+                return JsonResponse(
+                    {"EC": -1, "EM": "Invalid input", "DT": serializer.errors},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            validated_data = serializer.validated_data
+            file = validated_data['file']
+            # Hashing and the upload touch no DB state, so keep them off the
+            # thread that serves ORM calls.
+            key, size = await sync_to_async(media.digest, thread_sensitive=False)(file)
+            if not await sync_to_async(media.retain)(key, size):
+                try:
+                    await sync_to_async(media.put, thread_sensitive=False)(
+                        file, key, media.CONTENT_TYPES[file.image.format]
+                    )
+                except Exception:
+                    await sync_to_async(media.release)([key])
+                    raise
+                await sync_to_async(media.mark_uploaded)([key])
+            serializer.instance = await sync_to_async(serializer.save_image)(
+                post, validated_data.get('label', ''), key
+            )
+            return JsonResponse(
+                {"EC": 1, "EM": "Image saved successfully", "DT": serializer.data},
+                status=status.HTTP_201_CREATED,
+            )
+
+        except Exception as e:
+            return JsonResponse(
+                {"EC": -1, "EM": f"Error saving image: {str(e)}", "DT": ""},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+
+class CommentCreateView(AsyncAPIView):
+    schema_view = views.CommentCreateView
+
+    def create_comment(self, post_id, data):
+        post = post_cache.get_post(post_id)
+        if post is None:
+            return {"detail": "Not found."}, status.HTTP_404_NOT_FOUND
+
+        parent_id = data.get('parent')
+        if parent_id is not None and parent_id != '':
+            if not Comment.objects.filter(id=parent_id).exists():
+                return ({'error': f"Parent comment with ID {parent_id} does not exist."},
+                        status.HTTP_400_BAD_REQUEST)
+
+        serializer = CommentSerializer(data=data)
+        if serializer.is_valid():
+            # The author fields are read-only in the serializer, so they are saved explicitly.
+            serializer.save(post=post, user_id=data['user_id'], user_name=data['user_name'],
+                            user_email=data['user_email'])
+            broadcast_comment(post.id, 'created', serializer.data)
+            count_changed(post.id, 'comments', 1)
+            return serializer.data, status.HTTP_201_CREATED
+        return serializer.errors, status.HTTP_400_BAD_REQUEST
+
+    async def post(self, request, post_id):
+        data = self.get_data(request)
+        attach_user(data, getattr(request, 'user_data', None), anonymous=True)
+        payload, status_code = await sync_to_async(self.create_comment)(post_id, data)
+        return JsonResponse(payload, status=status_code)
+
+
+class CommentUpdateDeleteView(AsyncAPIView):
+    schema_view = views.CommentUpdateDeleteView
+
+    def get_object(self, post_id, comment_id):
+        return Comment.objects.filter(id=comment_id, post_id=post_id).first()
+
+    def update_comment(self, post_id, comment_id, user_data, data):
+        comment = self.get_object(post_id, comment_id)
+        if not comment:
+            return {'error': 'Comment or post not found'}, status.HTTP_404_NOT_FOUND
+
+        if not user_data or comment.user_id != user_data.get('id'):
+            return {'error': 'Permission denied'}, status.HTTP_403_FORBIDDEN
+
+        serializer = CommentSerializer(comment, data=data, partial=True)
+        if serializer.is_valid():
+            serializer.save()
+            broadcast_comment(comment.post_id, 'updated', serializer.data)
+            return serializer.data, status.HTTP_200_OK
+        return serializer.errors, status.HTTP_400_BAD_REQUEST
+
+    def delete_comment(self, request, post_id, comment_id, user_data):
+        comment = self.get_object(post_id, comment_id)
+        if not comment:
+            return {'error': 'Comment or post not found'}, status.HTTP_404_NOT_FOUND
+
+        # request.user is resolved lazily from the session, so it is read here
+        # rather than on the event loop.
+        if not user_data or (comment.user_id != user_data.get('id') and not request.user.is_superuser):
+            return {'error': 'Permission denied'}, status.HTTP_403_FORBIDDEN
+
+        # Subscribers are notified once the delete has committed, not before.
+        with transaction.atomic():
+            broadcast_comment(comment.post_id, 'deleted', {'id': comment.id, 'parent': comment.parent_id})
+            count_changed(comment.post_id, 'comments', -comment.thread_size())
+            comment.delete()
+        return {'status': 'Comment deleted'}, status.HTTP_204_NO_CONTENT
+
+    async def put(self, request, post_id, comment_id):
+        data = self.get_data(request)
+        payload, status_code = await sync_to_async(self.update_comment)(
+            post_id, comment_id, getattr(request, 'user_data', None), data
+        )
+        return JsonResponse(payload, status=status_code)
+
+    async def delete(self, request, post_id, comment_id):
+        payload, status_code = await sync_to_async(self.delete_comment)(
+            request, post_id, comment_id, getattr(request, 'user_data', None)
+        )
+        return JsonResponse(payload, status=status_code)
+
+
+class LikeCreateDeleteView(AsyncAPIView):
+    schema_view = views.LikeCreateDeleteView
+
+    def create_like(self, post_id, user_id, user_name, user_email):
+        post = post_cache.get_post(post_id)
+        if not post:
+            return {"detail": "Post not found"}, status.HTTP_404_NOT_FOUND
+
+        if user_id != 'anonymous' and Like.objects.filter(user_id=user_id, post=post).exists():
+            return {"detail": "You have already liked this post."}, status.HTTP_400_BAD_REQUEST
+
+        like_instance = Like.objects.create(
+            user_id=user_id,
+            user_name=user_name,
+            user_email=user_email,
+            post=post
+        )
+        count_changed(post.id, 'likes', 1)
+        return LikeSerializer(like_instance).data, status.HTTP_201_CREATED
+
+    def delete_like(self, post_id, user_data):
+        if post_cache.get_post(post_id) is None:
+            return {"detail": "Post not found"}, status.HTTP_404_NOT_FOUND
+        if not user_data:
+            return {"error": "Authentication failed"}, status.HTTP_401_UNAUTHORIZED
+
+        like = Like.objects.filter(user_id=user_data.get('id'), post_id=post_id).first()
+        if not like:
+            return {"detail": "You haven't liked this post."}, status.HTTP_400_BAD_REQUEST
+
+        like.delete()
+        count_changed(post_id, 'likes', -1)
+        return {"detail": "Unlike successfully"}, status.HTTP_204_NO_CONTENT
+
+    async def post(self, request, post_id):
+        user_data = getattr(request, 'user_data', None)
+        if user_data:
+            user_id = user_data.get('id')
+            user_name = user_data.get('full_name')
+            user_email = user_data.get('email')
+        else:
+            user_id = 'anonymous'
+            user_name = 'Anonymous'
+            user_email = 'anonymous@gmail.com'
+
+        payload, status_code = await sync_to_async(self.create_like)(post_id, user_id, user_name, user_email)
+        return JsonResponse(payload, status=status_code)
+
+    async def delete(self, request, post_id):
+        payload, status_code = await sync_to_async(self.delete_like)(post_id, getattr(request, 'user_data', None))
+        return JsonResponse(payload, status=status_code)
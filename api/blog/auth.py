@@ -0,0 +1,112 @@
+"""
+SSO token verification shared by the HTTP middleware and the WebSocket
+middleware. Successful verifications are cached per token (never past the
+token's own expiry), so repeat requests and socket connects skip the SSO
+round trip.
+"""
+import hashlib
+import logging
+import time
+import jwt
+from django.conf import settings
+from django.core.cache import cache
+from .clients import verify_sso_token, averify_sso_token
+
+logger = logging.getLogger(__name__)
+
+
+def decode_claims(token):
+    return jwt.decode(token, options={"verify_signature": False})
+
+
+def user_data_from_token(token):
+    """Build the `user_data` dict attached to requests and socket scopes. Raises jwt.InvalidTokenError."""
+    decoded = decode_claims(token)
+    return {
+        'id': decoded.get('user_id'),
+        'email': decoded.get('email'),
+        'full_name': f"{decoded.get('first_name', '')} {decoded.get('last_name', '')}".strip(),
+        'role': decoded.get('roleWithPermission', {}),
+        'permissions': [
+            perm['url'] for perm in decoded.get('roleWithPermission', {}).get('Permissions', [])
+        ]
+    }
+
+
+def cache_key(token):
+    return f"sso_verify:{hashlib.sha256(token.encode()).hexdigest()}"
+
+
+def cache_timeout(token):
+    timeout = settings.SSO_VERIFY_CACHE_TTL
+    try:
+        expires_at = decode_claims(token).get('exp')
+    except jwt.InvalidTokenError:
+        return 0
+    if expires_at:
+        timeout = min(timeout, int(expires_at - time.time()))
+    return timeout
+
+
+def is_verified(status_code, data):
+    return status_code == 200 and data.get("EC") == 1
+
+
+def cached_result(token):
+    try:
+        return cache.get(cache_key(token))
+    except Exception:
+        logger.warning("SSO verification cache unavailable", exc_info=True)
+        return None
+
+
+async def acached_result(token):
+    try:
+        return await cache.aget(cache_key(token))
+    except Exception:
+        logger.warning("SSO verification cache unavailable", exc_info=True)
+        return None
+
+
+def cacheable(token, status_code, data):
+    """Cache timeout for a verification result, or 0 when it must not be cached."""
+    return cache_timeout(token) if is_verified(status_code, data) else 0
+
+
+def store_result(token, status_code, data):
+    timeout = cacheable(token, status_code, data)
+    if timeout <= 0:
+        return
+    try:
+        cache.set(cache_key(token), data, timeout)
+    except Exception:
+        logger.warning("SSO verification cache unavailable", exc_info=True)
+
+
+async def astore_result(token, status_code, data):
+    timeout = cacheable(token, status_code, data)
+    if timeout <= 0:
+        return
+    try:
+        await cache.aset(cache_key(token), data, timeout)
+    except Exception:
+        logger.warning("SSO verification cache unavailable", exc_info=True)
+
+
+def verify_token(token):
+    """Verify `token` with the SSO service unless a recent success is cached. Returns (status_code, data)."""
+    data = cached_result(token)
+    if data is not None:
+        return 200, data
+    status_code, data = verify_sso_token(token)
+    store_result(token, status_code, data)
+    return status_code, data
+
+
+async def averify_token(token):
+    data = await acached_result(token)
+    if data is not None:
+        return 200, data
+    status_code, data = await averify_sso_token(token)
+    await astore_result(token, status_code, data)
+    return status_code, data
@@ -0,0 +1,168 @@
+"""
+Server-side pushes to the ``post_{id}`` WebSocket groups served by
+``CommentConsumer``. Only committed data is sent: callers queue events with
+``transaction.on_commit`` through the helpers below.
+"""
+import logging
+import threading
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def post_group(post_id):
+    return f"post_{post_id}"
+
+
+def group_send(group, message):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    # Consumers report now - sent_at as group fan-out latency
+    message = {**message, "sent_at": time.time()}
+    try:
+        async_to_sync(channel_layer.group_send)(group, message)
+    except Exception:
+        # The write is already committed; a failed push must not fail the request.
+        logger.exception("Failed to push %s to %s", message.get('type'), group)
+
+
+class CommentBroadcaster:
+    """
+    Sends comment events to a post's group as they happen. Once a post emits
+    more than `hot_threshold` events within one `interval`, further events
+    for it are buffered and flushed as one ``send_comment_batch`` frame per
+    interval, so busy threads cost a frame per interval instead of one per comment.
+    """
+
+    def __init__(self, interval=None, hot_threshold=None):
+        self.interval = interval if interval is not None else settings.COMMENT_BROADCAST_INTERVAL
+        self.hot_threshold = hot_threshold if hot_threshold is not None else settings.COMMENT_BROADCAST_HOT_THRESHOLD
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.pending = {}
+        self.timer = None
+
+    def publish(self, post_id, event):
+        now = time.monotonic()
+        with self.lock:
+            started, count = self.windows.get(post_id, (now, 0))
+            if now - started >= self.interval:
+                started, count = now, 0
+            self.windows[post_id] = (started, count + 1)
+
+            if count < self.hot_threshold and post_id not in self.pending:
+                buffered = False
+            else:
+                self.pending.setdefault(post_id, []).append(event)
+                self.schedule_flush()
+                buffered = True
+
+        if not buffered:
+            group_send(post_group(post_id), {"type": "send_comment", "post_id": post_id, **event})
+
+    def schedule_flush(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        now = time.monotonic()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.timer = None
+            self.windows = {
+                post_id: window for post_id, window in self.windows.items()
+                if now - window[0] < self.interval
+            }
+
+        for post_id, events in pending.items():
+            group_send(post_group(post_id), {
+                "type": "send_comment_batch",
+                "post_id": post_id,
+                "events": events,
+            })
+
+    def close(self):
+        """Cancel the scheduled flush and send what is buffered now."""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+
+class CounterAggregator:
+    """
+    Sums like/comment count deltas per post and sends them as one
+    ``send_counts`` frame per post every `interval`, so a burst of hundreds
+    of likes on one post costs a few messages per second.
+    """
+
+    fields = ('likes', 'comments')
+
+    def __init__(self, interval=None):
+        self.interval = interval if interval is not None else settings.COUNTER_BROADCAST_INTERVAL
+        self.lock = threading.Lock()
+        self.deltas = {}
+        self.timer = None
+
+    def add(self, post_id, field, delta):
+        with self.lock:
+            deltas = self.deltas.setdefault(post_id, dict.fromkeys(self.fields, 0))
+            deltas[field] += delta
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.deltas = self.deltas, {}
+            self.timer = None
+
+        for post_id, deltas in pending.items():
+            if any(deltas.values()):
+                group_send(post_group(post_id), {
+                    "type": "send_counts",
+                    "post_id": post_id,
+                    "deltas": deltas,
+                })
+
+    def close(self):
+        """Cancel the scheduled flush and send the summed deltas now."""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+
+comment_broadcaster = CommentBroadcaster()
+counter_aggregator = CounterAggregator()
+
+
+def flush_pending():
+    """
+    Send everything the broadcasters hold and cancel their timers, for code
+    that swaps the channel layer out (the load test) and must not leave a
+    timer to push into whatever layer is configured later.
+    """
+    comment_broadcaster.close()
+    counter_aggregator.close()
+
+
+def broadcast_comment(post_id, action, comment_data):
+    """Push a comment event ("created", "updated" or "deleted") once the current transaction commits."""
+    event = {"action": action, "comment_data": dict(comment_data)}
+    transaction.on_commit(lambda: comment_broadcaster.publish(post_id, event))
+
+
+def count_changed(post_id, field, delta):
+    """Add `delta` to the post's "likes" or "comments" counter push once the current transaction commits."""
+    transaction.on_commit(lambda: counter_aggregator.add(post_id, field, delta))
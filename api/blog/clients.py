@@ -0,0 +1,142 @@
+import asyncio
+import weakref
+from django.conf import settings
+from api.timing import timed
+
+# boto3, requests and aiohttp are imported on first use: together they are
+# about half a second of startup, and most processes (Celery beat, the
+# websocket-only paths, management commands) never touch some of them.
+
+DEFAULT_POST_IMAGE = 'https://ezgroup-static-files-bucket.s3.ap-southeast-2.amazonaws.com/media/ezgroup-logo.jpg'
+
+# One pooled session per process (sync) and per event loop (async), so
+# outbound calls reuse keep-alive connections instead of a new handshake each time.
+_http_session = None
+_async_sessions = weakref.WeakKeyDictionary()
+_s3_client = None
+
+
+class ServiceError(Exception):
+    """An external service could not be reached, timed out or sent an unreadable response."""
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+    return _http_session
+
+
+def get_async_session():
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=settings.HTTP_CLIENT_TIMEOUT)
+        )
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    """Close the current loop's session; for tools that run their own short-lived loop."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client(
+            's3',
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=getattr(settings, 'AWS_REGION', None),
+        )
+    return _s3_client
+
+
+# S3 DeleteObjects takes at most this many keys per request
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def s3_key(image_url):
+    """The media bucket key behind `image_url`, or None for images hosted elsewhere (e.g. crawled news)."""
+    prefix = f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/'
+    if not image_url or not image_url.startswith(prefix):
+        return None
+    return image_url[len(prefix):]
+
+
+def delete_s3_objects(keys):
+    """Delete `keys` from the media bucket, S3_DELETE_BATCH_SIZE per request. Returns the keys S3 refused."""
+    s3_client = get_s3_client()
+    failed = []
+    for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        batch = keys[start:start + S3_DELETE_BATCH_SIZE]
+        with timed('s3'):
+            response = s3_client.delete_objects(
+                Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+            )
+        failed.extend(error['Key'] for error in response.get('Errors', []))
+    return failed
+
+
+def sso_headers(token):
+    return {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+
+
+def verify_sso_token(token):
+    """Ask the SSO service whether `token` is valid. Returns (status_code, data); raises ServiceError."""
+    import requests
+    try:
+        with timed('sso'):
+            response = get_http_session().post(settings.SSO_URL, headers=sso_headers(token),
+                                               timeout=settings.HTTP_CLIENT_TIMEOUT)
+            return response.status_code, response.json()
+    except requests.RequestException as e:
+        raise ServiceError(e) from e
+
+
+async def averify_sso_token(token):
+    import aiohttp
+    try:
+        with timed('sso'):
+            async with get_async_session().post(settings.SSO_URL, headers=sso_headers(token)) as response:
+                return response.status, await response.json(content_type=None)
+    # ValueError: a reply that is not JSON, as requests.JSONDecodeError is for the sync path
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise ServiceError(e) from e
+
+
+def newsletter_url():
+    return f"{settings.NEWSLETTER_ENDPOINT}/posts/"
+
+
+def publish_to_newsletter(data):
+    """Forward a new post to the newsletter service. Returns (ok, response_text); raises ServiceError."""
+    import requests
+    try:
+        with timed('http'):
+            response = get_http_session().post(newsletter_url(), json=data, timeout=settings.HTTP_CLIENT_TIMEOUT)
+            return response.status_code == 200, response.text
+    except requests.RequestException as e:
+        raise ServiceError(e) from e
+
+
+async def apublish_to_newsletter(data):
+    import aiohttp
+    try:
+        with timed('http'):
+            async with get_async_session().post(newsletter_url(), json=data) as response:
+                return response.status == 200, await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise ServiceError(e) from e
@@ -1,64 +1,213 @@
+import asyncio
 import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from api.metrics import registry
+from . import presence
+from .broadcast import post_group
+
+fanout_latency = registry.histogram(
+    'ws_group_fanout_seconds', "Time from group_send to delivery at a consumer", labels=('event',)
+)
+overflowed_frames = registry.counter(
+    'ws_send_queue_overflow_total', "Frames hitting a full per-connection send queue", labels=('policy',)
+)
+
+
+class BoundedSendMixin:
+    """
+    Queue outgoing frames per connection, at most WS_SEND_QUEUE_SIZE of them,
+    and write them from a background task so a slow client cannot stall the
+    consumer's channel-layer receive loop. WS_OVERFLOW_POLICY picks what
+    happens when the queue is full: "drop_oldest", "drop_newest" or "close".
+    """
+
+    send_queue = None
+    sender = None
+
+    def start_sending(self):
+        self.send_queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.sender = asyncio.create_task(self.drain_send_queue())
+
+    def stop_sending(self):
+        self.send_queue = None
+        if self.sender is not None:
+            self.sender.cancel()
+
+    async def drain_send_queue(self):
+        while True:
+            text_data, bytes_data = await self.send_queue.get()
+            await super().send(text_data=text_data, bytes_data=bytes_data)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.send_queue is None or close:
+            return await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+        if self.send_queue.full():
+            policy = settings.WS_OVERFLOW_POLICY
+            overflowed_frames.inc(policy=policy)
+            if policy == 'close':
+                self.stop_sending()
+                await self.close(code=4008)
+                return
+            if policy == 'drop_newest':
+                return
+            self.send_queue.get_nowait()
+        self.send_queue.put_nowait((text_data, bytes_data))
+
+    def record_fanout(self, event):
+        sent_at = event.get('sent_at')
+        if sent_at:
+            fanout_latency.observe(max(time.time() - sent_at, 0), event=event['type'])
+
+
+class CommentConsumer(BoundedSendMixin, AsyncWebsocketConsumer):
+    """
+    Live updates for one post (``ws/comments/<post_id>/``) and, with the
+    ``subscribe_counts`` action, count updates for any number of other posts
+    on the same socket (``ws/counts/`` for feed pages).
+    """
 
-class CommentConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.post_id = self.scope['url_route']['kwargs']['post_id']
-        self.group_name = f"post_{self.post_id}"
+        self.post_id = self.scope['url_route']['kwargs'].get('post_id')
+        self.group_name = post_group(self.post_id) if self.post_id else None
+        self.count_post_ids = set()
+        self.heartbeat = None
+
+        if self.group_name:
+            await self.channel_layer.group_add(
+                self.group_name,
+                self.channel_name
+            )
+        await self.accept(subprotocol=self.scope.get('auth_subprotocol'))
+        self.start_sending()
+        if self.post_id:
+            await presence.touch(self.post_id, self.channel_name)
+            self.heartbeat = asyncio.create_task(self.keep_present())
 
-        await self.channel_layer.group_add(
-            self.group_name,
-            self.channel_name
-        )
-        await self.accept()
+    async def keep_present(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_TTL / 3)
+            await presence.touch(self.post_id, self.channel_name)
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.group_name,
-            self.channel_name
-        )
+        self.stop_sending()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            await presence.leave(self.post_id, self.channel_name)
+        if self.group_name:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+        for post_id in self.count_post_ids:
+            await self.channel_layer.group_discard(post_group(post_id), self.channel_name)
 
     async def receive(self, text_data):
         data = json.loads(text_data)
         action = data.get('action')
 
-        if action == 'new_comment':
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    "type": "send_comment",
-                    "comment_data": data['comment_data'],
-                }
-            )
-        elif action == 'new_notification':
+        # Comments are pushed by the server once saved (blog.broadcast), so
+        # client-sent comment payloads are no longer relayed.
+        if action == 'subscribe_counts':
+            await self.subscribe_counts(data.get('post_ids', []))
+        elif action == 'unsubscribe_counts':
+            await self.unsubscribe_counts(data.get('post_ids', []))
+        elif action == 'new_notification' and self.group_name:
             await self.channel_layer.group_send(
                 self.group_name,
                 {
                     "type": "send_notification",
+                    "post_id": self.post_id,
                     "notification_data": data['notification_data'],
+                    "sent_at": time.time(),
                 }
             )
 
+    async def subscribe_counts(self, post_ids):
+        post_ids = {str(post_id) for post_id in post_ids if str(post_id).isdigit()}
+        post_ids -= self.count_post_ids
+        post_ids.discard(self.post_id)
+        room = settings.COUNTER_MAX_SUBSCRIPTIONS - len(self.count_post_ids)
+        for post_id in sorted(post_ids)[:max(room, 0)]:
+            await self.channel_layer.group_add(post_group(post_id), self.channel_name)
+            self.count_post_ids.add(post_id)
+        await self.send(text_data=json.dumps({
+            "type": "subscribed_counts",
+            "post_ids": sorted(self.count_post_ids, key=int),
+        }))
+
+    async def unsubscribe_counts(self, post_ids):
+        for post_id in {str(post_id) for post_id in post_ids} & self.count_post_ids:
+            await self.channel_layer.group_discard(post_group(post_id), self.channel_name)
+            self.count_post_ids.discard(post_id)
+
+    def is_room_event(self, event):
+        # Groups joined through subscribe_counts only forward counts.
+        return str(event.get("post_id", self.post_id)) == str(self.post_id)
+
+    async def send_counts(self, event):
+        self.record_fanout(event)
+        await self.send(text_data=json.dumps({
+            "type": "counts",
+            "post_id": event["post_id"],
+            "deltas": event["deltas"]
+        }))
+
     async def send_comment(self, event):
+        self.record_fanout(event)
+        if not self.is_room_event(event):
+            return
         await self.send(text_data=json.dumps({
             "type": "comment",
+            "action": event.get("action", "created"),
             "data": event["comment_data"]
         }))
 
+    async def send_comment_batch(self, event):
+        self.record_fanout(event)
+        if not self.is_room_event(event):
+            return
+        await self.send(text_data=json.dumps({
+            "type": "comment_batch",
+            "events": [
+                {"action": item["action"], "data": item["comment_data"]}
+                for item in event["events"]
+            ]
+        }))
+
     async def send_notification(self, event):
+        self.record_fanout(event)
+        if not self.is_room_event(event):
+            return
         await self.send(text_data=json.dumps({
             "type": "notification",
             "data": event["notification_data"]
         }))
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(BoundedSendMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_name = f"user_{self.scope['user'].id}"
+        self.group_name = None
+        # Set by JWTWebSocketAuthMiddleware from the SSO bearer token
+        user_data = self.scope.get('user_data')
+        if not user_data:
+            await self.close(code=4401)
+            return
+        if str(self.scope['url_route']['kwargs'].get('user_id')) != str(user_data['id']):
+            await self.close(code=4403)
+            return
+
+        self.group_name = f"user_{user_data['id']}"
         await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol=self.scope.get('auth_subprotocol'))
+        self.start_sending()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        self.stop_sending()
+        if self.group_name:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def send_notification(self, event):
+        self.record_fanout(event)
         await self.send(text_data=json.dumps({"message": event["message"]}))
@@ -0,0 +1,110 @@
+"""
+Post deletion.
+
+Deleting a post only sets ``deleted_at``. From then on ``Post.objects``
+leaves it out, and saving the flag drops it from the post cache and the
+trending ranking. The ``purge_post`` task removes the rest: images, likes
+and comments POST_PURGE_CHUNK_SIZE rows at a time, then the post row. The
+images' references to shared objects are released (see blog.media); objects
+stored before deduplication are deleted with one DeleteObjects request per
+1000 keys, before their rows. Images whose object S3 refuses to delete are
+kept and the purge raises PurgeError, so the task retries them later
+rather than leaving the object with nothing pointing at it. The post's
+likes and comments no longer count towards a ranking it has already left,
+so trending updates are suspended during the purge.
+
+If the task cannot be queued, the ``purge_deleted_posts`` beat task picks
+the post up later. With POST_DELETE_QUEUE=FALSE the purge runs inline once
+the request's transaction commits.
+"""
+import logging
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import media, trending
+from .clients import delete_s3_objects, s3_key
+from .models import Comment, Image, Like, MediaObject, Post
+
+logger = logging.getLogger(__name__)
+
+
+class PurgeError(Exception):
+    """Part of a post could not be removed; purging it again resumes from there."""
+
+
+def delete_post(post):
+    """Hide `post` now and purge it in the background."""
+    post.deleted_at = timezone.now()
+    post.save(update_fields=['deleted_at'])
+    transaction.on_commit(partial(schedule_purge, post.pk))
+
+
+def schedule_purge(post_id):
+    if not settings.POST_DELETE_QUEUE:
+        purge(post_id)
+        return
+    from .tasks import purge_post
+    try:
+        purge_post.delay(post_id)
+    except Exception:
+        # The periodic purge removes it instead.
+        logger.warning("Could not schedule the purge of post %s", post_id, exc_info=True)
+
+
+def chunks(queryset, size):
+    """Lists of up to `size` primary keys from `queryset`, until it matches nothing."""
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:size])
+        if not ids:
+            return
+        yield ids
+
+
+def purge_images(post_id, size):
+    removed = 0
+    kept = []
+    while True:
+        images = list(Image.objects.filter(post_id=post_id).exclude(pk__in=kept).values_list('pk', 'image_url')[:size])
+        if not images:
+            break
+        keys = {pk: s3_key(url) for pk, url in images}
+        tracked = set(MediaObject.objects.filter(key__in=set(keys.values()) - {None}).values_list('key', flat=True))
+        # Objects stored before deduplication belong to this image alone, so they go first.
+        failed = set(delete_s3_objects(sorted({key for key in keys.values() if key and key not in tracked})))
+        done = [pk for pk, key in keys.items() if key not in failed]
+        # Bulk deletes skip Image.delete, which would release the objects one by one.
+        with transaction.atomic():
+            media.release([keys[pk] for pk in done if keys[pk] in tracked])
+            Image.objects.filter(pk__in=done).delete()
+        removed += len(done)
+        kept.extend(pk for pk, key in keys.items() if key in failed)
+    if kept:
+        raise PurgeError(f"S3 refused to delete the objects of {len(kept)} images of post {post_id}")
+    return removed
+
+
+def purge(post_id, chunk_size=None):
+    """Delete a deleted post and everything attached to it. Returns rows deleted by model."""
+    size = chunk_size or settings.POST_PURGE_CHUNK_SIZE
+    post = Post.all_objects.filter(pk=post_id, deleted_at__isnull=False).first()
+    if post is None:
+        return {}
+    deleted = {'images': purge_images(post_id, size), 'likes': 0, 'comments': 0}
+    with trending.suspended():
+        for ids in chunks(Like.objects.filter(post_id=post_id), size):
+            deleted['likes'] += Like.objects.filter(pk__in=ids).delete()[0]
+        # Replies in a chunk's threads go with it, so count what was actually deleted.
+        for ids in chunks(Comment.objects.filter(post_id=post_id), size):
+            deleted['comments'] += Comment.objects.filter(pk__in=ids).delete()[0]
+    post.delete()
+    return deleted
+
+
+def purge_pending(limit=100):
+    """Purge up to `limit` deleted posts left behind. Returns how many were purged."""
+    post_ids = list(Post.all_objects.filter(deleted_at__isnull=False)
+                    .order_by('deleted_at').values_list('pk', flat=True)[:limit])
+    for post_id in post_ids:
+        purge(post_id)
+    return len(post_ids)
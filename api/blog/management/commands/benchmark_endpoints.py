@@ -0,0 +1,93 @@
+import json
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from perf.bench import CASES, Dataset, failures, measure, regressions
+from perf.db import test_database
+from perf.fakes import LOCAL_BACKENDS, FakeServices
+
+BASELINE_DIR = os.path.join(settings.BASE_DIR, 'perf', 'baselines')
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark every blog and authen endpoint against the configured database "
+        "with seeded data, reporting latency percentiles, queries and allocations per request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000',
+                            help="Comma-separated numbers of seeded posts to benchmark with.")
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--endpoint', action='append', choices=sorted(CASES), dest='endpoints',
+                            help="Only benchmark this endpoint; may be repeated.")
+        parser.add_argument('--baseline', help="Baseline JSON file (default: perf/baselines/<vendor>.json).")
+        parser.add_argument('--save', action='store_true',
+                            help="Write the results into the baseline file, replacing only the cases run. "
+                                 "Refused if any request got a non-2xx response.")
+        parser.add_argument('--compare', action='store_true',
+                            help="Fail if an endpoint issues more queries than in the baseline file, "
+                                 "or allocates more than --tolerance above it.")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Allowed relative growth of allocations for --compare.")
+        parser.add_argument('--latency-tolerance', type=float,
+                            help="Also fail --compare when p95 latency grows by more than this fraction. "
+                                 "Only meaningful against a baseline saved on the same machine.")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        names = options['endpoints'] or list(CASES)
+        baseline_path = options['baseline'] or os.path.join(BASELINE_DIR, f'{connection.vendor}.json')
+
+        results = {}
+        with override_settings(**LOCAL_BACKENDS), FakeServices():
+            for size in sizes:
+                with test_database():
+                    dataset = Dataset(size)
+                    results[str(size)] = {}
+                    for name in names:
+                        result = measure(CASES[name], dataset, options['iterations'])
+                        results[str(size)][name] = result
+                        self.report(size, name, result)
+
+        if options['save']:
+            # An error path is usually much cheaper than the success path, so it is no baseline.
+            failed = failures(results)
+            for size, name, statuses in failed:
+                self.stderr.write(f"{name} @ {size} posts: status {','.join(str(code) for code in statuses)}")
+            if failed:
+                raise CommandError(f"Not saving: {len(failed)} case(s) got non-2xx responses")
+            sizes = {}
+            if os.path.exists(baseline_path):
+                with open(baseline_path) as f:
+                    sizes = json.load(f)['sizes']
+            for size, cases in results.items():
+                sizes.setdefault(size, {}).update(cases)
+            os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+            with open(baseline_path, 'w') as f:
+                json.dump({'vendor': connection.vendor, 'iterations': options['iterations'], 'sizes': sizes},
+                          f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write(f"Saved baseline to {baseline_path}")
+
+        if options['compare']:
+            if not os.path.exists(baseline_path):
+                raise CommandError(f"No baseline at {baseline_path}; run with --save first.")
+            with open(baseline_path) as f:
+                baseline = json.load(f)['sizes']
+            found = regressions(results, baseline, options['tolerance'], options['latency_tolerance'])
+            for size, name, metric, before, after in found:
+                self.stderr.write(f"{name} @ {size} posts: {metric} {before} -> {after}")
+            if found:
+                raise CommandError(f"{len(found)} regression(s) against {baseline_path}")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
+
+    def report(self, size, name, result):
+        status = ','.join(str(code) for code in result['status'])
+        self.stdout.write(
+            f"{size:>7} {name:<22} p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  "
+            f"p99 {result['p99_ms']:>8} ms  {result['queries']:>3} queries  "
+            f"{result['peak_alloc_kb']:>8} KiB  [{status}]"
+        )
@@ -0,0 +1,41 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from perf.startup import PROCESSES, measure
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure cold-start import time, resident memory and loaded modules of the "
+        "WSGI, ASGI and Celery worker processes, each in a fresh interpreter."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--process', action='append', choices=sorted(PROCESSES), dest='processes',
+                            help="Only measure this process type; may be repeated.")
+        parser.add_argument('--repeat', type=int, default=5, help="Cold starts per process type.")
+        parser.add_argument('--top', type=int, default=10,
+                            help="Also list this many slowest packages to import (0 to skip).")
+        parser.add_argument('--output', help="Also write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        results = {}
+        for process in options['processes'] or list(PROCESSES):
+            try:
+                result = measure(process, options['repeat'], options['top'])
+            except RuntimeError as e:
+                raise CommandError(e)
+            results[process] = result
+            self.report(process, result)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+
+    def report(self, process, result):
+        self.stdout.write(
+            f"{process:<7} import {result['import_ms']:>8} ms  RSS {result['rss_mb']:>6} MiB  "
+            f"{result['modules']:>5} modules  (median of {result['runs']})"
+        )
+        for name, ms in result.get('slowest_imports', []):
+            self.stdout.write(f"          {name:<28} {ms:>8} ms")
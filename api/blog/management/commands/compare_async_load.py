@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from blog.clients import close_async_session
+from blog.models import Post
+from perf.asgi import ASGIClient
+from perf.bench import png_bytes
+from perf.db import test_database
+from perf.fakes import FakeServices, make_token
+from perf.load import run_concurrently
+from perf.stats import summarize
+
+ENDPOINTS = ['create-post', 'image-upload', 'comment']
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive concurrent requests through the ASGI handler against fake SSO, "
+        "newsletter and S3 services and compare sync views with ASYNC_VIEWS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+        parser.add_argument('--endpoint', choices=ENDPOINTS, default='create-post')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--latency', type=float, default=50,
+                            help="Latency of each fake external call, in milliseconds.")
+        parser.add_argument('--json', action='store_true', help="Print the result as JSON.")
+
+    def handle(self, *args, **options):
+        if options['mode'] == 'both':
+            return self.compare(options)
+
+        if settings.ASYNC_VIEWS != (options['mode'] == 'async'):
+            raise CommandError(f"--mode {options['mode']} needs ASYNC_VIEWS="
+                               f"{'TRUE' if options['mode'] == 'async' else 'FALSE'}")
+
+        with test_database(), FakeServices(latency=options['latency'] / 1000) as fakes:
+            post = Post.objects.create(title='Load test', content='Body', category='bench')
+            latencies, errors, elapsed, peak_threads = asyncio.run(self.drive(post, options))
+            result = summarize(latencies, elapsed, errors)
+            result['peak_threads'] = peak_threads
+            result.update(mode=options['mode'], endpoint=options['endpoint'],
+                          concurrency=options['concurrency'], s3_calls=fakes.s3.calls,
+                          newsletter_calls=fakes.newsletter_calls)
+
+        if options['json']:
+            self.stdout.write(json.dumps(result))
+        else:
+            self.stdout.write(json.dumps(result, indent=2))
+
+    async def drive(self, post, options):
+        client = ASGIClient(headers={'authorization': f'Bearer {make_token()}'})
+        base = f'/api/v1/blogs/posts/{post.id}'
+        image = png_bytes()
+
+        async def send(i):
+            if options['endpoint'] == 'create-post':
+                response = await client.post_json('/api/v1/blogs/posts/create-post/', {
+                    'title': f'Load test {i}', 'content': 'Body', 'category': 'bench',
+                })
+            elif options['endpoint'] == 'image-upload':
+                response = await client.post_multipart(f'{base}/images/upload/', {
+                    'label': f'Figure {i}',
+                    'file': SimpleUploadedFile(f'{i}.png', image, content_type='image/png'),
+                })
+            else:
+                response = await client.post_json(f'{base}/comments/create/', {'content': f'Comment {i}'})
+            return response.status_code < 400
+
+        # Each sync view holds a thread for its whole duration, so the number of
+        # live threads shows how much a process pays per in-flight request.
+        peak_threads = threading.active_count()
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while True:
+                peak_threads = max(peak_threads, threading.active_count())
+                await asyncio.sleep(0.01)
+
+        sampler = asyncio.create_task(sample_threads())
+        latencies, errors, elapsed = await run_concurrently(send, options['requests'], options['concurrency'])
+        sampler.cancel()
+        await close_async_session()
+        return latencies, errors, elapsed, peak_threads
+
+    def compare(self, options):
+        results = []
+        for mode in ('sync', 'async'):
+            env = dict(os.environ, ASYNC_VIEWS='TRUE' if mode == 'async' else 'FALSE')
+            command = [
+                sys.executable, sys.argv[0], 'compare_async_load', '--json', '--mode', mode,
+                '--endpoint', options['endpoint'], '--requests', str(options['requests']),
+                '--concurrency', str(options['concurrency']), '--latency', str(options['latency']),
+            ]
+            output = subprocess.run(command, env=env, capture_output=True, text=True)
+            if output.returncode != 0:
+                raise CommandError(output.stderr)
+            results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+            return
+
+        columns = ['mode', 'requests', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_threads']
+        self.stdout.write(f"{options['endpoint']}: {options['requests']} requests, "
+                          f"concurrency {options['concurrency']}, {options['latency']} ms external latency")
+        self.stdout.write(''.join(f'{column:>15}' for column in columns))
+        for result in results:
+            self.stdout.write(''.join(f'{result[column]!s:>15}' for column in columns))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.schema import code_version, write_artifact
+
+
+class Command(BaseCommand):
+    help = "Write the OpenAPI schema for the current code version to OPENAPI_SCHEMA_DIR if it is not there yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate even if the artifact exists.")
+
+    def handle(self, *args, **options):
+        path = write_artifact(force=options['force'])
+        self.stdout.write(f"OpenAPI schema for code version {code_version()}: {path}")
@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import io
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from blog.broadcast import flush_pending
+from blog.clients import close_async_session
+from perf.bench import quiet_logging
+from perf.db import test_database
+from perf.fakes import LOCAL_BACKENDS, FakeServices
+from perf.loadtest import Seed, load_scenario, run_scenario, scenario_names
+
+
+class Command(BaseCommand):
+    help = (
+        "Run load-test scenarios (perf/scenarios/*.json) against the ASGI app in-process "
+        "with fake external services, reporting throughput, tail latency and error rates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help=f"Scenario names or JSON files (default: all of {', '.join(scenario_names())}).")
+        parser.add_argument('--output', help="Also write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        try:
+            scenarios = [load_scenario(name) for name in options['scenarios'] or scenario_names()]
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        # Imported here: building the ASGI app sets up routing for websockets too.
+        from api.asgi import application
+
+        config = {'vendor': connection.vendor, 'async_views': settings.ASYNC_VIEWS}
+        results = []
+        for scenario in scenarios:
+            with test_database(), override_settings(**LOCAL_BACKENDS), \
+                    FakeServices(latency=scenario['latency_ms'] / 1000):
+                seed = Seed(scenario)
+                with contextlib.redirect_stdout(io.StringIO()), quiet_logging():
+                    result = asyncio.run(self.run(scenario, seed, application))
+            results.append({**result, **config})
+            self.report(result)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+
+    async def run(self, scenario, seed, application):
+        try:
+            return await run_scenario(scenario, seed, application)
+        finally:
+            # Still inside LOCAL_BACKENDS: nothing may be left to push once it is restored.
+            await sync_to_async(flush_pending)()
+            await close_async_session()
+
+    def report(self, result):
+        self.stdout.write(
+            f"{result['scenario']}: {result['requests']} requests, {result['throughput_rps']} req/s, "
+            f"p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+            f"error rate {result['error_rate']:.2%}"
+        )
+        for action, stats in result['actions'].items():
+            self.stdout.write(
+                f"  {action:<14} {stats['requests']:>6} requests  p50 {stats['p50_ms']:>8} ms  "
+                f"p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  errors {stats['error_rate']:.2%}"
+            )
+        if 'websocket' in result:
+            ws = result['websocket']
+            self.stdout.write(
+                f"  websocket      {ws['connected']}/{ws['subscribers']} subscribers, {ws['frames']} frames, "
+                f"{ws['comment_events']} comment events, delivery ratio {ws['delivery_ratio']}"
+            )
@@ -0,0 +1,173 @@
+"""
+Content-addressed image storage.
+
+Uploads are stored under ``<PUBLIC_MEDIA_LOCATION>/sha256/<digest>``, so
+the same bytes always land on the same key. A MediaObject row per key
+counts the images that use it. Storing content that is already referenced
+and uploaded skips the S3 PUT, and deleting an image only drops a
+reference. The reference is taken before the PUT, and objects left with no
+references are removed by ``collect_unreferenced`` only after
+MEDIA_GC_GRACE seconds, so a concurrent upload never loses its object. A
+row is marked ``uploaded`` only after a PUT succeeds, so an upload racing
+one that fails PUTs the object itself instead of pointing at nothing.
+
+Objects uploaded before this scheme (``media/<post_id>/<name>``) have no
+row; ``release`` hands them back so the caller deletes them directly.
+
+``store`` runs every step. The async upload view calls them one by one
+instead, to keep network calls off the ORM thread: ``digest`` and ``put``
+touch only the file and S3, ``retain``, ``mark_uploaded`` and ``release``
+only the database.
+"""
+import hashlib
+import logging
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from PIL import Image as PILImage
+from api.timing import timed
+from .clients import delete_s3_objects, get_s3_client, s3_key
+from .models import MediaObject
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed objects never change, so browsers and CDNs may keep them for good.
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Image formats, as Pillow names them, that are stored, and the Content-Type
+# each is served with. It comes from the bytes, never from the client.
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+
+def content_key(digest):
+    return f'{settings.PUBLIC_MEDIA_LOCATION}/sha256/{digest}'
+
+
+def url_for(key):
+    return f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/{key}'
+
+
+def digest(file):
+    """(key, size) for `file`, hashed chunk by chunk; the file is rewound for the upload."""
+    sha = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    for chunk in file.chunks() if hasattr(file, 'chunks') else iter(lambda: file.read(1 << 16), b''):
+        sha.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return content_key(sha.hexdigest()), size
+
+
+def sniff(file):
+    """The Content-Type for the image in `file`, from its format as Pillow detects it; None if not one we store."""
+    try:
+        with PILImage.open(file) as image:
+            image_format = image.format
+    except (OSError, SyntaxError, ValueError):
+        image_format = None
+    file.seek(0)
+    return CONTENT_TYPES.get(image_format)
+
+
+def put(file, key, content_type=None):
+    extra_args = {'CacheControl': CACHE_CONTROL}
+    if content_type:
+        extra_args['ContentType'] = content_type
+    with timed('s3'):
+        get_s3_client().upload_fileobj(file, settings.AWS_STORAGE_BUCKET_NAME, key, ExtraArgs=extra_args)
+
+
+def store(file, content_type=None):
+    """
+    Store `file` for one more image and return its key. Content that is
+    already referenced is not uploaded again. Call ``release`` with the key
+    if the image is not saved after all.
+    """
+    key, size = digest(file)
+    if not retain(key, size):
+        try:
+            put(file, key, content_type)
+        except Exception:
+            release([key])
+            raise
+        mark_uploaded([key])
+    return key
+
+
+def retain(key, size):
+    """
+    Count one more image using `key`. Returns whether the object is already
+    stored; if not, the caller PUTs it and then calls ``mark_uploaded``.
+    """
+    now = timezone.now()
+    if MediaObject.objects.filter(key=key, refs__gt=0, uploaded=True).update(refs=F('refs') + 1, updated_at=now):
+        return True
+    # Unreferenced objects may be collected at any time, so they are uploaded again.
+    if MediaObject.objects.filter(key=key).update(refs=F('refs') + 1, updated_at=now):
+        return False
+    try:
+        with transaction.atomic():
+            MediaObject.objects.create(key=key, size=size, refs=1, updated_at=now)
+    except IntegrityError:
+        # Created by a concurrent upload of the same content
+        MediaObject.objects.filter(key=key).update(refs=F('refs') + 1, updated_at=now)
+    return False
+
+
+def mark_uploaded(keys):
+    """Record that the objects under `keys` have been written, so later uploads can skip the PUT."""
+    MediaObject.objects.filter(key__in=keys, uploaded=False).update(uploaded=True)
+
+
+def add_refs(keys, sign):
+    """Add (sign=1) or drop (sign=-1) one reference per entry in `keys`. Returns the keys with no row."""
+    counts = Counter(keys)
+    if not counts:
+        return []
+    tracked = set(MediaObject.objects.filter(key__in=counts).values_list('key', flat=True))
+    by_count = {}
+    for key in tracked:
+        by_count.setdefault(counts[key], []).append(key)
+    now = timezone.now()
+    for count, group in by_count.items():
+        MediaObject.objects.filter(key__in=group).update(refs=Greatest(F('refs') + sign * count, 0), updated_at=now)
+    return [key for key in counts if key not in tracked]
+
+
+def adopt(image_urls):
+    """Count the images created from `image_urls` (rather than an upload) that point at stored objects."""
+    add_refs([key for key in map(s3_key, image_urls) if key], 1)
+
+
+def release(keys):
+    """
+    Drop one reference per entry in `keys`. Returns the keys with no
+    MediaObject row: objects stored before deduplication, which no other
+    image shares and which the caller should delete itself.
+    """
+    return add_refs(keys, -1)
+
+
+def collect_unreferenced(batch_size=1000):
+    """Delete objects unreferenced for MEDIA_GC_GRACE seconds, from S3 and the table. Returns how many."""
+    cutoff = timezone.now() - timedelta(seconds=settings.MEDIA_GC_GRACE)
+    collected = 0
+    while True:
+        with transaction.atomic():
+            # Locked, so an upload retaining one of these waits and then creates it afresh.
+            rows = list(MediaObject.objects.select_for_update()
+                        .filter(refs=0, updated_at__lt=cutoff).values_list('pk', 'key')[:batch_size])
+            if not rows:
+                return collected
+            failed = set(delete_s3_objects([key for _, key in rows]))
+            if failed:
+                logger.error("S3 refused to delete %d unreferenced objects: %s", len(failed), sorted(failed)[:10])
+            MediaObject.objects.filter(pk__in=[pk for pk, key in rows if key not in failed]).delete()
+        collected += len(rows) - len(failed)
+        if failed:
+            # Try those again on the next run rather than spinning on them now.
+            return collected
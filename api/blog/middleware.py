@@ -1,140 +1,115 @@
-from django.http import JsonResponse
-import requests
+from channels.middleware import BaseMiddleware
+from urllib.parse import parse_qs
+from .auth import verify_token, averify_token, is_verified, user_data_from_token
+from .clients import ServiceError
+import asyncio
 import jwt
-import os
+import logging
 import re
-from dotenv import load_dotenv
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
+# Paths whose bearer token is not sent to SSO, matched against the whole path
+# without its trailing slash. The authen app and /metrics check their own tokens.
 NON_SECURE_PATHS = [
-    r"/api/v1/auth/logout",
-    r"/api/v1/auth/register",
-    r"/api/v1/auth/login",
-    r"/api/v1/blog/posts/",
-    r"/api/v1/blog/posts/\d+/details/", 
-    # r"/api/v1/blogs/posts/create-post/", 
-    # r"/api/v1/blogs/posts/\d+/images/upload/",
-    r"/api/v1/blog/posts/\d+/like/",     
-    r"/api/v1/blogs/posts/\d+/images/",   
-    r"/api/v1/blog/posts/\d+/comments/", 
-    r"/api/v1/blog/notifications/",
-    r"/api/v1/subscribe/",
-    r"/api/docs/",
+    r"/api/v1/authen/.*",
+    r"/api/docs(/.*)?",
+    r"/metrics",
 ]
 
-SSO_URL = os.getenv('SSO_URL')
-
 class JWTAuthenticationMiddleware:
+    """
+    Identify the caller from the SSO bearer token. A token the SSO service
+    accepts puts ``user_data`` and ``auth_token`` on the request; a request
+    without one, with one SSO rejects, or sent while SSO is unreachable is
+    served anonymously. No request is refused here: the views decide what
+    anonymous callers may do.
+    """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        # Under ASGI the rest of the stack is async, so run natively there
+        # instead of parking a worker thread on the SSO round trip.
+        self.async_mode = asyncio.iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
 
     def __call__(self, request):
-        path = request.path.rstrip('/')
-        print(f"\nProcessing request for path: {path}")
+        if self.async_mode:
+            return self.__acall__(request)
 
-        if self.should_skip_auth(path):
-            print(f"Skipping auth for path: {path}")
-            return self.get_response(request)
-        for pattern in NON_SECURE_PATHS:
-            if re.match(pattern, path):
-                print(f"Path {path} matches pattern {pattern}, skipping auth")
-            return self.get_response(request)
-    
-        print(f"Path {path} requires authentication")
-            
+        path = request.path.rstrip('/')
         token = self.extract_token(request)
-        if not token:
-            return JsonResponse({
-                "EC": -1,
-                "EM": "Bearer token is required",
-                "DT": ""
-            }, status=401)
-
-        try:
-            verify_url = SSO_URL
-            print(f"Verifying token at: {verify_url}")
-            
-            response = requests.post(
-                verify_url,
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": "application/json"
-                },
-                timeout=5
-            )
-            
-            data = response.json()
-            print(f"SSO Response Data: {data}")
+        if token and not self.should_skip_auth(path):
+            try:
+                self.identify(request, token, *verify_token(token))
+            except ServiceError as e:
+                logger.warning("SSO request failed; serving %s anonymously: %s", path, e)
+        return self.get_response(request)
 
-            if response.status_code == 200 and data.get("EC") == 1:
-                try:
-                    decoded = jwt.decode(token, options={"verify_signature": False})
-                    print(f"Decoded token: {decoded}")
-                    
-                    request.user_data = {
-                        'id': decoded.get('user_id'),
-                        'email': decoded.get('email'),
-                        'full_name': f"{decoded.get('first_name', '')} {decoded.get('last_name', '')}".strip(),
-                        'role': decoded.get('roleWithPermission', {}),
-                        'permissions': [
-                            perm['url'] for perm in decoded.get('roleWithPermission', {}).get('Permissions', [])
-                        ]
-                    }
-                    print(f"Attached user data: {request.user_data}")
-                    
-                    current_path = path.replace('/api/v1', '')
-                    if current_path in request.user_data['permissions']:
-                        print(f"User has permission for path: {current_path}")
-                        request.auth_token = token
-                        return self.get_response(request)
-                    else:
-                        print(f"User lacks permission for path: {current_path}")
-                        return JsonResponse({
-                            "EC": -1,
-                            "EM": "Permission denied",
-                            "DT": ""
-                        }, status=403)
-                    
-                except jwt.InvalidTokenError as e:
-                    print(f"Token decode error: {str(e)}")
-                    return JsonResponse({
-                        "EC": -1,
-                        "EM": "Invalid token format",
-                        "DT": ""
-                    }, status=401)
-            
-            return JsonResponse({
-                "EC": -1,
-                "EM": data.get("EM", "Invalid token"),
-                "DT": ""
-            }, status=401)
+    async def __acall__(self, request):
+        path = request.path.rstrip('/')
+        token = self.extract_token(request)
+        if token and not self.should_skip_auth(path):
+            try:
+                self.identify(request, token, *await averify_token(token))
+            except ServiceError as e:
+                logger.warning("SSO request failed; serving %s anonymously: %s", path, e)
+        return await self.get_response(request)
 
-        except requests.RequestException as e:
-            print(f"Request error: {str(e)}")
-            return JsonResponse({
-                "EC": -1,
-                "EM": f"SSO service error: {str(e)}",
-                "DT": ""
-            }, status=503)
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")
-            return JsonResponse({
-                "EC": -1,
-                "EM": f"Authentication error: {str(e)}",
-                "DT": ""
-            }, status=500)
+    def identify(self, request, token, status_code, data):
+        """Attach user data if SSO accepted `token`; otherwise the request stays anonymous."""
+        logger.debug("SSO responded %s with EC=%s", status_code, data.get("EC"))
+        if is_verified(status_code, data):
+            try:
+                request.user_data = user_data_from_token(token)
+                request.auth_token = token
+                logger.debug("Attached user data for user %s", request.user_data['id'])
+            except jwt.InvalidTokenError as e:
+                logger.warning("Token decode error: %s", e)
 
     def extract_token(self, request):
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             token = auth_header.split(" ")[1]
-            print(f"Extracted token: {token[:30]}...")
             return token
         return None
 
     def should_skip_auth(self, path):
-        for pattern in NON_SECURE_PATHS:
-            if re.match(pattern, path):
-                return True
-        return False
\ No newline at end of file
+        return any(re.fullmatch(pattern, path) for pattern in NON_SECURE_PATHS)
+
+
+class JWTWebSocketAuthMiddleware(BaseMiddleware):
+    """
+    Authenticate WebSocket connections with the SSO bearer token, taken from
+    the ``token`` query parameter or from the ``bearer, <token>`` subprotocol
+    pair. Verification goes through the same cached path as HTTP requests.
+
+    Sets ``scope['user_data']`` (None for anonymous sockets) and, when the
+    token came as a subprotocol, ``scope['auth_subprotocol']`` for the
+    consumer to echo back on accept.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        token, subprotocol = self.extract_token(scope)
+        scope['user_data'] = None
+        scope['auth_subprotocol'] = subprotocol
+        if token:
+            try:
+                status_code, data = await averify_token(token)
+                if is_verified(status_code, data):
+                    scope['user_data'] = user_data_from_token(token)
+            except (ServiceError, jwt.InvalidTokenError, ValueError):
+                pass
+        return await super().__call__(scope, receive, send)
+
+    def extract_token(self, scope):
+        subprotocols = scope.get('subprotocols') or []
+        if len(subprotocols) >= 2 and subprotocols[0].lower() == 'bearer':
+            return subprotocols[1], subprotocols[0]
+        query = parse_qs(scope.get('query_string', b'').decode())
+        tokens = query.get('token')
+        return (tokens[0], None) if tokens else (None, None)
@@ -0,0 +1,31 @@
+# Generated by Django 4.0 on 2026-10-19 15:22
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0004_post_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaObject',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveBigIntegerField()),
+                ('refs', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='mediaobject',
+            index=models.Index(fields=['refs', 'updated_at'], name='media_refs_updated_idx'),
+        ),
+    ]
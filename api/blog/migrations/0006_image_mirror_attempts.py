@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-19 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0005_mediaobject'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='mirror_attempts',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
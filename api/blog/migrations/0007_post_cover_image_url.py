@@ -0,0 +1,26 @@
+# Generated by Django 4.0 on 2026-10-19 15:29
+
+from django.db import migrations, models
+
+
+def set_covers(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    Image = apps.get_model('blog', 'Image')
+    first_image = Image.objects.filter(post_id=models.OuterRef('pk')).order_by('pk').values('image_url')[:1]
+    Post.objects.update(cover_image_url=models.Subquery(first_image))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0006_image_mirror_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='cover_image_url',
+            field=models.URLField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_covers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0 on 2026-10-19 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0007_post_cover_image_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediaobject',
+            name='uploaded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,263 @@
+"""
+Mirroring of crawled images into the media bucket.
+
+``update_news`` saves the ``img src`` URLs it finds as they are and marks
+those images with ``mirror_attempts=0``. ``mirror`` then downloads them
+MIRROR_WORKERS at a time, at most MIRROR_PER_HOST from any one host, stores
+each under its content hash (see blog.media) and points the images, and
+the covers of their posts, at our copy with one bulk UPDATE per batch. A
+URL used by several images is fetched once per run, and content that is
+already stored is not uploaded again.
+
+The URLs come from scraped HTML, so only http(s) URLs whose host resolves
+to public addresses are fetched, redirects included, and only JPEG, PNG,
+GIF and WebP content is kept, typed by what Pillow detects in the bytes.
+
+Only images still marked are read, so each crawl handles just what it
+added. An image that cannot be fetched keeps its original URL; the
+``mirror_crawled_images`` beat task tries it again, up to
+MIRROR_MAX_ATTEMPTS times in all.
+"""
+import hashlib
+import ipaddress
+import logging
+import socket
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, zip_longest
+from urllib.parse import urljoin, urlsplit
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, URLField, Value, When
+from . import media, post_cache
+from .clients import get_http_session, s3_key
+from .models import Image, Post
+
+logger = logging.getLogger(__name__)
+
+# Downloads are kept in memory up to this size, then spill to a temporary file
+SPOOL_SIZE = 1 << 20
+# Redirects followed per download; every hop is checked like the first URL
+MAX_REDIRECTS = 5
+
+
+class MirrorError(Exception):
+    """An image could not be downloaded, or what came back is not one we keep."""
+
+
+class HostLimits:
+    """A semaphore per host, so one slow CDN cannot take every download slot."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        host = urlsplit(url).hostname or ''
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.size)
+            return self.semaphores[host]
+
+
+def is_external(image_url):
+    """Whether `image_url` is an absolute http(s) URL outside the media bucket."""
+    return image_url.startswith(('http://', 'https://')) and \
+        not image_url.startswith(f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/')
+
+
+def interleave(urls):
+    """`urls` reordered to alternate between hosts, so workers rarely wait on the same host's limit."""
+    by_host = defaultdict(list)
+    for url in urls:
+        by_host[urlsplit(url).hostname].append(url)
+    return [url for url in chain.from_iterable(zip_longest(*by_host.values())) if url is not None]
+
+
+def check_host(url):
+    """Raise MirrorError unless `url` is http(s) and its host resolves only to public addresses."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise MirrorError(f"not an http(s) URL: {url}")
+    if settings.MIRROR_ALLOW_PRIVATE_HOSTS:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or parts.scheme,
+                                                               type=socket.SOCK_STREAM)}
+    except (socket.gaierror, UnicodeError, ValueError) as e:
+        raise MirrorError(f"cannot resolve {parts.hostname}: {e}") from e
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        ip = getattr(ip, 'ipv4_mapped', None) or ip
+        if not ip.is_global:
+            # Loopback, private, link-local (169.254.169.254) and the like
+            raise MirrorError(f"{parts.hostname} resolves to a non-public address ({ip})")
+
+
+def fetch(url):
+    """The streamed response for `url`, following redirects only to hosts ``check_host`` allows."""
+    session = get_http_session()
+    for _ in range(MAX_REDIRECTS + 1):
+        check_host(url)
+        response = session.get(url, stream=True, timeout=settings.MIRROR_TIMEOUT, allow_redirects=False)
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    raise MirrorError(f"more than {MAX_REDIRECTS} redirects")
+
+
+def download(url, host_limits):
+    """(key, size, content type, file) for the image at `url`; raises MirrorError."""
+    import requests
+    file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with host_limits(url), fetch(url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            if not content_type.startswith('image/'):
+                raise MirrorError(f"not an image ({content_type or 'no Content-Type'})")
+            for chunk in response.iter_content(1 << 16):
+                size += len(chunk)
+                if size > settings.MIRROR_MAX_BYTES:
+                    raise MirrorError(f"larger than {settings.MIRROR_MAX_BYTES} bytes")
+                sha.update(chunk)
+                file.write(chunk)
+        # The server's Content-Type is only a hint; the object is served as what the bytes are.
+        file.seek(0)
+        content_type = media.sniff(file)
+        if content_type is None:
+            raise MirrorError("not a JPEG, PNG, GIF or WebP image")
+    except requests.RequestException as e:
+        file.close()
+        raise MirrorError(e) from e
+    except MirrorError:
+        file.close()
+        raise
+    return media.content_key(sha.hexdigest()), size, content_type, file
+
+
+def upload(key, content_type, file):
+    try:
+        media.put(file, key, content_type)
+    finally:
+        file.close()
+
+
+def repoint_covers(new_urls, post_ids):
+    """Point the covers of `post_ids` that use a URL in `new_urls` at its replacement."""
+    post_ids = list(Post.all_objects.filter(pk__in=post_ids, cover_image_url__in=new_urls).values_list('pk', flat=True))
+    if not post_ids:
+        return
+    Post.all_objects.filter(pk__in=post_ids).update(cover_image_url=Case(
+        *[When(cover_image_url=url, then=Value(new_url)) for url, new_url in new_urls.items()],
+        default=F('cover_image_url'), output_field=URLField(),
+    ))
+    for post_id in post_ids:
+        post_cache.written(post_id)
+
+
+def mirror_batch(images, known):
+    """
+    Mirror `images`, (pk, image_url) pairs. `known` maps URLs mirrored
+    earlier in the run to (key, size) and is updated. Returns how many
+    images were mirrored and how many failed.
+    """
+    pks_by_url = defaultdict(list)
+    for pk, url in images:
+        pks_by_url[url].append(pk)
+    urls_by_key = defaultdict(list)
+    sizes = {}
+    failed = []
+    fetch = []
+    for url in pks_by_url:
+        if url in known:
+            key, sizes[key] = known[url]
+            # One reference per key for now, taken before any PUT so the collector
+            # leaves the object alone; the rest are added with the images below.
+            if key in urls_by_key or media.retain(key, sizes[key]):
+                urls_by_key[key].append(url)
+                continue
+            # Collected since it was mirrored, so it is fetched again.
+            media.release([key])
+        fetch.append(url)
+    with ThreadPoolExecutor(settings.MIRROR_WORKERS) as pool:
+        limits = HostLimits(settings.MIRROR_PER_HOST)
+        downloads = {pool.submit(download, url, limits): url for url in interleave(fetch)}
+        uploads = {}
+        for future in as_completed(downloads):
+            url = downloads[future]
+            try:
+                key, size, content_type, file = future.result()
+            except Exception as e:
+                logger.warning("Could not mirror %s: %s", url, e)
+                failed.extend(pks_by_url[url])
+                continue
+            duplicate = key in urls_by_key
+            urls_by_key[key].append(url)
+            sizes[key] = size
+            if duplicate or media.retain(key, size):
+                file.close()
+            else:
+                uploads[pool.submit(upload, key, content_type, file)] = key
+        uploaded = []
+        for future in as_completed(uploads):
+            key = uploads[future]
+            try:
+                future.result()
+            except Exception:
+                logger.warning("Could not upload %s", key, exc_info=True)
+                media.release([key])
+                failed.extend(pk for url in urls_by_key.pop(key) for pk in pks_by_url[url])
+            else:
+                uploaded.append(key)
+    media.mark_uploaded(uploaded)
+
+    wanted = {pk: (url, key) for key, urls in urls_by_key.items() for url in urls for pk in pks_by_url[url]}
+    with transaction.atomic():
+        # Locked so that no image is deleted or edited between this check and the update.
+        current = {pk: (url, post_id) for pk, url, post_id in Image.objects.select_for_update()
+                   .filter(pk__in=wanted).values_list('pk', 'image_url', 'post_id')}
+        mirrored = [Image(pk=pk, post_id=current[pk][1], image_url=media.url_for(key), mirror_attempts=None)
+                    for pk, (url, key) in wanted.items() if current.get(pk, (None,))[0] == url]
+        Image.objects.bulk_update(mirrored, ['image_url', 'mirror_attempts'])
+        repoint_covers({current[image.pk][0]: image.image_url for image in mirrored},
+                       {image.post_id for image in mirrored})
+        refs = Counter(s3_key(image.image_url) for image in mirrored)
+        media.add_refs([key for key, count in refs.items() for _ in range(count - 1)], 1)
+        media.release([key for key in urls_by_key if not refs[key]])
+        Image.objects.filter(pk__in=failed).update(mirror_attempts=F('mirror_attempts') + 1)
+    known.update((url, (key, sizes[key])) for key, urls in urls_by_key.items() for url in urls)
+    return {'mirrored': len(mirrored), 'failed': len(failed)}
+
+
+def mirror(image_ids=None):
+    """Mirror the pending images among `image_ids`, or every pending image. Returns counts."""
+    queryset = Image.objects.filter(mirror_attempts__lt=settings.MIRROR_MAX_ATTEMPTS).order_by('pk')
+    if image_ids is not None:
+        queryset = queryset.filter(pk__in=image_ids)
+    totals = Counter(mirrored=0, failed=0)
+    known = {}
+    last = 0
+    while True:
+        images = list(queryset.filter(pk__gt=last).values_list('pk', 'image_url')[:settings.MIRROR_BATCH_SIZE])
+        if not images:
+            return dict(totals)
+        totals.update(mirror_batch(images, known))
+        last = images[-1][0]
+
+
+def schedule(image_ids):
+    if not image_ids:
+        return
+    from .tasks import mirror_images
+    try:
+        mirror_images.delay(image_ids)
+    except Exception:
+        # The periodic task mirrors them instead.
+        logger.warning("Could not schedule mirroring of %d images", len(image_ids), exc_info=True)
@@ -1,6 +1,14 @@
-from django.db import models
-from django.conf import settings
-import boto3
+from django.db import models, transaction
+from django.utils import timezone
+from .clients import delete_s3_objects, s3_key
+
+
+class LivePostManager(models.Manager):
+    """Posts that have not been deleted; see blog.deletion."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 
 class Post(models.Model):
     title = models.CharField(max_length=255, null=False)
@@ -11,41 +19,95 @@ class Post(models.Model):
     user_email = models.EmailField(max_length=255, null=False, default="default@email.com")
     created_at = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
+    # Set when the post is deleted; the row and its children are purged in the background
+    deleted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # URL of the post's first image, kept by Image.save/delete so lists need not read images
+    cover_image_url = models.URLField(null=True, blank=True)
+
+    objects = LivePostManager()
+    all_objects = models.Manager()
 
     def __str__(self):
         return f'Post: {self.title} | by {self.user_name or "Anonymous"}'
     class Meta:
         managed = True
+        indexes = [
+            models.Index(fields=['-created_at'], name='post_created_idx'),
+            models.Index(fields=['category', '-created_at'], name='post_category_created_idx'),
+            models.Index(fields=['user_id', '-created_at'], name='post_user_created_idx'),
+            # update_news dedupes crawled articles by title
+            models.Index(fields=['title'], name='post_title_idx'),
+        ]
     
 class Image(models.Model):
     post = models.ForeignKey('Post', related_name='images', on_delete=models.CASCADE, null=True)
     image_url = models.URLField(null=False)
     label = models.CharField(max_length=255, blank=True)
+    # Failed attempts to copy a crawled image into the bucket (blog.mirror); None when
+    # there is nothing to copy
+    mirror_attempts = models.PositiveSmallIntegerField(null=True, blank=True, db_index=True)
 
     def save(self, *args, **kwargs):
         if not self.label and self.post:
             self.label = f"Figure: {self.post.title}"
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        if adding and self.post_id:
+            self.set_cover()
+
+    def set_cover(self):
+        """Make this the post's cover if it has none."""
+        from . import post_cache
+        if Post.all_objects.filter(pk=self.post_id, cover_image_url__isnull=True).update(cover_image_url=self.image_url):
+            if Image.post.is_cached(self):
+                self.post.cover_image_url = self.image_url
+            post_cache.written(self.post_id)
 
     def delete(self, *args, **kwargs):
-        if self.image_url:
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_REGION
-            )
-            bucket_name = settings.AWS_STORAGE_BUCKET_NAME
-            file_key = self.image_url.replace(f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/', '')
-            s3_client.delete_object(Bucket=bucket_name, Key=file_key)
-
-        super().delete(*args, **kwargs)
+        from . import media, post_cache
+        key = s3_key(self.image_url)
+        with transaction.atomic():
+            # Shared objects stay until their last image is gone (media.collect_unreferenced).
+            untracked = media.release([key]) if key else []
+            result = super().delete(*args, **kwargs)
+            # The next image becomes the cover, if this was it.
+            if Post.all_objects.filter(pk=self.post_id, cover_image_url=self.image_url).update(
+                    cover_image_url=first_image_url()):
+                post_cache.written(self.post_id)
+        if untracked:
+            delete_s3_objects(untracked)
+        return result
 
     def __str__(self):
         return self.label if self.label else f"Image for {self.post.title}"
     class Meta:
         managed = True
 
+def first_image_url():
+    """The URL of the first image of the post in the outer query, or NULL."""
+    return models.Subquery(
+        Image.objects.filter(post_id=models.OuterRef('pk')).order_by('pk').values('image_url')[:1]
+    )
+
+class MediaObject(models.Model):
+    """An S3 object stored under its content hash, and how many images use it."""
+    key = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    refs = models.PositiveIntegerField(default=0)
+    # Set once a PUT of the object has succeeded; until then every upload PUTs it
+    uploaded = models.BooleanField(default=False)
+    # Last change to refs; unreferenced objects are removed a grace period after it
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        managed = True
+        indexes = [
+            models.Index(fields=['refs', 'updated_at'], name='media_refs_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.refs} refs)"
+
 class Comment(models.Model):
     post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name="comments", null=False)
     content = models.TextField(null=False)
@@ -58,8 +120,19 @@ class Comment(models.Model):
     def __str__(self):
         return f"Comment by {self.commenter_name}"
 
+    def thread_size(self):
+        """Number of comments deleted along with this one, cascaded replies included."""
+        size, level = 0, [self.id]
+        while level:
+            size += len(level)
+            level = list(Comment.objects.filter(parent_id__in=level).values_list('id', flat=True))
+        return size
+
     class Meta:
         managed = True
+        indexes = [
+            models.Index(fields=['post', 'created_at'], name='comment_post_created_idx'),
+        ]
 
     
 class Like(models.Model):
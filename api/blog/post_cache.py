@@ -0,0 +1,221 @@
+"""
+Post rows by primary key, for the views that only need a post to check
+that it exists, who owns it or which id to attach a child row to.
+
+Lookups go through a small per-process LRU, then the shared cache (Redis),
+then the database. Saving or deleting a post drops it from the shared
+cache and from this process's LRU; other processes may keep serving their
+local copy for up to POST_CACHE_LOCAL_TTL seconds. Code that writes a
+post's own columns must re-read it from the database first.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+from api.metrics import registry
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+lookups = registry.counter(
+    'post_cache_lookups_total', "Post lookups by id, by the tier that answered", labels=('tier',)
+)
+
+
+class LocalCache:
+    """Thread-safe LRU of at most `size` entries, each kept for `ttl` seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_local = LocalCache(settings.POST_CACHE_LOCAL_SIZE, settings.POST_CACHE_LOCAL_TTL)
+
+
+def cache_key(post_id):
+    return f"post:v1:{post_id}"
+
+
+def field_names():
+    return [field.attname for field in Post._meta.concrete_fields]
+
+
+def to_row(post):
+    return {name: getattr(post, name) for name in field_names()}
+
+
+def from_row(row):
+    """A fresh Post from a cached row, or None if the row predates a schema change."""
+    names = field_names()
+    if set(row) != set(names):
+        return None
+    return Post.from_db(router.db_for_read(Post), names, [row[name] for name in names])
+
+
+def shared_get(post_id):
+    try:
+        return cache.get(cache_key(post_id))
+    except Exception:
+        logger.warning("Post cache unavailable", exc_info=True)
+        return None
+
+
+def shared_set(post_id, row):
+    try:
+        cache.set(cache_key(post_id), row, settings.POST_CACHE_TTL)
+    except Exception:
+        logger.warning("Post cache unavailable", exc_info=True)
+
+
+def shared_get_many(post_ids):
+    try:
+        found = cache.get_many([cache_key(post_id) for post_id in post_ids])
+    except Exception:
+        logger.warning("Post cache unavailable", exc_info=True)
+        return {}
+    return {post_id: found[cache_key(post_id)] for post_id in post_ids if cache_key(post_id) in found}
+
+
+def shared_set_many(rows):
+    try:
+        cache.set_many({cache_key(post_id): row for post_id, row in rows.items()}, settings.POST_CACHE_TTL)
+    except Exception:
+        logger.warning("Post cache unavailable", exc_info=True)
+
+
+def get_post(post_id):
+    """
+    The Post with primary key `post_id`, or None. Every call returns a new
+    instance, so callers may modify it without affecting other requests.
+    """
+    row = _local.get(post_id)
+    if row is not None:
+        post = from_row(row)
+        if post is not None:
+            lookups.inc(tier='local')
+            return post
+
+    row = shared_get(post_id)
+    if row is not None:
+        post = from_row(row)
+        if post is not None:
+            _local.set(post_id, row)
+            lookups.inc(tier='shared')
+            return post
+
+    lookups.inc(tier='db')
+    post = Post.objects.filter(pk=post_id).first()
+    if post is not None:
+        row = to_row(post)
+        _local.set(post_id, row)
+        shared_set(post_id, row)
+    return post
+
+
+def get_posts(post_ids):
+    """Posts for `post_ids` in the same order, skipping ids with no post; same tiers as get_post."""
+    posts = {}
+    for post_id in post_ids:
+        row = _local.get(post_id)
+        post = from_row(row) if row is not None else None
+        if post is not None:
+            posts[post_id] = post
+    lookups.inc(len(posts), tier='local')
+
+    missing = [post_id for post_id in post_ids if post_id not in posts]
+    if missing:
+        found = 0
+        for post_id, row in shared_get_many(missing).items():
+            post = from_row(row)
+            if post is not None:
+                posts[post_id] = post
+                _local.set(post_id, row)
+                found += 1
+        lookups.inc(found, tier='shared')
+
+    missing = [post_id for post_id in post_ids if post_id not in posts]
+    if missing:
+        lookups.inc(len(missing), tier='db')
+        rows = {}
+        for post_id, post in Post.objects.in_bulk(missing).items():
+            posts[post_id] = post
+            rows[post_id] = to_row(post)
+            _local.set(post_id, rows[post_id])
+        if rows:
+            shared_set_many(rows)
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+
+def get_post_or_404(post_id):
+    post = get_post(post_id)
+    if post is None:
+        raise Http404("No Post matches the given query.")
+    return post
+
+
+def invalidate(post_id):
+    _local.delete(post_id)
+    try:
+        cache.delete(cache_key(post_id))
+    except Exception:
+        logger.warning("Post cache unavailable", exc_info=True)
+
+
+def written(post_id):
+    """Invalidate a post whose row was just written, again once the write commits."""
+    invalidate(post_id)
+    # Until this transaction commits, other requests still read the old row
+    # and may cache it again; drop it once more when the write is visible.
+    transaction.on_commit(partial(invalidate, post_id))
+
+
+def clear_local():
+    """Forget every locally cached post; for tools that swap the database underneath."""
+    _local.clear()
+
+
+@receiver(post_save, sender=Post, dispatch_uid='post_cache_saved')
+@receiver(post_delete, sender=Post, dispatch_uid='post_cache_deleted')
+def post_changed(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    written(instance.pk)
@@ -0,0 +1,43 @@
+"""
+Viewer presence for post rooms. Each open ``ws/comments/<post_id>/`` socket
+is a member of the Redis sorted set ``presence:post_<id>``, scored by the
+time its membership lapses. Sockets refresh their entry while open, so
+entries left behind by crashed workers drop out after PRESENCE_TTL seconds.
+"""
+import logging
+import time
+import redis
+from django.conf import settings
+from api.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+
+def presence_key(post_id):
+    return f"presence:post_{post_id}"
+
+
+async def touch(post_id, channel_name):
+    """Add or refresh this socket's membership of the post's room."""
+    key = presence_key(post_id)
+    now = time.time()
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {channel_name: now + settings.PRESENCE_TTL})
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.expire(key, settings.PRESENCE_TTL)
+            await pipe.execute()
+    except redis.RedisError:
+        logger.warning("Could not update presence for post %s", post_id, exc_info=True)
+
+
+async def leave(post_id, channel_name):
+    try:
+        await get_async_redis().zrem(presence_key(post_id), channel_name)
+    except redis.RedisError:
+        logger.warning("Could not clear presence for post %s", post_id, exc_info=True)
+
+
+def viewer_count(post_id):
+    """Number of sockets currently viewing the post."""
+    return get_redis().zcount(presence_key(post_id), time.time(), '+inf')
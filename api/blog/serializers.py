@@ -1,39 +1,45 @@
 from rest_framework import serializers
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from .models import Post, Image, Comment, Like 
-import boto3
-from django.conf import settings
+from api.timing import TimedSerializerMixin
+from . import media
 
-class ImageSerializer(serializers.ModelSerializer):
+class ImageSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     file = serializers.ImageField(write_only=True, required=True)
     class Meta:
         model = Image
         fields = ['id', 'post', 'label', 'image_url', 'file']
         read_only_fields = ['image_url']
     
-    def create(self, validated_data):
-        file = validated_data.pop('file')
-        post = validated_data.get('post')
-        
-        s3_client = boto3.client('s3',
-                                 aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                                 aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,)
+    @staticmethod
+    def save_image(post, label, key):
+        """Create the Image for a stored object, giving its reference back if that fails."""
+        try:
+            return Image.objects.create(post=post, label=label, image_url=media.url_for(key))
+        except Exception:
+            media.release([key])
+            raise
 
-        folder = f'{post.id}'
-        
-        file_key = f"{settings.PUBLIC_MEDIA_LOCATION}/{folder}/{file.name}"
-        
-        s3_client.upload_fileobj(file, settings.AWS_STORAGE_BUCKET_NAME, file_key)
+    def validate_file(self, file):
+        # ImageField has already opened the file with Pillow
+        if file.image.format not in media.CONTENT_TYPES:
+            raise serializers.ValidationError(
+                f"Unsupported image format. Allowed formats: {', '.join(sorted(media.CONTENT_TYPES))}."
+            )
+        return file
 
-        image_url = f"https://{settings.AWS_S3_CUSTOM_DOMAIN}/{file_key}"
+    def create(self, validated_data):
+        file = validated_data.pop('file')
+        key = media.store(file, media.CONTENT_TYPES[file.image.format])
+        return self.save_image(validated_data.get('post'), validated_data.get('label', ''), key)
 
-        image = Image.objects.create(
-            post=post,
-            label=validated_data.get('label', ''),
-            image_url=image_url
-        )
-        return image
+def count_per_post(model):
+    """Rows of `model` for the post in the outer query."""
+    return (model.objects.filter(post_id=OuterRef('pk')).order_by()
+            .values('post_id').annotate(count=Count('pk')).values('count'))
 
-class PostSerializer(serializers.ModelSerializer):
+class PostSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     likes_count = serializers.IntegerField(source='likes.count', read_only=True)
     shares_count = serializers.IntegerField(source='shares.count', read_only=True)
     comments_count = serializers.IntegerField(source='comments.count', read_only=True)
@@ -46,7 +52,31 @@ class PostSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['created_at', 'last_modified']
 
-class CommentSerializer(serializers.ModelSerializer):
+class PostListSerializer(PostSerializer):
+    """A post in a feed; the counts come from ``with_counts`` annotations, so a page is one query."""
+    likes_count = serializers.IntegerField(read_only=True)
+    comments_count = serializers.IntegerField(read_only=True)
+    class Meta(PostSerializer.Meta):
+        fields = PostSerializer.Meta.fields + ['cover_image_url']
+
+    @staticmethod
+    def with_counts(queryset):
+        return queryset.annotate(
+            likes_count=Coalesce(Subquery(count_per_post(Like)), 0),
+            comments_count=Coalesce(Subquery(count_per_post(Comment)), 0),
+        )
+
+class TrendingPostSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """A post in the trending ranking; ``context['scores']`` maps post ids to scores."""
+    score = serializers.SerializerMethodField()
+    class Meta:
+        model = Post
+        fields = ['id', 'title', 'category', 'user_id', 'user_name', 'created_at', 'score']
+
+    def get_score(self, post):
+        return round(self.context['scores'][post.id], 3)
+
+class CommentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     parent = serializers.PrimaryKeyRelatedField(
         queryset=Comment.objects.all(),
         required=False,
@@ -62,7 +92,7 @@ class CommentSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['created_at', 'user_id', 'user_name', 'user_email']
 
-class LikeSerializer(serializers.ModelSerializer):
+class LikeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     created_at = serializers.DateTimeField(read_only=True)
     class Meta:
         model = Like
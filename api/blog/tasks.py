@@ -1,12 +1,14 @@
 from celery import shared_task
-import requests
-import pandas as pd
-from bs4 import BeautifulSoup
 from .models import Post, Image
+from . import deletion, media, mirror, trending
 from django.utils import timezone
 
 
 def get_new_posts(url="https://cafef.vn/bat-dong-san.chn"):
+    # Only the crawl needs these; the worker and beat start without them.
+    import requests
+    from bs4 import BeautifulSoup
+
     response = requests.get(url)
     
     if not response.text:
@@ -78,9 +80,13 @@ def get_new_posts(url="https://cafef.vn/bat-dong-san.chn"):
 @shared_task
 def update_news():
     posts = get_new_posts()
+    existing_titles = set(
+        Post.objects.filter(title__in=[data['title'] for data in posts]).values_list('title', flat=True)
+    )
 
+    image_ids = []
     for data in posts:
-        if Post.objects.filter(title=data['title']).exists():
+        if data['title'] in existing_titles:
             print(f"Post with title '{data['title']}' already exists. Skipping...")
             continue
 
@@ -93,6 +99,7 @@ def update_news():
                 user_email=f'{data['author']}.{data['source']}@ezmail.com',  # No real email
             )
         post.save()
+        existing_titles.add(post.title)
 
         image_urls = data['images'].split('[SEP]') 
         image_labels = data['labels'].split('[SEP]')
@@ -102,7 +109,45 @@ def update_news():
             image = Image(
                 post=post,
                 image_url=img_url,
-                label=label
+                label=label,
+                mirror_attempts=0 if mirror.is_external(img_url) else None,
             )
             image.save()
-        
\ No newline at end of file
+            if image.mirror_attempts is not None:
+                image_ids.append(image.pk)
+
+    mirror.schedule(image_ids)
+
+
+@shared_task
+def decay_trending():
+    return trending.decay()
+
+
+@shared_task(bind=True, max_retries=5)
+def purge_post(self, post_id):
+    try:
+        return deletion.purge(post_id)
+    except Exception as e:
+        # Whatever is left (S3 outage, lock timeout) is picked up again from where it stopped.
+        raise self.retry(exc=e, countdown=60 * 2 ** self.request.retries)
+
+
+@shared_task
+def purge_deleted_posts():
+    return deletion.purge_pending()
+
+
+@shared_task
+def collect_unreferenced_images():
+    return media.collect_unreferenced()
+
+
+@shared_task
+def mirror_images(image_ids):
+    return mirror.mirror(image_ids)
+
+
+@shared_task
+def mirror_crawled_images():
+    return mirror.mirror()
@@ -0,0 +1,1004 @@
+import asyncio
+import io
+import json
+import re
+from unittest import mock
+import fakeredis
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from datetime import timedelta
+from types import SimpleNamespace
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image as PILImage
+from perf.fakes import LOCAL_BACKENDS, FakeS3, FakeServices, make_token
+from . import async_views, broadcast, clients, consumers, deletion, media, mirror, post_cache, presence, routing, trending
+from .clients import ServiceError
+from .middleware import JWTWebSocketAuthMiddleware
+from .models import Post, Image, Comment, Like, MediaObject
+from .serializers import ImageSerializer
+
+CATEGORIES = ['Bất động sản', 'Tài chính', 'Chứng khoán', 'Doanh nghiệp', 'Vĩ mô']
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def image_bytes(image_format, color='white'):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (8, 8), color).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def query_plan(sql, params=()):
+    """EXPLAIN `sql` on the current backend; one entry per plan step."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute(f'EXPLAIN {sql}', params)
+        columns = [col[0] for col in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def full_scans(plan):
+    if connection.vendor == 'sqlite':
+        return [step for step in plan if step.startswith('SCAN ') and 'INDEX' not in step]
+    return [step for step in plan if step.get('type') == 'ALL']
+
+
+def websocket(path, **kwargs):
+    """A WebsocketCommunicator for `path` on the app's WebSocket stack, auth middleware included."""
+    return WebsocketCommunicator(JWTWebSocketAuthMiddleware(URLRouter(routing.websocket_urlpatterns)), path, **kwargs)
+
+
+def sorts(plan):
+    if connection.vendor == 'sqlite':
+        return [step for step in plan if 'TEMP B-TREE' in step]
+    return [step for step in plan if 'filesort' in (step.get('Extra') or '')]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class QueryPlanTestCase(TestCase):
+    """
+    Regression tests for the indexes behind the blog's read paths. The data
+    set is large enough that the planner picks a full scan or a sort
+    whenever no index fits, so a dropped index or a query that stops
+    matching one fails here instead of in production.
+    """
+
+    POSTS = 2000
+    COMMENTS_PER_POST = 5
+    LIKES_PER_POST = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        Post.objects.bulk_create([
+            Post(
+                title=f'Article {i}',
+                content='Nội dung',
+                category=CATEGORIES[i % len(CATEGORIES)],
+                user_id=f'user-{i % 100}',
+                user_name=f'User {i % 100}',
+                user_email=f'user{i % 100}@ezmail.com',
+            )
+            for i in range(cls.POSTS)
+        ], batch_size=500)
+        posts = list(Post.objects.order_by('id'))
+        # created_at is auto_now_add, so spread the rows out explicitly
+        for i, post in enumerate(posts):
+            post.created_at = now - timedelta(minutes=cls.POSTS - i)
+        Post.objects.bulk_update(posts, ['created_at'], batch_size=500)
+
+        Image.objects.bulk_create([
+            Image(post=post, label='cover', image_url=f'https://img.ezmail.com/{post.id}.jpg')
+            for post in posts
+        ], batch_size=500)
+        Comment.objects.bulk_create([
+            Comment(post=post, content='Bình luận', user_id=f'user-{n}',
+                    user_name=f'User {n}', user_email=f'user{n}@ezmail.com')
+            for post in posts for n in range(cls.COMMENTS_PER_POST)
+        ], batch_size=500)
+        Like.objects.bulk_create([
+            Like(post=post, user_id=f'user-{n}', user_name=f'User {n}', user_email=f'user{n}@ezmail.com')
+            for post in posts for n in range(cls.LIKES_PER_POST)
+        ], batch_size=500)
+
+        cls.post = posts[cls.POSTS // 2]
+        cls.comment = cls.post.comments.first()
+        Comment.objects.create(post=cls.post, parent=cls.comment, content='Trả lời', user_id='user-1',
+                               user_name='User 1', user_email='user1@ezmail.com')
+
+        # Give the planner real statistics, as a long-running database would have.
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+            else:
+                for model in (Post, Image, Comment, Like):
+                    cursor.execute(f'ANALYZE TABLE {model._meta.db_table}')
+
+    def setUp(self):
+        post_cache.clear_local()
+
+    def assertIndexed(self, queryset, ordered=False):
+        sql, params = queryset.query.sql_with_params()
+        plan = query_plan(sql, params)
+        self.assertEqual(full_scans(plan), [], f'{sql} scans a whole table: {plan}')
+        if ordered:
+            self.assertEqual(sorts(plan), [], f'{sql} sorts instead of reading an index: {plan}')
+
+    def assertStatementsIndexed(self, captured):
+        """Every filtered statement an endpoint issued must be served by an index."""
+        for query in captured:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or not re.search(r'\bWHERE\b', sql):
+                continue
+            plan = query_plan(sql)
+            self.assertEqual(full_scans(plan), [], f'{sql} scans a whole table: {plan}')
+
+    def get(self, name, expected_queries, indexed=True, **kwargs):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse(name, kwargs=kwargs))
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(captured), expected_queries, [q['sql'] for q in captured])
+        if indexed:
+            self.assertStatementsIndexed(captured)
+        return response
+
+    # Access patterns
+
+    def test_newest_posts(self):
+        self.assertIndexed(Post.objects.order_by('-created_at')[:20], ordered=True)
+
+    def test_posts_by_category(self):
+        self.assertIndexed(Post.objects.filter(category=CATEGORIES[1]).order_by('-created_at')[:20], ordered=True)
+
+    def test_posts_by_user(self):
+        self.assertIndexed(Post.objects.filter(user_id='user-7').order_by('-created_at')[:20], ordered=True)
+
+    def test_update_news_title_dedupe(self):
+        titles = ['Article 10', 'Article 1999', 'Not crawled yet']
+        self.assertIndexed(Post.objects.filter(title__in=titles).values_list('title', flat=True))
+
+    def test_post_comments_in_order(self):
+        self.assertIndexed(Comment.objects.filter(post=self.post).order_by('created_at'), ordered=True)
+
+    def test_existing_like_lookup(self):
+        self.assertIndexed(Like.objects.filter(user_id='user-1', post=self.post))
+
+    # Endpoints
+
+    def test_post_list_statements(self):
+        # a page of posts with their counts and cover in one statement
+        response = self.get('post-list', 1)
+        self.assertEqual(len(response.data['results']), 20)
+        first = response.data['results'][0]
+        self.assertEqual(first['title'], f'Article {self.POSTS - 1}')
+        self.assertEqual((first['likes_count'], first['comments_count']), (self.LIKES_PER_POST, self.COMMENTS_PER_POST))
+        self.assertIn('cover_image_url', first)
+
+        # the next page seeks on created_at instead of sorting the table
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['title'], f'Article {self.POSTS - 21}')
+        plan = query_plan(captured[0]['sql'])
+        self.assertEqual((full_scans(plan), sorts(plan)), ([], []), plan)
+
+    def test_post_details_statements(self):
+        self.get('post-details', 3, post_id=self.post.id)
+
+    def test_image_list_statements(self):
+        self.get('image-list', 2, post_id=self.post.id)
+
+    def test_comment_list_statements(self):
+        # post, comments, then one prefetch for every comment's replies
+        response = self.get('comment-list', 3, post_id=self.post.id)
+        self.assertEqual(len(response.data), self.COMMENTS_PER_POST + 1)
+        counts = {comment['id']: comment['replies_count'] for comment in response.data}
+        self.assertEqual(counts[self.comment.id], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PostCacheTestCase(TestCase):
+    def setUp(self):
+        # Rolled-back tests hand out the same post ids again
+        cache.clear()
+        post_cache.clear_local()
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0],
+                                        user_id='user-1')
+
+    def test_repeat_lookups_skip_the_database(self):
+        post_cache.get_post(self.post.id)
+        with self.assertNumQueries(0):
+            post = post_cache.get_post(self.post.id)
+        self.assertEqual((post.id, post.user_id, post.title), (self.post.id, 'user-1', 'Article'))
+
+    def test_shared_tier_refills_the_local_one(self):
+        post_cache.get_post(self.post.id)
+        post_cache.clear_local()
+        with self.assertNumQueries(0):
+            self.assertEqual(post_cache.get_post(self.post.id).id, self.post.id)
+
+    def test_lookups_return_independent_instances(self):
+        post_cache.get_post(self.post.id).title = 'Changed in another request'
+        self.assertEqual(post_cache.get_post(self.post.id).title, 'Article')
+
+    def test_save_and_delete_invalidate(self):
+        post_cache.get_post(self.post.id)
+        self.post.title = 'Edited'
+        self.post.save()
+        self.assertEqual(post_cache.get_post(self.post.id).title, 'Edited')
+
+        self.post.delete()
+        self.assertIsNone(post_cache.get_post(self.post.id))
+
+    def test_rows_cached_before_a_schema_change_are_ignored(self):
+        row = post_cache.to_row(self.post)
+        del row['category']
+        post_cache._local.set(self.post.id, row)
+        with self.assertNumQueries(1):
+            self.assertEqual(post_cache.get_post(self.post.id).category, CATEGORIES[0])
+
+    def test_endpoints_read_the_post_from_cache(self):
+        url = reverse('image-list', kwargs={'post_id': self.post.id})
+        self.client.get(url)
+        # Only the images query is left
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, POST_DELETE_QUEUE=False, AWS_STORAGE_BUCKET_NAME='bucket',
+                   AWS_S3_CUSTOM_DOMAIN='bucket.s3.local')
+class PostDeletionTestCase(TestCase):
+    IMAGES = 2500
+
+    def setUp(self):
+        cache.clear()
+        post_cache.clear_local()
+        self.s3 = FakeS3()
+        previous, clients._s3_client = clients._s3_client, self.s3
+        self.addCleanup(setattr, clients, '_s3_client', previous)
+
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0],
+                                        user_id='user-1')
+        Image.objects.bulk_create([
+            Image(post=self.post, label='figure', image_url=f'https://bucket.s3.local/media/{n}.png')
+            for n in range(self.IMAGES)
+        ] + [Image(post=self.post, label='crawled', image_url='https://cafef.vn/news.jpg')])
+        for n in range(self.IMAGES):
+            self.s3.objects[('bucket', f'media/{n}.png')] = b'png'
+        Like.objects.create(post=self.post, user_id='user-2')
+        root = Comment.objects.create(post=self.post, content='Bình luận', user_id='user-2')
+        Comment.objects.create(post=self.post, parent=root, content='Trả lời', user_id='user-3')
+
+    def test_deleted_post_is_hidden_at_once(self):
+        post_cache.get_post(self.post.id)
+        deletion.delete_post(post_cache.get_post(self.post.id))
+        self.assertIsNone(post_cache.get_post(self.post.id))
+        self.assertFalse(Post.objects.filter(pk=self.post.id).exists())
+        self.assertTrue(Post.all_objects.filter(pk=self.post.id).exists())
+
+    def test_purge_removes_children_and_batches_s3_deletes(self):
+        deletion.delete_post(self.post)
+        self.assertEqual(deletion.purge(self.post.id), {'images': self.IMAGES + 1, 'likes': 1, 'comments': 2})
+        self.assertEqual(self.s3.objects, {})
+        # 2500 keys in chunks of 500, at most 1000 keys per request
+        self.assertEqual(self.s3.calls, 5)
+        self.assertFalse(Post.all_objects.filter(pk=self.post.id).exists())
+        for model in (Image, Like, Comment):
+            self.assertFalse(model.objects.filter(post_id=self.post.id).exists())
+
+    def test_images_s3_refuses_to_delete_are_kept_for_a_retry(self):
+        deletion.delete_post(self.post)
+        self.s3.refuse.add('media/7.png')
+        with self.assertRaises(deletion.PurgeError):
+            deletion.purge(self.post.id)
+        self.assertEqual(list(Image.objects.filter(post=self.post).values_list('image_url', flat=True)),
+                         ['https://bucket.s3.local/media/7.png'])
+        self.assertEqual(list(self.s3.objects), [('bucket', 'media/7.png')])
+        self.assertTrue(Post.all_objects.filter(pk=self.post.id).exists())
+
+        self.s3.refuse.clear()
+        self.assertEqual(deletion.purge(self.post.id), {'images': 1, 'likes': 1, 'comments': 2})
+        self.assertEqual(self.s3.objects, {})
+
+    def test_purge_skips_trending_updates(self):
+        deletion.delete_post(self.post)
+        with mock.patch.object(trending, 'on_commit') as on_commit:
+            deletion.purge(self.post.id)
+        self.assertEqual([call.args[0] for call in on_commit.call_args_list], [trending.remove])
+
+    def test_purge_ignores_live_posts(self):
+        self.assertEqual(deletion.purge(self.post.id), {})
+        self.assertEqual(Image.objects.filter(post=self.post).count(), self.IMAGES + 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, AWS_STORAGE_BUCKET_NAME='bucket', AWS_S3_CUSTOM_DOMAIN='bucket.s3.local',
+                   PUBLIC_MEDIA_LOCATION='media', MEDIA_GC_GRACE=60)
+class MediaStorageTestCase(TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        previous, clients._s3_client = clients._s3_client, self.s3
+        self.addCleanup(setattr, clients, '_s3_client', previous)
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+
+    def upload(self, content, name='figure.png'):
+        key = media.store(SimpleUploadedFile(name, content, content_type='image/png'), 'image/png')
+        return Image.objects.create(post=self.post, image_url=media.url_for(key))
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(b'same bytes', 'a.png')
+        second = self.upload(b'same bytes', 'b.png')
+        self.upload(b'other bytes', 'a.png')
+        self.assertEqual(first.image_url, second.image_url)
+        self.assertEqual(self.s3.calls, 2)
+        self.assertEqual(len(self.s3.objects), 2)
+        self.assertEqual(MediaObject.objects.get(key=clients.s3_key(first.image_url)).refs, 2)
+
+    def test_objects_are_collected_after_their_last_image(self):
+        first, second = self.upload(b'same bytes'), self.upload(b'same bytes')
+        first.delete()
+        MediaObject.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(media.collect_unreferenced(), 0)
+        self.assertEqual(len(self.s3.objects), 1)
+
+        second.delete()
+        self.assertEqual(media.collect_unreferenced(), 0, "still within the grace period")
+        MediaObject.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(media.collect_unreferenced(), 1)
+        self.assertEqual(self.s3.objects, {})
+        self.assertFalse(MediaObject.objects.exists())
+
+    def test_unreferenced_content_is_uploaded_again(self):
+        image = self.upload(b'same bytes')
+        image.delete()
+        self.upload(b'same bytes')
+        self.assertEqual(self.s3.calls, 2)
+        self.assertEqual(MediaObject.objects.get().refs, 1)
+
+    def test_upload_racing_a_failed_put_stores_the_object(self):
+        file = SimpleUploadedFile('a.png', b'same bytes', content_type='image/png')
+        key, size = media.digest(file)
+        # A first upload has taken its reference but not finished its PUT
+        self.assertFalse(media.retain(key, size))
+        self.assertEqual(self.upload(b'same bytes').image_url, media.url_for(key))
+        media.release([key])  # the first PUT failed
+        self.assertIn(('bucket', key), self.s3.objects)
+        self.upload(b'same bytes')
+        self.assertEqual(self.s3.calls, 1)
+        self.assertEqual(MediaObject.objects.values_list('refs', 'uploaded').get(), (2, True))
+
+    def test_uploads_are_served_as_the_format_pillow_detects(self):
+        def upload(name, image_format, content_type):
+            file = SimpleUploadedFile(name, image_bytes(image_format), content_type=content_type)
+            return ImageSerializer(data={'post': self.post.id, 'file': file})
+
+        serializer = upload('page.png', 'PNG', 'text/html')
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        image = serializer.save()
+        self.assertEqual(self.s3.extra_args[('bucket', clients.s3_key(image.image_url))]['ContentType'], 'image/png')
+
+        serializer = upload('figure.bmp', 'BMP', 'image/bmp')
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('file', serializer.errors)
+
+    def test_objects_stored_before_deduplication_are_deleted_directly(self):
+        self.s3.objects[('bucket', 'media/1/legacy.png')] = b'png'
+        Image.objects.create(post=self.post, image_url='https://bucket.s3.local/media/1/legacy.png').delete()
+        self.assertEqual(self.s3.objects, {})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TRENDING_POST_WEIGHT=5, TRENDING_LIKE_WEIGHT=1, TRENDING_COMMENT_WEIGHT=3,
+                   TRENDING_MIN_SCORE=1)
+class TrendingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        post_cache.clear_local()
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.object(trending, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, model, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return model.objects.create(**kwargs)
+
+    def test_engagement_adds_and_removes_its_weight(self):
+        post = self.create(Post, title='Article', content='Nội dung', category=CATEGORIES[0])
+        other = self.create(Post, title='Other', content='Nội dung', category=CATEGORIES[1])
+        like = self.create(Like, post=post, user_id='user-1')
+        self.create(Comment, post=other, content='Bình luận', user_id='user-1')
+        self.assertEqual(trending.top(10), [(other.pk, 8), (post.pk, 6)])
+        self.assertEqual(trending.top(10, CATEGORIES[0]), [(post.pk, 6)])
+        with self.captureOnCommitCallbacks(execute=True):
+            like.delete()
+        self.assertEqual(trending.top(10, CATEGORIES[0]), [(post.pk, 5)])
+
+    def test_removals_do_not_bring_back_a_dropped_post(self):
+        post = self.create(Post, title='Article', content='Nội dung', category=CATEGORIES[0])
+        like = self.create(Like, post=post, user_id='user-1')
+        trending.remove(post.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            like.delete()
+        self.assertEqual((trending.top(10), trending.top(10, CATEGORIES[0])), ([], []))
+
+    def test_edited_category_moves_the_post(self):
+        post = self.create(Post, title='Article', content='Nội dung', category=CATEGORIES[0])
+        self.create(Like, post=post, user_id='user-1')
+        post.category = CATEGORIES[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            post.save()
+        self.assertEqual(trending.top(10, CATEGORIES[0]), [])
+        self.assertEqual(trending.top(10, CATEGORIES[1]), [(post.pk, 6)])
+        self.assertEqual(self.redis.hget(trending.CATEGORIES_KEY, post.pk), CATEGORIES[1])
+        # Later activity lands in the new category
+        self.create(Comment, post=post, content='Bình luận', user_id='user-1')
+        self.assertEqual(trending.top(10, CATEGORIES[1]), [(post.pk, 9)])
+
+    def test_decay_scales_scores_and_drops_quiet_posts(self):
+        quiet = self.create(Post, title='Quiet', content='Nội dung', category=CATEGORIES[0])
+        busy = self.create(Post, title='Busy', content='Nội dung', category=CATEGORIES[1])
+        for n in range(5):
+            self.create(Like, post=busy, user_id=f'user-{n}')
+        self.assertEqual(trending.decay(0.1), 1)
+        self.assertEqual(trending.top(10), [(busy.pk, 1.0)])
+        self.assertEqual(trending.top(10, CATEGORIES[0]), [])
+        self.assertIsNone(self.redis.hget(trending.CATEGORIES_KEY, quiet.pk))
+        self.assertEqual(self.redis.smembers(trending.KEYS_KEY),
+                         {trending.ALL_KEY, trending.ranking_key(CATEGORIES[1])})
+
+
+@override_settings(CACHES=LOCMEM_CACHES, AWS_S3_CUSTOM_DOMAIN='bucket.s3.local')
+class PostCoverTestCase(TestCase):
+    def setUp(self):
+        post_cache.clear_local()
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+
+    def cover(self):
+        return Post.objects.values_list('cover_image_url', flat=True).get(pk=self.post.pk)
+
+    def test_first_image_is_the_cover(self):
+        first = Image.objects.create(post=self.post, image_url='https://cafef.vn/1.jpg')
+        self.assertEqual(self.post.cover_image_url, first.image_url)
+        second = Image.objects.create(post=self.post, image_url='https://cafef.vn/2.jpg')
+        self.assertEqual(self.cover(), first.image_url)
+
+        first.delete()
+        self.assertEqual(self.cover(), second.image_url)
+        self.assertEqual(post_cache.get_post(self.post.pk).cover_image_url, second.image_url)
+        second.delete()
+        self.assertIsNone(self.cover())
+        third = Image.objects.create(post=self.post, image_url='https://cafef.vn/3.jpg')
+        self.assertEqual(self.cover(), third.image_url)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MIRROR_WORKERS=8, MIRROR_PER_HOST=2, MIRROR_MAX_ATTEMPTS=2, MIRROR_BATCH_SIZE=4)
+class MirrorTestCase(TestCase):
+    def setUp(self):
+        self.fakes = FakeServices(latency=0.02)
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.fakes.images = {
+            'a.png': ('image/png', image_bytes('PNG')),
+            'copy-of-a.png': ('image/png', image_bytes('PNG')),
+            'b.jpg': ('image/jpeg', image_bytes('JPEG')),
+            'page.html': ('text/html', b'<html></html>'),
+            'logo.svg': ('image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'),
+            'mislabelled.png': ('image/png', image_bytes('GIF')),
+        }
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+
+    def crawled(self, *names):
+        return [Image.objects.create(post=self.post, image_url=f'{self.fakes.url}/images/{name}', mirror_attempts=0)
+                for name in names]
+
+    def test_images_are_copied_once_per_content(self):
+        images = self.crawled('a.png', 'a.png', 'copy-of-a.png', 'b.jpg', 'b.jpg', 'a.png')
+        self.assertEqual(mirror.mirror(), {'mirrored': 6, 'failed': 0})
+        # Each URL is fetched once, each content stored once
+        self.assertEqual(self.fakes.image_calls, 3)
+        self.assertLessEqual(self.fakes.image_peak, 2)
+        self.assertEqual(len(self.fakes.s3.objects), 2)
+        for image in images:
+            image.refresh_from_db()
+            self.assertIsNone(image.mirror_attempts)
+            self.assertEqual(clients.s3_key(image.image_url).split('/')[:2], ['media', 'sha256'])
+        self.assertEqual(sorted(MediaObject.objects.values_list('refs', flat=True)), [2, 4])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.cover_image_url, images[0].image_url)
+        self.assertEqual(mirror.mirror(), {'mirrored': 0, 'failed': 0})
+        self.assertEqual(self.fakes.image_calls, 3)
+
+    def test_failed_images_keep_their_url_until_attempts_run_out(self):
+        missing, html = self.crawled('missing.png', 'page.html')
+        self.assertEqual(mirror.mirror(), {'mirrored': 0, 'failed': 2})
+        missing.refresh_from_db()
+        self.assertEqual(missing.mirror_attempts, 1)
+        self.assertEqual(missing.image_url, f'{self.fakes.url}/images/missing.png')
+        mirror.mirror()
+        self.assertEqual(mirror.mirror(), {'mirrored': 0, 'failed': 0})
+        self.assertEqual(self.fakes.image_calls, 4)
+        self.assertFalse(MediaObject.objects.exists())
+
+    def test_only_raster_images_are_kept_and_typed_by_content(self):
+        svg, gif = self.crawled('logo.svg', 'mislabelled.png')
+        self.assertEqual(mirror.mirror(), {'mirrored': 1, 'failed': 1})
+        gif.refresh_from_db()
+        self.assertEqual(self.fakes.s3.extra_args[('bench-bucket', clients.s3_key(gif.image_url))]['ContentType'],
+                         'image/gif')
+        svg.refresh_from_db()
+        self.assertEqual((svg.image_url, svg.mirror_attempts), (f'{self.fakes.url}/images/logo.svg', 1))
+
+    def test_private_addresses_are_refused(self):
+        for url in ('http://169.254.169.254/latest/meta-data/', 'http://127.0.0.1/a.png', 'http://10.1.2.3/a.png',
+                    'http://[::1]/a.png', 'http://[::ffff:127.0.0.1]/a.png', 'http://localhost/a.png',
+                    'file:///etc/passwd'):
+            with self.subTest(url=url), override_settings(MIRROR_ALLOW_PRIVATE_HOSTS=False), \
+                    self.assertRaises(mirror.MirrorError):
+                mirror.check_host(url)
+        with override_settings(MIRROR_ALLOW_PRIVATE_HOSTS=False):
+            self.crawled('a.png')
+            self.assertEqual(mirror.mirror(), {'mirrored': 0, 'failed': 1})
+        self.assertEqual(self.fakes.image_calls, 0)
+
+    def test_every_redirect_hop_is_checked(self):
+        image = Image.objects.create(post=self.post, image_url=f'{self.fakes.url}/redirect/a.png', mirror_attempts=0)
+        with mock.patch.object(mirror, 'check_host', wraps=mirror.check_host) as check_host:
+            self.assertEqual(mirror.mirror(), {'mirrored': 1, 'failed': 0})
+        self.assertEqual([call.args[0] for call in check_host.call_args_list],
+                         [image.image_url, f'{self.fakes.url}/images/a.png'])
+
+    def test_only_the_given_images_are_mirrored(self):
+        first, second = self.crawled('a.png', 'b.jpg')
+        self.assertEqual(mirror.mirror([second.pk]), {'mirrored': 1, 'failed': 0})
+        first.refresh_from_db()
+        self.assertEqual(first.mirror_attempts, 0)
+
+
+@override_settings(**LOCAL_BACKENDS)
+class AuthenticationMiddlewareTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+        self.create_url = reverse('post-create')
+        self.data = {'title': 'New post', 'content': 'Body', 'category': CATEGORIES[0]}
+
+    def auth(self, user_id='writer'):
+        return {'HTTP_AUTHORIZATION': f'Bearer {make_token(user_id=user_id)}'}
+
+    def test_requests_without_a_valid_token_are_anonymous(self):
+        response = self.client.post(self.create_url, self.data, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fakes.sso_calls, 0)
+        url = reverse('post-update-delete', kwargs={'post_id': self.post.id})
+        self.assertEqual(self.client.delete(url).status_code, 401)
+        self.assertEqual(self.client.delete(url, HTTP_AUTHORIZATION='Basic x').status_code, 401)
+
+    def test_verified_token_identifies_the_user(self):
+        response = self.client.post(self.create_url, self.data, content_type='application/json', **self.auth())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Post.objects.get(title='New post').user_id, 'writer')
+        self.assertEqual(self.fakes.sso_calls, 1)
+
+    def test_sso_failure_serves_the_request_anonymously(self):
+        url = reverse('like-post', kwargs={'post_id': self.post.id})
+        with override_settings(SSO_URL='http://127.0.0.1:1/verify'):
+            self.assertEqual(self.client.post(url, **self.auth()).status_code, 201)
+        self.assertEqual(list(Like.objects.values_list('user_id', flat=True)), ['anonymous'])
+
+    def test_public_routes_identify_a_token_holder(self):
+        url = reverse('like-post', kwargs={'post_id': self.post.id})
+        self.assertEqual(self.client.get(reverse('post-list')).status_code, 200)
+        self.assertEqual(self.client.post(url).status_code, 201)
+        self.assertEqual(self.client.post(url, **self.auth()).status_code, 201)
+        self.assertEqual(sorted(Like.objects.values_list('user_id', flat=True)), ['anonymous', 'writer'])
+
+    def test_only_the_author_may_change_a_post(self):
+        self.post.user_id = 'writer'
+        self.post.save()
+        url = reverse('post-update-delete', kwargs={'post_id': self.post.id})
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.delete(url, **self.auth(user_id='someone-else')).status_code, 403)
+        self.assertEqual(self.client.delete(url, **self.auth()).status_code, 204)
+
+    def test_authen_and_metrics_tokens_are_not_sent_to_sso(self):
+        self.client.post(reverse('login'), {}, content_type='application/json', **self.auth())
+        self.client.get('/metrics/', **self.auth())
+        self.assertEqual(self.fakes.sso_calls, 0)
+
+    async def test_non_json_sso_reply_serves_the_request_anonymously(self):
+        self.fakes.sso_reply = (502, '<html>Bad Gateway</html>')
+        with self.assertRaises(ServiceError):
+            await clients.averify_sso_token('token')
+        url = reverse('like-post', kwargs={'post_id': self.post.id})
+        response = await self.async_client.post(url, authorization=f'Bearer {make_token(user_id="writer")}')
+        self.assertEqual(response.status_code, 201)
+
+    def test_non_json_sso_reply_is_a_service_error(self):
+        self.fakes.sso_reply = (502, '<html>Bad Gateway</html>')
+        with self.assertRaises(ServiceError):
+            clients.verify_sso_token('token')
+
+    async def test_async_requests_are_identified(self):
+        token = make_token(user_id='writer')
+        # AsyncClient takes extra headers by their plain names
+        response = await self.async_client.post(self.create_url, self.data, content_type='application/json',
+                                                authorization=f'Bearer {token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.fakes.sso_calls, 1)
+
+
+class MetricsAccessTestCase(TestCase):
+    def test_metrics_need_the_scrape_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+        with override_settings(METRICS_TOKEN='scrape-token'):
+            response = self.client.get('/metrics/')
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-token')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'# TYPE', response.content)
+
+
+@override_settings(**LOCAL_BACKENDS)
+class AsyncViewsTestCase(TestCase):
+    """The async views called directly, as the middleware would hand them a request."""
+
+    def setUp(self):
+        cache.clear()
+        post_cache.clear_local()
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.factory = AsyncRequestFactory()
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+        self.writer = {'id': 'writer', 'full_name': 'Writer', 'email': 'writer@ezmail.com'}
+
+    def call(self, view, method, user_data=None, data=None, **kwargs):
+        request = getattr(self.factory, method)('/', data or {}, content_type='application/json')
+        if user_data:
+            request.user_data = user_data
+        response = async_to_sync(view.as_view())(request, **kwargs)
+        return response.status_code, json.loads(response.content or b'{}')
+
+    def test_create_post_publishes_the_first_image(self):
+        status_code, body = self.call(async_views.PostCreateView, 'post', self.writer, {
+            'title': 'New post', 'content': 'Body', 'category': CATEGORIES[0],
+            'images': [{'image_url': 'https://cafef.vn/1.jpg', 'label': 'one'},
+                       {'image_url': 'https://cafef.vn/2.jpg', 'label': 'two'}],
+        })
+        self.assertEqual(status_code, 200)
+        post = Post.objects.get(pk=body['DT']['id'])
+        self.assertEqual((post.user_id, post.cover_image_url), ('writer', 'https://cafef.vn/1.jpg'))
+        self.assertEqual(post.images.count(), 2)
+        self.assertEqual(self.fakes.newsletter_calls, 1)
+
+    def test_invalid_post_is_rejected(self):
+        status_code, body = self.call(async_views.PostCreateView, 'post', self.writer, {'title': 'No body'})
+        self.assertEqual(status_code, 400)
+        self.assertIn('content', body)
+        self.assertEqual(self.fakes.newsletter_calls, 0)
+
+    def test_comments_are_changed_by_their_author_only(self):
+        kwargs = {'post_id': self.post.id}
+        status_code, body = self.call(async_views.CommentCreateView, 'post', self.writer, {'content': 'Bình luận'},
+                                      **kwargs)
+        self.assertEqual(status_code, 201)
+        kwargs['comment_id'] = body['id']
+        other = {'id': 'other', 'full_name': 'Other', 'email': 'other@ezmail.com'}
+
+        self.assertEqual(self.call(async_views.CommentUpdateDeleteView, 'put', other, {'content': 'x'}, **kwargs)[0],
+                         403)
+        status_code, body = self.call(async_views.CommentUpdateDeleteView, 'put', self.writer, {'content': 'Sửa'},
+                                      **kwargs)
+        self.assertEqual((status_code, body.get('content')), (200, 'Sửa'), body)
+        self.assertEqual(self.call(async_views.CommentUpdateDeleteView, 'delete', **kwargs)[0], 403)
+        self.assertEqual(self.call(async_views.CommentUpdateDeleteView, 'delete', self.writer, **kwargs)[0], 204)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_failed_comment_delete_is_not_broadcast(self):
+        comment = Comment.objects.create(post=self.post, content='Bình luận', user_id='writer')
+        with mock.patch.object(Comment, 'delete', side_effect=DatabaseError), \
+                mock.patch('blog.broadcast.comment_broadcaster.publish') as publish, \
+                self.captureOnCommitCallbacks(execute=True) as callbacks, self.assertRaises(DatabaseError):
+            self.call(async_views.CommentUpdateDeleteView, 'delete', self.writer, post_id=self.post.id,
+                      comment_id=comment.id)
+        self.assertEqual((callbacks, publish.call_count), ([], 0))
+
+    def test_likes(self):
+        kwargs = {'post_id': self.post.id}
+        self.assertEqual(self.call(async_views.LikeCreateDeleteView, 'post', self.writer, **kwargs)[0], 201)
+        self.assertEqual(self.call(async_views.LikeCreateDeleteView, 'post', self.writer, **kwargs)[0], 400)
+        self.assertEqual(self.call(async_views.LikeCreateDeleteView, 'delete', **kwargs)[0], 401)
+        self.assertEqual(self.call(async_views.LikeCreateDeleteView, 'delete', self.writer, **kwargs)[0], 204)
+        self.assertEqual(self.call(async_views.LikeCreateDeleteView, 'post', post_id=0)[0], 404)
+
+
+@override_settings(**LOCAL_BACKENDS)
+class CommentBroadcastTestCase(TestCase):
+    def setUp(self):
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.post = Post.objects.create(title='Article', content='Nội dung', category=CATEGORIES[0])
+        # The tests flush by hand instead of racing the timer.
+        self.broadcaster = broadcast.CommentBroadcaster(interval=60, hot_threshold=2)
+        patcher = mock.patch.object(broadcast, 'comment_broadcaster', self.broadcaster)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cancel_flush)
+
+    def cancel_flush(self):
+        if self.broadcaster.timer is not None:
+            self.broadcaster.timer.cancel()
+
+    def broadcast(self, *contents):
+        """Broadcast a "created" event per content; returns the on_commit callbacks, not yet run."""
+        with self.captureOnCommitCallbacks() as callbacks:
+            for content in contents:
+                broadcast.broadcast_comment(self.post.id, 'created', {'content': content})
+        return callbacks
+
+    def commit(self, callbacks):
+        for callback in callbacks:
+            callback()
+
+    def test_events_are_pushed_once_committed(self):
+        async def scenario():
+            socket = websocket(f'/ws/comments/{self.post.id}/')
+            self.assertTrue((await socket.connect())[0])
+            callbacks = await sync_to_async(self.broadcast)('Bình luận')
+            self.assertTrue(await socket.receive_nothing())
+            await sync_to_async(self.commit)(callbacks)
+            self.assertEqual(await socket.receive_json_from(),
+                             {'type': 'comment', 'action': 'created', 'data': {'content': 'Bình luận'}})
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_hot_post_events_are_batched_until_flushed(self):
+        async def scenario():
+            socket = websocket(f'/ws/comments/{self.post.id}/')
+            self.assertTrue((await socket.connect())[0])
+            await sync_to_async(self.commit)(await sync_to_async(self.broadcast)('1', '2', '3', '4'))
+            for content in ('1', '2'):
+                self.assertEqual((await socket.receive_json_from())['data'], {'content': content})
+            # Past the threshold events wait for the flush.
+            self.assertTrue(await socket.receive_nothing())
+            self.assertIsNotNone(self.broadcaster.timer)
+            await sync_to_async(self.broadcaster.close)()
+            self.assertEqual(await socket.receive_json_from(), {'type': 'comment_batch', 'events': [
+                {'action': 'created', 'data': {'content': '3'}},
+                {'action': 'created', 'data': {'content': '4'}},
+            ]})
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+
+@override_settings(**LOCAL_BACKENDS, COUNTER_MAX_SUBSCRIPTIONS=3)
+class CountSubscriptionTestCase(TestCase):
+    def setUp(self):
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.aggregator = broadcast.CounterAggregator(interval=60)
+
+    def test_subscriptions_are_capped(self):
+        async def scenario():
+            socket = websocket('/ws/counts/')
+            self.assertTrue((await socket.connect())[0])
+            await socket.send_json_to({'action': 'subscribe_counts', 'post_ids': [12, '3', 'x', 3]})
+            self.assertEqual(await socket.receive_json_from(), {'type': 'subscribed_counts', 'post_ids': ['3', '12']})
+            await socket.send_json_to({'action': 'subscribe_counts', 'post_ids': [7, 5]})
+            self.assertEqual(await socket.receive_json_from(),
+                             {'type': 'subscribed_counts', 'post_ids': ['3', '5', '12']})
+            await socket.send_json_to({'action': 'unsubscribe_counts', 'post_ids': [12]})
+            await socket.send_json_to({'action': 'subscribe_counts', 'post_ids': [7]})
+            self.assertEqual(await socket.receive_json_from(),
+                             {'type': 'subscribed_counts', 'post_ids': ['3', '5', '7']})
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_deltas_are_summed_per_post(self):
+        async def scenario():
+            socket = websocket('/ws/counts/')
+            self.assertTrue((await socket.connect())[0])
+            await socket.send_json_to({'action': 'subscribe_counts', 'post_ids': [1, 2]})
+            await socket.receive_json_from()
+            for post_id, field, delta in [(1, 'likes', 1), (1, 'likes', 1), (1, 'likes', 1), (1, 'likes', -1),
+                                          (1, 'comments', 1), (2, 'likes', 1), (2, 'likes', -1)]:
+                self.aggregator.add(post_id, field, delta)
+            self.assertTrue(await socket.receive_nothing())
+            await sync_to_async(self.aggregator.close)()
+            self.assertEqual(await socket.receive_json_from(),
+                             {'type': 'counts', 'post_id': 1, 'deltas': {'likes': 2, 'comments': 1}})
+            # Post 2 netted out, so it sends nothing.
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_counts_sockets_get_only_counts(self):
+        async def scenario():
+            room = websocket('/ws/comments/1/')
+            counts = websocket('/ws/counts/')
+            self.assertTrue((await room.connect())[0])
+            self.assertTrue((await counts.connect())[0])
+            await counts.send_json_to({'action': 'subscribe_counts', 'post_ids': [1]})
+            await counts.receive_json_from()
+
+            await room.send_json_to({'action': 'new_notification', 'notification_data': {'text': 'Xin chào'}})
+            self.assertEqual(await room.receive_json_from(), {'type': 'notification', 'data': {'text': 'Xin chào'}})
+            await sync_to_async(broadcast.comment_broadcaster.publish)(1, {'action': 'created', 'comment_data': {}})
+            self.assertEqual((await room.receive_json_from())['type'], 'comment')
+            self.aggregator.add(1, 'likes', 1)
+            await sync_to_async(self.aggregator.close)()
+            self.assertEqual((await room.receive_json_from())['type'], 'counts')
+
+            self.assertEqual((await counts.receive_json_from())['type'], 'counts')
+            self.assertTrue(await counts.receive_nothing())
+            await room.disconnect()
+            await counts.disconnect()
+
+        async_to_sync(scenario)()
+
+
+@override_settings(**LOCAL_BACKENDS)
+class NotificationSocketTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+
+    def connect(self, path, **kwargs):
+        async def scenario():
+            socket = websocket(path, **kwargs)
+            result = await socket.connect()
+            await socket.disconnect()
+            await clients.close_async_session()
+            return result
+
+        return async_to_sync(scenario)()
+
+    def test_sockets_without_a_valid_token_are_refused(self):
+        self.assertEqual(self.connect('/ws/notifications/writer/'), (False, 4401))
+        self.assertEqual(self.connect('/ws/notifications/writer/?token=not-a-jwt'), (False, 4401))
+        self.fakes.sso_reply = (401, 'Unauthorized')
+        self.assertEqual(self.connect(f'/ws/notifications/writer/?token={make_token(user_id="writer")}'),
+                         (False, 4401))
+
+    def test_sockets_are_limited_to_their_own_user(self):
+        token = make_token(user_id='writer')
+        self.assertEqual(self.connect(f'/ws/notifications/other/?token={token}'), (False, 4403))
+        self.assertEqual(self.connect(f'/ws/notifications/writer/?token={token}'), (True, None))
+        self.assertEqual(self.connect('/ws/notifications/writer/', subprotocols=['bearer', token]), (True, 'bearer'))
+
+    def test_notifications_reach_the_users_socket(self):
+        async def scenario():
+            socket = websocket(f'/ws/notifications/writer/?token={make_token(user_id="writer")}')
+            self.assertTrue((await socket.connect())[0])
+            await get_channel_layer().group_send('user_writer', {'type': 'send_notification', 'message': 'Hi'})
+            self.assertEqual(await socket.receive_json_from(), {'message': 'Hi'})
+            await socket.disconnect()
+            await clients.close_async_session()
+
+        async_to_sync(scenario)()
+
+
+class RecordingSocket:
+    """Stands in for AsyncWebsocketConsumer: records the frames written and the close code."""
+
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.sent.append(text_data)
+
+    async def close(self, code=None):
+        self.close_code = code
+
+
+class QueuedSocket(consumers.BoundedSendMixin, RecordingSocket):
+    pass
+
+
+@override_settings(WS_SEND_QUEUE_SIZE=2)
+class SendQueueTestCase(TestCase):
+    def overflow(self, policy):
+        """Send three frames to a socket whose queue is not drained; returns it and the frames left queued."""
+        async def scenario():
+            socket = QueuedSocket()
+            socket.send_queue = asyncio.Queue(maxsize=2)
+            for frame in ('1', '2', '3'):
+                await socket.send(text_data=frame)
+            queued = []
+            while socket.send_queue is not None and not socket.send_queue.empty():
+                queued.append(socket.send_queue.get_nowait()[0])
+            return socket, queued
+
+        before = consumers.overflowed_frames.values.get((policy,), 0)
+        with override_settings(WS_OVERFLOW_POLICY=policy):
+            socket, queued = async_to_sync(scenario)()
+        self.assertEqual(consumers.overflowed_frames.values[(policy,)] - before, 1)
+        return socket, queued
+
+    def test_drop_oldest(self):
+        socket, queued = self.overflow('drop_oldest')
+        self.assertEqual((queued, socket.close_code), (['2', '3'], None))
+
+    def test_drop_newest(self):
+        socket, queued = self.overflow('drop_newest')
+        self.assertEqual((queued, socket.close_code), (['1', '2'], None))
+
+    def test_close(self):
+        socket, queued = self.overflow('close')
+        self.assertEqual((queued, socket.close_code, socket.send_queue), ([], 4008, None))
+
+    def test_queued_frames_are_sent_in_order(self):
+        async def scenario():
+            socket = QueuedSocket()
+            socket.start_sending()
+            for frame in ('1', '2'):
+                await socket.send(text_data=frame)
+            while not socket.send_queue.empty():
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            socket.stop_sending()
+            return socket.sent
+
+        self.assertEqual(async_to_sync(scenario)(), ['1', '2'])
+
+
+@override_settings(**LOCAL_BACKENDS, PRESENCE_TTL=30)
+class PresenceTestCase(TestCase):
+    def setUp(self):
+        self.fakes = FakeServices()
+        self.fakes.__enter__()
+        self.addCleanup(self.fakes.__exit__, None, None, None)
+        self.now = 1000.0
+        patcher = mock.patch.object(presence, 'time', SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def touch(self, channel_name):
+        async_to_sync(presence.touch)(7, channel_name)
+
+    def test_members_expire_unless_refreshed(self):
+        self.touch('a')
+        self.touch('b')
+        self.assertEqual(presence.viewer_count(7), 2)
+        self.now += 20
+        self.touch('a')
+        self.now += 15
+        self.assertEqual(presence.viewer_count(7), 1)
+        # A later touch also drops the lapsed member from the set.
+        self.touch('a')
+        self.assertEqual(presence.get_redis().zcard(presence.presence_key(7)), 1)
+        self.now += 31
+        self.assertEqual(presence.viewer_count(7), 0)
+
+    def test_sockets_join_and_leave_the_room(self):
+        async def scenario():
+            socket = websocket('/ws/comments/7/')
+            self.assertTrue((await socket.connect())[0])
+            joined = await sync_to_async(presence.viewer_count)(7)
+            await socket.disconnect()
+            return joined, await sync_to_async(presence.viewer_count)(7)
+
+        self.assertEqual(async_to_sync(scenario)(), (1, 0))
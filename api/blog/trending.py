@@ -0,0 +1,199 @@
+"""
+Trending posts, ranked in Redis sorted sets: ``trending:all`` and one
+``trending:category:<name>`` per category. A new post starts with
+TRENDING_POST_WEIGHT; each like and comment adds its weight to the post's
+score once committed, and removing one takes it off again. Editing a
+post's category moves it to the new category's ranking with its score. The
+``decay_trending`` task scales every score by the decay over the elapsed
+interval, so older activity counts for less and quiet posts drop out.
+
+Reading the top N is a ZREVRANGE, O(log n + N); ranking never touches MySQL.
+"""
+import contextvars
+import logging
+from contextlib import contextmanager
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from api.redis_client import get_redis
+from . import post_cache
+from .models import Post, Like, Comment
+
+logger = logging.getLogger(__name__)
+
+ALL_KEY = 'trending:all'
+CATEGORY_PREFIX = 'trending:category:'
+# post id -> category, so like/comment updates find the category ranking without a query
+CATEGORIES_KEY = 'trending:categories'
+# every ranking key, for the decay task
+KEYS_KEY = 'trending:keys'
+
+_suspended = contextvars.ContextVar('trending_suspended', default=False)
+
+# Add a weight to a post's score in the overall and its category ranking.
+# Removals (negative weights) never bring back a post that already dropped
+# out. Returns 0 when the post's category is unknown and was not passed.
+RECORD = """
+local member, weight, category = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+if weight < 0 and not redis.call('ZSCORE', KEYS[1], member) then
+    return 1
+end
+if category == '' then
+    category = redis.call('HGET', KEYS[2], member)
+    if not category then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[2], member, category)
+local category_key = ARGV[4] .. category
+redis.call('SADD', KEYS[3], KEYS[1], category_key)
+for _, key in ipairs({KEYS[1], category_key}) do
+    if tonumber(redis.call('ZINCRBY', key, weight, member)) <= 0 then
+        redis.call('ZREM', key, member)
+    end
+end
+return 1
+"""
+
+REMOVE = """
+local category = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[1], ARGV[1])
+if category then
+    redis.call('ZREM', ARGV[2] .. category, ARGV[1])
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+# Move a ranked post to the ranking of category ARGV[2], keeping its score.
+# Returns 0 when the post is not tracked or already in that category.
+MOVE = """
+local member, category = ARGV[1], ARGV[2]
+local previous = redis.call('HGET', KEYS[2], member)
+if not previous or previous == category then
+    return 0
+end
+redis.call('HSET', KEYS[2], member, category)
+redis.call('ZREM', ARGV[3] .. previous, member)
+local score = redis.call('ZSCORE', KEYS[1], member)
+if score then
+    local category_key = ARGV[3] .. category
+    redis.call('ZADD', category_key, score, member)
+    redis.call('SADD', KEYS[3], category_key)
+end
+return 1
+"""
+
+
+def run(source, keys, args):
+    # register_script only hashes the source; EVALSHA falls back to EVAL once per server.
+    return get_redis().register_script(source)(keys=keys, args=args)
+
+
+def ranking_key(category=None):
+    return f'{CATEGORY_PREFIX}{category}' if category else ALL_KEY
+
+
+def record(post_id, weight, category=''):
+    keys = [ALL_KEY, CATEGORIES_KEY, KEYS_KEY]
+    args = [post_id, weight, category or '', CATEGORY_PREFIX]
+    if not run(RECORD, keys, args) and weight > 0:
+        # First activity on a post created before it was ranked.
+        post = post_cache.get_post(post_id)
+        if post is not None:
+            run(RECORD, keys, [post_id, weight, post.category, CATEGORY_PREFIX])
+
+
+def move(post_id, category):
+    if category:
+        run(MOVE, [ALL_KEY, CATEGORIES_KEY, KEYS_KEY], [post_id, category, CATEGORY_PREFIX])
+
+
+def remove(post_id):
+    run(REMOVE, [ALL_KEY, CATEGORIES_KEY], [post_id, CATEGORY_PREFIX])
+
+
+def top(limit, category=None):
+    """The `limit` highest-scoring (post_id, score) pairs, best first."""
+    entries = get_redis().zrevrange(ranking_key(category), 0, limit - 1, withscores=True)
+    return [(int(member), score) for member, score in entries]
+
+
+def decay_factor(interval=None):
+    interval = settings.TRENDING_DECAY_INTERVAL if interval is None else interval
+    return 0.5 ** (interval / settings.TRENDING_HALF_LIFE)
+
+
+def decay(factor=None):
+    """Scale every score by `factor` and drop posts below TRENDING_MIN_SCORE. Returns how many dropped out."""
+    factor = decay_factor() if factor is None else factor
+    client = get_redis()
+    dropped = client.zrangebyscore(ALL_KEY, '-inf', f'({settings.TRENDING_MIN_SCORE / factor}')
+    for key in client.smembers(KEYS_KEY):
+        with client.pipeline() as pipe:
+            # ZUNIONSTORE of a set with itself rescales it in place, server-side.
+            pipe.zunionstore(key, {key: factor})
+            pipe.zremrangebyscore(key, '-inf', f'({settings.TRENDING_MIN_SCORE}')
+            pipe.exists(key)
+            *_, exists = pipe.execute()
+        if not exists:
+            client.srem(KEYS_KEY, key)
+    if dropped:
+        client.hdel(CATEGORIES_KEY, *dropped)
+    return len(dropped)
+
+
+def on_commit(function, *args):
+    def apply():
+        try:
+            function(*args)
+        except redis.RedisError:
+            # The write is committed; the ranking catches up with later activity.
+            logger.warning("Could not update trending scores", exc_info=True)
+    transaction.on_commit(apply)
+
+
+@contextmanager
+def suspended():
+    """Ignore like and comment changes in this context, e.g. while purging a post that already left the rankings."""
+    token = _suspended.set(True)
+    try:
+        yield
+    finally:
+        _suspended.reset(token)
+
+
+@receiver(post_save, sender=Post, dispatch_uid='trending_post_saved')
+def post_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if created:
+        on_commit(record, instance.pk, settings.TRENDING_POST_WEIGHT, instance.category)
+    elif instance.deleted_at is not None:
+        on_commit(remove, instance.pk)
+    elif update_fields is None or 'category' in update_fields:
+        # The category may have been edited; the script leaves the post alone if not.
+        on_commit(move, instance.pk, instance.category)
+
+
+@receiver(post_delete, sender=Post, dispatch_uid='trending_post_deleted')
+def post_deleted(sender, instance, **kwargs):
+    on_commit(remove, instance.pk)
+
+
+@receiver(post_save, sender=Like, dispatch_uid='trending_like_saved')
+@receiver(post_save, sender=Comment, dispatch_uid='trending_comment_saved')
+def engagement_saved(sender, instance, created=False, **kwargs):
+    if created:
+        on_commit(record, instance.post_id, weight_of(sender))
+
+
+@receiver(post_delete, sender=Like, dispatch_uid='trending_like_deleted')
+@receiver(post_delete, sender=Comment, dispatch_uid='trending_comment_deleted')
+def engagement_deleted(sender, instance, **kwargs):
+    if not _suspended.get():
+        on_commit(record, instance.post_id, -weight_of(sender))
+
+
+def weight_of(model):
+    return settings.TRENDING_LIKE_WEIGHT if model is Like else settings.TRENDING_COMMENT_WEIGHT
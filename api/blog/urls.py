@@ -1,16 +1,21 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
 
+# Under ASGI the I/O-bound write endpoints can run as native async views
+io_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
-    path('posts/create-post/', views.PostCreateView.as_view(), name='post-create'),
+    path('posts/create-post/', io_views.PostCreateView.as_view(), name='post-create'),
     path('posts/', views.PostListView.as_view(), name='post-list'),
+    path('posts/trending/', views.TrendingPostsView.as_view(), name='post-trending'),
     path('posts/<int:post_id>/', views.PostUpdateDeleteView.as_view(), name='post-update-delete'),
     path('posts/<int:post_id>/details/', views.PostDetails.as_view(), name='post-details'),
-    path('posts/<int:post_id>/like/', views.LikeCreateDeleteView.as_view(), name='like-post'),
+    path('posts/<int:post_id>/viewers/', views.PostViewersView.as_view(), name='post-viewers'),
+    path('posts/<int:post_id>/like/', io_views.LikeCreateDeleteView.as_view(), name='like-post'),
     path('posts/<int:post_id>/images/', views.ImageListView.as_view(), name='image-list'),
-    path('posts/<int:post_id>/images/upload/', views.ImageCreateView.as_view(), name='image-create'),
+    path('posts/<int:post_id>/images/upload/', io_views.ImageCreateView.as_view(), name='image-create'),
     path('posts/<int:post_id>/comments/', views.CommentListView.as_view(), name='comment-list'),
-    path('posts/<int:post_id>/comments/create/', views.CommentCreateView.as_view(), name='comment-create'),
-    path('posts/<int:post_id>/comment/<int:comment_id>/', views.CommentUpdateDeleteView.as_view(), name='comment-delete-update'),
+    path('posts/<int:post_id>/comments/create/', io_views.CommentCreateView.as_view(), name='comment-create'),
+    path('posts/<int:post_id>/comment/<int:comment_id>/', io_views.CommentUpdateDeleteView.as_view(), name='comment-delete-update'),
 ]
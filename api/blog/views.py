@@ -1,16 +1,20 @@
 from rest_framework import permissions, status, views
+from rest_framework.pagination import CursorPagination
 from .models import Post, Image, Like, Comment
-from .serializers import PostSerializer, ImageSerializer, LikeSerializer, CommentSerializer
+from .serializers import (PostSerializer, PostListSerializer, ImageSerializer, LikeSerializer, CommentSerializer,
+                          TrendingPostSerializer)
+from .clients import DEFAULT_POST_IMAGE, ServiceError, publish_to_newsletter
+from .broadcast import broadcast_comment, count_changed
+from . import deletion, media, post_cache, presence, trending
+import redis
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Prefetch
 from drf_yasg.utils import swagger_auto_schema
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from drf_yasg import openapi
-import requests
-import os
-from dotenv import load_dotenv
-load_dotenv()
+import logging
+
+logger = logging.getLogger(__name__)
 
 class PostCreateView(views.APIView):
     permission_classes = [permissions.AllowAny]
@@ -48,20 +52,17 @@ class PostCreateView(views.APIView):
             images_data = data.get('images', [])
             for image_data in images_data:
                 Image.objects.create(post=post, **image_data)
+            media.adopt([image_data.get('image_url') for image_data in images_data])
             
             try:
                 sending_data = data
                 sending_data['created_at'] = post.created_at.isoformat()
                 sending_data['id'] = post.id
-                if len(images_data) >0:
-                    sending_data['first_image'] = Image.objects.filter(post_id=post.id).first().image_url
-                else:
-                    sending_data['first_image'] ='https://ezgroup-static-files-bucket.s3.ap-southeast-2.amazonaws.com/media/ezgroup-logo.jpg'
-                print(sending_data)
-                fastapi_url = f"{os.getenv("NEWSLETTER_ENDPOINT")}/posts/"
-                response = requests.post(fastapi_url, json=sending_data)
+                sending_data['first_image'] = post.cover_image_url or DEFAULT_POST_IMAGE
+                logger.debug("Publishing post %s to the newsletter", post.id)
+                published, response_text = publish_to_newsletter(sending_data)
 
-                if response.status_code == 200:
+                if published:
                     return Response({
                         "EC": 1,
                         "EM": "Success",
@@ -70,11 +71,11 @@ class PostCreateView(views.APIView):
                 else:
                     return Response({
                         "EC": 1,
-                        "EM": f"Failed to add post to newsletter. Yet, saved post. Error: {response.text}",
+                        "EM": f"Failed to add post to newsletter. Yet, saved post. Error: {response_text}",
                         "DT": serializer.data
                     }, status=status.HTTP_201_CREATED)
 
-            except requests.exceptions.RequestException as e:
+            except ServiceError as e:
                 return Response({
                     "EC": 0,
                     "EM": f"Error while sending post to FastAPI server: {e}"
@@ -83,24 +84,73 @@ class PostCreateView(views.APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class PostListPagination(CursorPagination):
+    # Newest first, read off post_created_idx; a cursor page costs the same at any depth.
+    ordering = '-created_at'
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
 class PostListView(views.APIView):
     permission_classes = [permissions.AllowAny]
 
     @swagger_auto_schema(
-        operation_summary="List all posts",
-        responses={200: PostSerializer(many=True)},
+        operation_summary="List posts, newest first",
+        manual_parameters=[
+            openapi.Parameter('cursor', openapi.IN_QUERY, description="Page cursor from the previous page's next link",
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Posts per page (at most 100, default 20)",
+                              type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: PostListSerializer(many=True)},
     )
     def get(self, request):
-        posts = Post.objects.all().prefetch_related('likes',  'comments')
-        serializer = PostSerializer(posts, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = PostListPagination()
+        posts = paginator.paginate_queryset(PostListSerializer.with_counts(Post.objects.all()), request, view=self)
+        serializer = PostListSerializer(posts, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class TrendingPostsView(views.APIView):
+    permission_classes = [permissions.AllowAny]
+
+    @swagger_auto_schema(
+        operation_summary="Trending posts",
+        manual_parameters=[
+            openapi.Parameter('category', openapi.IN_QUERY, description="Only rank posts of this category",
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description="Number of posts (1-100, default 20)",
+                              type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: TrendingPostSerializer(many=True), 503: "Ranking store unavailable"},
+    )
+    def get(self, request):
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            return Response({"EC": -1, "EM": "limit must be a number", "DT": ""}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ranked = trending.top(limit, request.query_params.get('category'))
+        except redis.RedisError:
+            return Response({"EC": -1, "EM": "Trending is unavailable", "DT": ""},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        scores = dict(ranked)
+        posts = post_cache.get_posts([post_id for post_id, _ in ranked])
+        serializer = TrendingPostSerializer(posts, many=True, context={'scores': scores})
+        return Response({
+            "EC": 1,
+            "EM": "Success",
+            "DT": serializer.data
+        }, status=status.HTTP_200_OK)
 
 
 class PostDetails(views.APIView):
     permission_classes = [permissions.AllowAny]
 
     def get_object(self, post_id):
-        return get_object_or_404(Post, pk=post_id)
+        return post_cache.get_post_or_404(post_id)
 
     @swagger_auto_schema(
         operation_summary="Post Details",
@@ -123,7 +173,7 @@ class PostUpdateDeleteView(views.APIView):
     permission_classes = [permissions.AllowAny] 
 
     def get_object(self, post_id):
-        return get_object_or_404(Post, pk=post_id)
+        return post_cache.get_post_or_404(post_id)
 
     def get(self, request, post_id):
         post = self.get_object(post_id)
@@ -158,6 +208,9 @@ class PostUpdateDeleteView(views.APIView):
             return Response({"error": "Permission denied. You cannot modify another user's post."},
                             status=status.HTTP_403_FORBIDDEN)
         self.check_object_permissions(request, post)
+        # The cached copy is fine for the ownership check, but the save
+        # writes every column, so start from the current row.
+        post.refresh_from_db()
         serializer = PostSerializer(post, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save() 
@@ -191,7 +244,7 @@ class PostUpdateDeleteView(views.APIView):
                             status=status.HTTP_403_FORBIDDEN)
 
         self.check_object_permissions(request, post)
-        post.delete()
+        deletion.delete_post(post)
         return Response(status=status.HTTP_204_NO_CONTENT)
     
 
@@ -203,7 +256,7 @@ class ImageListView(views.APIView):
         responses={200: ImageSerializer(many=True)},
     )
     def get(self, request, post_id):
-        post = get_object_or_404(Post, id=post_id)
+        post = post_cache.get_post_or_404(post_id)
         images = post.images.all()
         serializer = ImageSerializer(images, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -235,9 +288,8 @@ class ImageCreateView(views.APIView):
     )
     def post(self, request, post_id, *args, **kwargs):
         try:
-            try:
-                post = Post.objects.get(pk=post_id)
-            except Post.DoesNotExist:
+            post = post_cache.get_post(post_id)
+            if post is None:
                 return Response(
                     {"EC": -1, "EM": "Post not found", "DT": ""},
                     status=status.HTTP_404_NOT_FOUND,
@@ -278,7 +330,11 @@ class CommentListView(views.APIView):
         except Post.DoesNotExist:
             return Response({'error': 'Post not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        comments = Comment.objects.filter(post=post)
+        # Prefetch replies so replies_count doesn't cost a query per comment;
+        # replies share the post, which keeps the prefetch on the post index.
+        comments = Comment.objects.filter(post=post).order_by('created_at').prefetch_related(
+            Prefetch('replies', queryset=Comment.objects.filter(post=post))
+        )
         serializer = CommentSerializer(comments, many=True)
         return Response(serializer.data)
 
@@ -305,7 +361,7 @@ class CommentCreateView(views.APIView):
         },
     )
     def post(self, request, post_id):
-        post = get_object_or_404(Post, pk=post_id)
+        post = post_cache.get_post_or_404(post_id)
 
         # Initialize user data
         user_data = getattr(request, 'user_data', None)
@@ -332,7 +388,11 @@ class CommentCreateView(views.APIView):
         serializer = CommentSerializer(data=data)
 
         if serializer.is_valid():
-            comment = serializer.save(post=post)
+            # The author fields are read-only in the serializer, so they are saved explicitly.
+            comment = serializer.save(post=post, user_id=data['user_id'], user_name=data['user_name'],
+                                      user_email=data['user_email'])
+            broadcast_comment(post.id, 'created', serializer.data)
+            count_changed(post.id, 'comments', 1)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -379,6 +439,7 @@ class CommentUpdateDeleteView(views.APIView):
         serializer = CommentSerializer(comment, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
+            broadcast_comment(comment.post_id, 'updated', serializer.data)
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -410,7 +471,11 @@ class CommentUpdateDeleteView(views.APIView):
         if not user_data or (comment.user_id != user_data.get('id') and not request.user.is_superuser):
             return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
 
-        comment.delete()
+        # Subscribers are notified once the delete has committed, not before.
+        with transaction.atomic():
+            broadcast_comment(comment.post_id, 'deleted', {'id': comment.id, 'parent': comment.parent_id})
+            count_changed(comment.post_id, 'comments', -comment.thread_size())
+            comment.delete()
         return Response({'status': 'Comment deleted'}, status=status.HTTP_204_NO_CONTENT)
 
 class LikeCreateDeleteView(views.APIView):
@@ -436,7 +501,7 @@ class LikeCreateDeleteView(views.APIView):
         },
     )
     def post(self, request, post_id):
-        post = Post.objects.filter(pk=post_id).first()
+        post = post_cache.get_post(post_id)
         if not post:
             return Response({"detail": "Post not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -462,6 +527,7 @@ class LikeCreateDeleteView(views.APIView):
         )
 
         like_instance.save()
+        count_changed(post.id, 'likes', 1)
 
         serializer = LikeSerializer(like_instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -485,7 +551,7 @@ class LikeCreateDeleteView(views.APIView):
         },
     )
     def delete(self, request, post_id):
-        post = Post.objects.filter(pk=post_id).first()
+        post = post_cache.get_post(post_id)
         if not post:
             return Response({"detail": "Post not found"}, status=status.HTTP_404_NOT_FOUND)
 
@@ -500,4 +566,19 @@ class LikeCreateDeleteView(views.APIView):
                 return Response({"detail": "You haven't liked this post."}, status=status.HTTP_400_BAD_REQUEST)
 
         like.delete()
+        count_changed(post.id, 'likes', -1)
         return Response({"detail": "Unlike successfully"}, status=status.HTTP_204_NO_CONTENT)
+
+class PostViewersView(views.APIView):
+    permission_classes = [permissions.AllowAny]
+
+    @swagger_auto_schema(
+        operation_summary="Number of live viewers of a post",
+        responses={200: "Viewer count", 503: "Presence store unavailable"},
+    )
+    def get(self, request, post_id):
+        try:
+            viewers = presence.viewer_count(post_id)
+        except redis.RedisError:
+            return Response({"detail": "Presence is unavailable"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({"post_id": post_id, "viewers": viewers}, status=status.HTTP_200_OK)
@@ -2,6 +2,9 @@
 # Exit immediately if a command exits with a non-zero status
 set -e
 
+# Precompute the OpenAPI schema served at /api/docs/ (skipped if this code version has one)
+python manage.py generate_openapi_schema
+
 # Start the Django server
 echo "Starting Django server..."
 python manage.py runserver 0.0.0.0:8000 &
@@ -0,0 +1,4 @@
+"""
+Performance tooling for the API: in-process stand-ins for external
+services and helpers shared by the benchmark and load-test commands.
+"""
@@ -0,0 +1,86 @@
+import asyncio
+import json
+from django.core.handlers.asgi import ASGIHandler
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+
+
+class ASGIResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ASGIClient:
+    """
+    Send HTTP requests straight into an ASGI application in-process, the way
+    an ASGI server would, without a socket in between.
+    """
+
+    def __init__(self, application=None, headers=None):
+        self.application = application or ASGIHandler()
+        self.headers = headers or {}
+
+    async def request(self, method, path, body=b'', content_type=None, headers=None, query_string=''):
+        all_headers = {'host': 'testserver', **self.headers, **(headers or {})}
+        if body:
+            all_headers['content-length'] = str(len(body))
+        if content_type:
+            all_headers['content-type'] = content_type
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query_string.encode(),
+            'root_path': '',
+            'headers': [(key.lower().encode('latin1'), str(value).encode('latin1'))
+                        for key, value in all_headers.items()],
+            'client': ('127.0.0.1', 0),
+            'server': ('testserver', 80),
+        }
+        request_sent = False
+        finished = asyncio.Event()
+        status_code, response_headers, chunks = None, {}, []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                response_headers.update((key.decode('latin1'), value.decode('latin1'))
+                                        for key, value in message.get('headers', []))
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    finished.set()
+
+        await self.application(scope, receive, send)
+        return ASGIResponse(status_code, response_headers, b''.join(chunks))
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    async def post_json(self, path, data=None, method='POST', **kwargs):
+        body = json.dumps(data).encode() if data is not None else b''
+        return await self.request(method, path, body=body, content_type='application/json', **kwargs)
+
+    async def post_multipart(self, path, data, **kwargs):
+        return await self.request('POST', path, body=encode_multipart(BOUNDARY, data),
+                                  content_type=MULTIPART_CONTENT, **kwargs)
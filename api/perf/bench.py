@@ -0,0 +1,347 @@
+"""
+Per-endpoint benchmarks: seed a data set, send each case through Django's
+test client and record latency, queries and allocations per request.
+
+Every case is a function ``case(dataset, i)`` that does any setup it needs
+(outside the timed section) and returns the request to send as a dict with
+``method``, ``path`` and optionally ``data``, ``content_type`` and ``user``
+(an authen user to log in as).
+
+Requests carry a token for BENCH_USER_ID, who owns every tenth seeded post
+and the scratch posts, comments and likes that cases create, so that
+edits and deletes take their success path.
+"""
+import contextlib
+import io
+import logging
+import time
+import tracemalloc
+from collections import Counter
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client
+from django.test.client import MULTIPART_CONTENT
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from PIL import Image as PILImage
+from authen import otp
+from authen.models import User
+from blog.models import Post, Image, Comment, Like
+from .fakes import BENCH_USER_ID, make_token
+from .stats import percentile
+
+PASSWORD = 'bench-password'
+BLOG = '/api/v1/blogs'
+AUTHEN = '/api/v1/authen'
+
+
+def png_bytes():
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (8, 8), 'white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class Dataset:
+    """`size` posts, each with an image, a few comments and likes, plus size // 10 active users."""
+
+    # Every OWNED_EVERYth post belongs to the bench user
+    OWNED_EVERY = 10
+
+    COMMENTS_PER_POST = 3
+    LIKES_PER_POST = 2
+
+    def __init__(self, size):
+        self.size = size
+        self.image = png_bytes()
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(email=f'bench{n}@ezmail.com', first_name='Bench', last_name=str(n), role='member',
+                 resident_id=f'R{n}', staff_id=f'S{n}', password=password)
+            for n in range(max(10, size // 10))
+        ], batch_size=500)
+        self.users = list(User.objects.order_by('id'))
+
+        Post.objects.bulk_create([
+            Post(title=f'Bench post {n}', content='Body ' * 50, category=f'category-{n % 5}',
+                 user_id=BENCH_USER_ID if n % self.OWNED_EVERY == 0 else f'user-{n % 100}',
+                 user_name='Bench', user_email='bench@ezmail.com')
+            for n in range(size)
+        ], batch_size=500)
+        posts = list(Post.objects.order_by('id'))
+        self.post_ids = [post.id for post in posts]
+        self.owned_post_ids = self.post_ids[::self.OWNED_EVERY]
+
+        Image.objects.bulk_create([
+            Image(post=post, label='cover', image_url=f'https://bench-bucket.s3.local/{post.id}.png')
+            for post in posts
+        ], batch_size=500)
+        Comment.objects.bulk_create([
+            Comment(post=post, content='Comment', user_id=f'user-{n}', user_name='Bench',
+                    user_email='bench@ezmail.com')
+            for post in posts for n in range(self.COMMENTS_PER_POST)
+        ], batch_size=500)
+        Like.objects.bulk_create([
+            Like(post=post, user_id=f'user-{n}', user_name='Bench', user_email='bench@ezmail.com')
+            for post in posts for n in range(self.LIKES_PER_POST)
+        ], batch_size=500)
+
+    def post_id(self, i):
+        return self.post_ids[i * 7919 % self.size]
+
+    def owned_post_id(self, i):
+        return self.owned_post_ids[i * 7919 % len(self.owned_post_ids)]
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def new_post(self):
+        return Post.objects.create(title='Scratch post', content='Body', category='bench', user_id=BENCH_USER_ID)
+
+    def new_comment(self, i):
+        return Comment.objects.create(post_id=self.post_id(i), content='Scratch comment', user_id=BENCH_USER_ID)
+
+    def new_like(self, i):
+        like, _ = Like.objects.get_or_create(post_id=self.post_id(i), user_id=BENCH_USER_ID)
+        return like
+
+
+# blog
+
+def create_post(dataset, i):
+    return {'method': 'post', 'path': f'{BLOG}/posts/create-post/',
+            'data': {'title': f'New post {i}', 'content': 'Body', 'category': 'bench'}}
+
+
+def list_posts(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/'}
+
+
+def trending_posts(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/trending/'}
+
+
+def get_post(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/'}
+
+
+def update_post(dataset, i):
+    return {'method': 'put', 'path': f'{BLOG}/posts/{dataset.owned_post_id(i)}/', 'data': {'content': 'Edited'}}
+
+
+def delete_post(dataset, i):
+    return {'method': 'delete', 'path': f'{BLOG}/posts/{dataset.new_post().id}/'}
+
+
+def post_details(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/details/'}
+
+
+def post_viewers(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/viewers/'}
+
+
+def like_post(dataset, i):
+    # Likes are unique per user and post, so each one needs a fresh post.
+    return {'method': 'post', 'path': f'{BLOG}/posts/{dataset.new_post().id}/like/'}
+
+
+def unlike_post(dataset, i):
+    return {'method': 'delete', 'path': f'{BLOG}/posts/{dataset.new_like(i).post_id}/like/'}
+
+
+def list_images(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/images/'}
+
+
+def upload_image(dataset, i):
+    return {'method': 'post', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/images/upload/',
+            'content_type': MULTIPART_CONTENT,
+            'data': {'label': f'Figure {i}',
+                     'file': SimpleUploadedFile(f'{i}.png', dataset.image, content_type='image/png')}}
+
+
+def list_comments(dataset, i):
+    return {'method': 'get', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/comments/'}
+
+
+def create_comment(dataset, i):
+    return {'method': 'post', 'path': f'{BLOG}/posts/{dataset.post_id(i)}/comments/create/',
+            'data': {'content': f'Comment {i}'}}
+
+
+def update_comment(dataset, i):
+    comment = dataset.new_comment(i)
+    return {'method': 'put', 'path': f'{BLOG}/posts/{comment.post_id}/comment/{comment.id}/',
+            'data': {'content': 'Edited'}}
+
+
+def delete_comment(dataset, i):
+    comment = dataset.new_comment(i)
+    return {'method': 'delete', 'path': f'{BLOG}/posts/{comment.post_id}/comment/{comment.id}/'}
+
+
+# authen
+
+def register(dataset, i):
+    suffix = get_random_string(8)
+    return {'method': 'post', 'path': f'{AUTHEN}/register/', 'data': {
+        'email': f'new-{suffix}@ezmail.com', 'first_name': 'New', 'last_name': 'User',
+        'date_of_birth': '2000-01-01', 'resident_id': suffix, 'staff_id': suffix, 'role': 'member',
+        'password': PASSWORD, 'password2': PASSWORD,
+    }}
+
+
+def verify_otp(dataset, i):
+    suffix = get_random_string(8)
+    user = User.objects.create_user(email=f'otp-{suffix}@ezmail.com', password=PASSWORD, first_name='Otp',
+                                    last_name='User', resident_id=suffix, staff_id=suffix, is_active=False)
+    return {'method': 'post', 'path': f'{AUTHEN}/verification/otp/',
+            'data': {'email': user.email, 'otp': otp.issue(user)}}
+
+
+def update_account(dataset, i):
+    return {'method': 'put', 'path': f'{AUTHEN}/accounts/update/', 'user': dataset.user(i),
+            'data': {'first_name': f'Renamed {i}'}}
+
+
+def login(dataset, i):
+    return {'method': 'post', 'path': f'{AUTHEN}/accounts/login/',
+            'data': {'email': dataset.user(i).email, 'password': PASSWORD}}
+
+
+def obtain_token(dataset, i):
+    return {'method': 'post', 'path': f'{AUTHEN}/token/',
+            'data': {'email': dataset.user(i).email, 'password': PASSWORD}}
+
+
+def logout(dataset, i):
+    user = dataset.user(i)
+    return {'method': 'post', 'path': f'{AUTHEN}/accounts/logout/', 'user': user,
+            'data': {'refresh': user.tokens()['refresh']}}
+
+
+CASES = {
+    'blog.post-create': create_post,
+    'blog.post-list': list_posts,
+    'blog.post-trending': trending_posts,
+    'blog.post-get': get_post,
+    'blog.post-update': update_post,
+    'blog.post-delete': delete_post,
+    'blog.post-details': post_details,
+    'blog.post-viewers': post_viewers,
+    'blog.like-create': like_post,
+    'blog.like-delete': unlike_post,
+    'blog.image-list': list_images,
+    'blog.image-upload': upload_image,
+    'blog.comment-list': list_comments,
+    'blog.comment-create': create_comment,
+    'blog.comment-update': update_comment,
+    'blog.comment-delete': delete_comment,
+    'authen.register': register,
+    'authen.verify-otp': verify_otp,
+    'authen.account-update': update_account,
+    'authen.login': login,
+    'authen.token': obtain_token,
+    'authen.logout': logout,
+}
+
+
+def send(client, request):
+    if request.get('user') is not None:
+        client.force_login(request['user'])
+    method = getattr(client, request['method'])
+    content_type = request.get('content_type', 'application/json')
+    if request['method'] == 'get':
+        return method(request['path'])
+    return method(request['path'], request.get('data', {}), content_type=content_type)
+
+
+@contextlib.contextmanager
+def quiet_logging():
+    logging.disable(logging.ERROR)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def measure(case, dataset, iterations, warmup=3, profiled=5):
+    """
+    Latency percentiles over `iterations` timed requests, then queries and
+    allocations per request over `profiled` further requests (tracemalloc
+    slows requests down, so those are never timed).
+    """
+    # Server errors are reported in 'status' rather than aborting the run.
+    client = Client(raise_request_exception=False, HTTP_AUTHORIZATION=f'Bearer {make_token()}')
+    statuses = Counter()
+    latencies = []
+
+    # Django logs every 4xx/5xx; keep that out of the report.
+    with quiet_logging():
+        for i in range(warmup + iterations):
+            request = case(dataset, i)
+            started = time.perf_counter()
+            response = send(client, request)
+            elapsed = time.perf_counter() - started
+            client.logout()
+            if i >= warmup:
+                latencies.append(elapsed)
+                statuses[response.status_code] += 1
+
+        queries, allocated = [], []
+        tracemalloc.start()
+        try:
+            for i in range(profiled):
+                request = case(dataset, warmup + iterations + i)
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                with CaptureQueriesContext(connection) as captured:
+                    send(client, request)
+                allocated.append(tracemalloc.get_traced_memory()[1] - baseline)
+                queries.append(len(captured))
+                client.logout()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'requests': len(latencies),
+        'status': dict(sorted(statuses.items())),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries': max(queries, default=0),
+        'peak_alloc_kb': round(percentile(allocated, 50) / 1024, 1),
+    }
+
+
+def failures(results):
+    """(size, name, status counts) for cases that got any response other than 2xx."""
+    return [(size, name, result['status'])
+            for size, cases in results.items() for name, result in cases.items()
+            if any(not 200 <= int(code) < 300 for code in result['status'])]
+
+
+def regressions(results, baseline, tolerance, latency_tolerance=None):
+    """
+    Metrics that got worse than `baseline`: any extra query, allocations
+    grown by more than `tolerance` (a fraction), and p95 latency grown by
+    more than `latency_tolerance` when given. Latency is left out by default
+    since a baseline's timings only hold on the machine that saved it.
+    """
+    limits = {'queries': 0, 'peak_alloc_kb': tolerance}
+    if latency_tolerance is not None:
+        limits['p95_ms'] = latency_tolerance
+    found = []
+    for size, cases in results.items():
+        for name, result in cases.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            for metric, slack in limits.items():
+                before, after = previous.get(metric), result[metric]
+                if before is None:
+                    continue
+                if after > before * (1 + slack):
+                    found.append((size, name, metric, before, after))
+    return found
@@ -0,0 +1,22 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from django.db import connection
+from blog import post_cache
+
+
+@contextmanager
+def test_database():
+    """Create a throwaway test database for the configured backend and drop it afterwards."""
+    if connection.vendor == 'sqlite':
+        # Requests run on several threads under ASGI; a shared in-memory
+        # database locks whole tables, so use a file like a real deployment.
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), 'ezgroup_perf.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    # Post ids start over in every database.
+    post_cache.clear_local()
+    try:
+        yield connection.settings_dict['NAME']
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        post_cache.clear_local()
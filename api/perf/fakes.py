@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+import weakref
+import fakeredis
+import jwt
+from aiohttp import web
+from django.test.utils import override_settings
+from api import redis_client
+from blog import clients
+
+
+# Settings that keep channels, the cache and email in-process during a run.
+# Rate limits need Redis and would reject the repeated writes being measured;
+# mail is sent inline to the in-memory backend instead of the Redis outbox,
+# one-time passwords are kept in the database, and last_login is written and
+# deleted posts purged inline.
+LOCAL_BACKENDS = {
+    'RATE_LIMIT': False,
+    'MAIL_QUEUE': False,
+    'LOGIN_QUEUE': False,
+    'POST_DELETE_QUEUE': False,
+    'OTP_BACKEND': 'authen.otp.DatabaseOTPBackend',
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+}
+
+
+# The SSO user that make_token identifies by default
+BENCH_USER_ID = 'bench-user'
+
+
+def make_token(user_id=BENCH_USER_ID, email='bench@ezmail.com', permissions=()):
+    """Build an (unsigned) SSO-shaped access token the auth middleware can decode."""
+    return jwt.encode({
+        'user_id': user_id,
+        'email': email,
+        'first_name': 'Bench',
+        'last_name': 'User',
+        'roleWithPermission': {'Permissions': [{'url': url} for url in permissions]},
+    }, 'bench-secret-not-used-for-verification', algorithm='HS256')
+
+
+class FakeS3:
+    """In-memory stand-in for the boto3 S3 client; every call waits `latency` seconds."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        # ExtraArgs of the last upload to each key, e.g. ContentType
+        self.extra_args = {}
+        # Keys delete_objects reports as errors instead of deleting
+        self.refuse = set()
+        self.calls = 0
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        self._round_trip()
+        self.objects[(bucket, key)] = fileobj.read()
+        self.extra_args[(bucket, key)] = kwargs.get('ExtraArgs', {})
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._round_trip()
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._round_trip()
+        errors = []
+        for entry in Delete['Objects']:
+            if entry['Key'] in self.refuse:
+                errors.append({'Key': entry['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'})
+            else:
+                self.objects.pop((Bucket, entry['Key']), None)
+        return {'Errors': errors} if errors else {}
+
+
+class FakeAsyncRedisClients(weakref.WeakKeyDictionary):
+    """Stands in for api.redis_client's per-loop clients, handing out fakes that share `server`."""
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+
+    def get(self, loop, default=None):
+        if loop not in self:
+            self[loop] = fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True)
+        return self[loop]
+
+
+class FakeServices:
+    """
+    Run local stand-ins for the SSO verify endpoint, the newsletter service,
+    a third-party image host, S3 and Redis, and point settings (and
+    api.redis_client) at them for the duration of the block. Images served at ``/images/<name>`` are set in
+    ``images`` as (content type, bytes); ``/redirect/<name>`` redirects there.
+
+    The HTTP fakes are served by aiohttp on a private event loop thread, so
+    both the sync (requests) and async (aiohttp) client paths make real
+    round trips with a configurable `latency` in seconds.
+    """
+
+    def __init__(self, latency=0.0, s3_latency=None):
+        self.latency = latency
+        self.s3 = FakeS3(latency if s3_latency is None else s3_latency)
+        self.redis_server = fakeredis.FakeServer()
+        self.sso_calls = 0
+        # When set, the SSO endpoint answers with this (status, text) instead of JSON
+        self.sso_reply = None
+        self.newsletter_calls = 0
+        self.images = {}
+        self.image_calls = 0
+        # Most image requests in flight at once
+        self.image_peak = 0
+        self._image_active = 0
+        self._loop = asyncio.new_event_loop()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def __enter__(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+
+        self._previous_s3 = clients._s3_client
+        clients._s3_client = self.s3
+        self._previous_redis = redis_client._client, redis_client._async_clients
+        redis_client._client = fakeredis.FakeRedis(server=self.redis_server, decode_responses=True)
+        redis_client._async_clients = FakeAsyncRedisClients(self.redis_server)
+        self._settings = override_settings(
+            SSO_URL=f'{self.url}/verify',
+            NEWSLETTER_ENDPOINT=self.url,
+            AWS_STORAGE_BUCKET_NAME='bench-bucket',
+            AWS_S3_CUSTOM_DOMAIN='bench-bucket.s3.local',
+            PUBLIC_MEDIA_LOCATION='media',
+            # The image host listens on 127.0.0.1
+            MIRROR_ALLOW_PRIVATE_HOSTS=True,
+        )
+        self._settings.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._settings.disable()
+        clients._s3_client = self._previous_s3
+        redis_client._client, redis_client._async_clients = self._previous_redis
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _serve(self, started):
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post('/verify', self.verify)
+        app.router.add_post('/posts/', self.newsletter)
+        app.router.add_get('/images/{name}', self.image)
+        app.router.add_get('/redirect/{name}', self.redirect)
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    async def verify(self, request):
+        self.sso_calls += 1
+        await asyncio.sleep(self.latency)
+        if self.sso_reply is not None:
+            status, text = self.sso_reply
+            return web.Response(status=status, text=text, content_type='text/html')
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return web.json_response({'EC': -1, 'EM': 'Invalid token', 'DT': ''}, status=401)
+        return web.json_response({'EC': 1, 'EM': 'Token is valid', 'DT': ''})
+
+    async def newsletter(self, request):
+        self.newsletter_calls += 1
+        await request.read()
+        await asyncio.sleep(self.latency)
+        return web.json_response({'detail': 'Post received'})
+
+    async def redirect(self, request):
+        raise web.HTTPFound(f"/images/{request.match_info['name']}")
+
+    async def image(self, request):
+        self.image_calls += 1
+        self._image_active += 1
+        self.image_peak = max(self.image_peak, self._image_active)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._image_active -= 1
+        if request.match_info['name'] not in self.images:
+            return web.Response(status=404)
+        content_type, body = self.images[request.match_info['name']]
+        return web.Response(body=body, content_type=content_type)
@@ -0,0 +1,28 @@
+import asyncio
+import time
+
+
+async def run_concurrently(send, total, concurrency):
+    """
+    Await `send(i)` for i in range(total) with at most `concurrency` calls in
+    flight. `send` returns True on success. Returns (latencies, errors, elapsed).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await send(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return latencies, errors, time.perf_counter() - started
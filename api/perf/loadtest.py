@@ -0,0 +1,259 @@
+"""
+Scenario-driven load generator. A scenario file (see ``perf/scenarios``)
+describes the seeded data, how many requests to send at what concurrency,
+the weighted mix of actions and how many WebSocket clients stay subscribed
+to the hot posts' comment rooms while the load runs.
+
+Requests go straight into the ASGI application in-process, so results
+reflect the app's configuration (ASYNC_VIEWS, database, middleware) rather
+than a network stack.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.hashers import make_password
+from django.core.files.uploadedfile import SimpleUploadedFile
+from authen.models import User
+from blog import broadcast
+from blog.models import Post
+from .asgi import ASGIClient
+from .bench import PASSWORD, png_bytes
+from .fakes import make_token
+from .load import run_concurrently
+from .stats import summarize
+
+SCENARIO_DIR = os.path.join(os.path.dirname(__file__), 'scenarios')
+BLOG = '/api/v1/blogs'
+AUTHEN = '/api/v1/authen'
+TARGETS = ('hot', 'random', 'unique')
+# Actions that do not act on a post
+UNTARGETED = ('feed', 'login', 'login-unknown')
+
+DEFAULTS = {
+    'description': '',
+    'posts': 100,
+    'hot_posts': 1,
+    'requests': 500,
+    'concurrency': 50,
+    'latency_ms': 20,
+    'subscribers': 0,
+    'users': 0,
+}
+
+
+def scenario_names():
+    return sorted(name[:-len('.json')] for name in os.listdir(SCENARIO_DIR) if name.endswith('.json'))
+
+
+def load_scenario(name_or_path):
+    """Read a scenario by file path or by name under perf/scenarios. Raises ValueError if it is invalid."""
+    path = name_or_path if os.path.exists(name_or_path) else os.path.join(SCENARIO_DIR, f'{name_or_path}.json')
+    with open(path) as f:
+        scenario = {**DEFAULTS, 'name': os.path.splitext(os.path.basename(path))[0], **json.load(f)}
+
+    if not scenario.get('mix'):
+        raise ValueError(f"{path}: 'mix' must list at least one action")
+    for entry in scenario['mix']:
+        if entry.get('action') not in ACTIONS:
+            raise ValueError(f"{path}: unknown action {entry.get('action')!r}; choose from {sorted(ACTIONS)}")
+        if entry.setdefault('target', 'hot') not in TARGETS:
+            raise ValueError(f"{path}: unknown target {entry['target']!r}; choose from {TARGETS}")
+    if any(entry['target'] == 'unique' for entry in scenario['mix']) and scenario['posts'] < scenario['requests']:
+        raise ValueError(f"{path}: 'unique' targets need at least as many posts as requests")
+    if any(entry['action'] == 'login' for entry in scenario['mix']) and not scenario['users']:
+        raise ValueError(f"{path}: 'login' needs 'users' to log in as")
+    return scenario
+
+
+class Seed:
+    """
+    Posts and users for a scenario. The first `hot_posts` posts take the
+    'hot' traffic; every user's password is PASSWORD.
+    """
+
+    def __init__(self, scenario):
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(email=f'load{n}@ezmail.com', first_name='Load', last_name=str(n), role='member',
+                 resident_id=f'L{n}', staff_id=f'L{n}', password=password)
+            for n in range(scenario['users'])
+        ], batch_size=500)
+        self.emails = [f'load{n}@ezmail.com' for n in range(scenario['users'])]
+        Post.objects.bulk_create([
+            Post(title=f'Load post {n}', content='Body ' * 50, category=f'category-{n % 5}',
+                 user_id=f'user-{n % 100}', user_name='Load', user_email='load@ezmail.com')
+            for n in range(scenario['posts'])
+        ], batch_size=500)
+        self.post_ids = list(Post.objects.order_by('id').values_list('id', flat=True))
+        self.hot_post_ids = self.post_ids[:max(1, scenario['hot_posts'])]
+        self.unused = iter(self.post_ids)
+        self.random = random.Random(0)
+        self.image = png_bytes()
+
+    def target(self, kind):
+        if kind == 'hot':
+            return self.random.choice(self.hot_post_ids)
+        if kind == 'random':
+            return self.random.choice(self.post_ids)
+        return next(self.unused)
+
+
+async def feed(client, seed, post_id, i):
+    return await client.get(f'{BLOG}/posts/')
+
+
+async def post_details(client, seed, post_id, i):
+    return await client.get(f'{BLOG}/posts/{post_id}/details/')
+
+
+async def comments(client, seed, post_id, i):
+    return await client.get(f'{BLOG}/posts/{post_id}/comments/')
+
+
+async def images(client, seed, post_id, i):
+    return await client.get(f'{BLOG}/posts/{post_id}/images/')
+
+
+async def like(client, seed, post_id, i):
+    return await client.post_json(f'{BLOG}/posts/{post_id}/like/')
+
+
+async def comment(client, seed, post_id, i):
+    return await client.post_json(f'{BLOG}/posts/{post_id}/comments/create/', {'content': f'Comment {i}'})
+
+
+async def login(client, seed, post_id, i):
+    email = seed.emails[i % len(seed.emails)]
+    return await client.post_json(f'{AUTHEN}/accounts/login/', {'email': email, 'password': PASSWORD})
+
+
+async def login_unknown(client, seed, post_id, i):
+    # A handful of unknown emails, tried over and over, as in credential stuffing
+    return await client.post_json(f'{AUTHEN}/accounts/login/',
+                                  {'email': f'nobody{i % 10}@ezmail.com', 'password': PASSWORD})
+
+
+async def image_upload(client, seed, post_id, i):
+    return await client.post_multipart(f'{BLOG}/posts/{post_id}/images/upload/', {
+        'label': f'Figure {i}',
+        'file': SimpleUploadedFile(f'{i}.png', seed.image, content_type='image/png'),
+    })
+
+
+ACTIONS = {
+    'feed': feed,
+    'post-details': post_details,
+    'comments': comments,
+    'images': images,
+    'like': like,
+    'comment': comment,
+    'image-upload': image_upload,
+    'login': login,
+    'login-unknown': login_unknown,
+}
+# Statuses that count as success for actions expected to be refused
+EXPECTED_STATUS = {'login-unknown': (401, 403)}
+
+
+class Subscriber:
+    """A WebSocket client in a post's comment room, counting the comment events it receives."""
+
+    def __init__(self, application, post_id, token):
+        self.communicator = WebsocketCommunicator(application, f'/ws/comments/{post_id}/?token={token}')
+        self.post_id = post_id
+        self.frames = 0
+        self.comments = 0
+        self.task = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if connected:
+            self.task = asyncio.create_task(self.listen())
+        return connected
+
+    async def listen(self):
+        while True:
+            message = json.loads(await self.communicator.receive_from(timeout=3600))
+            self.frames += 1
+            if message['type'] == 'comment':
+                self.comments += 1
+            elif message['type'] == 'comment_batch':
+                self.comments += len(message['events'])
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.communicator.disconnect()
+
+
+async def run_scenario(scenario, seed, application, settle=1.0):
+    """
+    Send the scenario's requests and return throughput, latency and error
+    rate overall and per action, plus what the WebSocket subscribers saw.
+    `settle` is how long to wait for batched pushes after the last request.
+    """
+    token = make_token()
+    client = ASGIClient(headers={'authorization': f'Bearer {token}'})
+    weights = [entry['weight'] for entry in scenario['mix']]
+    picker = random.Random(1)
+    plan = [picker.choices(scenario['mix'], weights)[0] for _ in range(scenario['requests'])]
+    per_action = {entry['action']: {'latencies': [], 'errors': 0} for entry in scenario['mix']}
+    comments_sent = {}
+
+    subscribers = [
+        Subscriber(application, post_id, token)
+        for post_id in seed.hot_post_ids for _ in range(scenario['subscribers'])
+    ]
+    connected = sum(await asyncio.gather(*(subscriber.connect() for subscriber in subscribers)))
+
+    async def send(i):
+        entry = plan[i]
+        post_id = seed.target(entry['target']) if entry['action'] not in UNTARGETED else None
+        started = time.perf_counter()
+        try:
+            response = await ACTIONS[entry['action']](client, seed, post_id, i)
+            expected = EXPECTED_STATUS.get(entry['action'])
+            ok = response.status_code in expected if expected else response.status_code < 400
+        except Exception:
+            ok = False
+        stats = per_action[entry['action']]
+        stats['latencies'].append(time.perf_counter() - started)
+        if not ok:
+            stats['errors'] += 1
+        elif entry['action'] == 'comment':
+            comments_sent[post_id] = comments_sent.get(post_id, 0) + 1
+        return ok
+
+    latencies, errors, elapsed = await run_concurrently(send, scenario['requests'], scenario['concurrency'])
+    # Push batched events now rather than on a timer that could outlive this run's channel layer.
+    await sync_to_async(broadcast.flush_pending)()
+    await asyncio.sleep(settle if subscribers else 0)
+    await asyncio.gather(*(subscriber.close() for subscriber in subscribers))
+
+    result = {
+        'scenario': scenario['name'],
+        **summarize(latencies, elapsed, errors),
+        'error_rate': round(errors / max(len(latencies), 1), 4),
+        'actions': {
+            action: {
+                **summarize(stats['latencies'], errors=stats['errors']),
+                'error_rate': round(stats['errors'] / max(len(stats['latencies']), 1), 4),
+            }
+            for action, stats in per_action.items()
+        },
+    }
+    if subscribers:
+        expected = sum(comments_sent.get(subscriber.post_id, 0) for subscriber in subscribers)
+        received = sum(subscriber.comments for subscriber in subscribers)
+        result['websocket'] = {
+            'subscribers': len(subscribers),
+            'connected': connected,
+            'frames': sum(subscriber.frames for subscriber in subscribers),
+            'comment_events': received,
+            'delivery_ratio': round(received / expected, 4) if expected else None,
+        }
+    return result
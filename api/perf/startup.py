@@ -0,0 +1,83 @@
+"""
+Startup cost per process type. Each measurement runs in a fresh
+interpreter that imports what that process imports before it can serve
+(the WSGI or ASGI application plus the URLconf, or Django, the Celery app
+and its task modules for a worker) and reports the time taken, its
+resident memory and how many modules it loaded.
+"""
+import json
+import re
+import subprocess
+import sys
+from django.conf import settings
+from .stats import percentile
+
+# What each process imports before it is ready. Web processes load the
+# URLconf on their first request; doing it here charges that to startup.
+PROCESSES = {
+    'wsgi': "import api.wsgi\nfrom django.urls import get_resolver\nget_resolver().url_patterns",
+    'asgi': "import api.asgi\nfrom django.urls import get_resolver\nget_resolver().url_patterns",
+    'celery': (
+        "import django\ndjango.setup()\nfrom api.celery import app\napp.loader.import_default_modules()"
+    ),
+}
+
+PROBE = '''
+import json, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
+started = time.perf_counter()
+exec(compile(sys.argv[1], '<startup>', 'exec'))
+elapsed = time.perf_counter() - started
+rss_kb = 0
+with open('/proc/self/status') as f:
+    for line in f:
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+if not rss_kb:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'import_ms': elapsed * 1000, 'rss_kb': rss_kb, 'modules': len(sys.modules)}))
+'''
+
+# -X importtime lines: "import time: <self us> | <cumulative us> | <indented module>"
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| *(\S+)')
+
+
+def probe(process, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', PROBE, PROCESSES[process]]
+    result = subprocess.run(command, cwd=settings.BASE_DIR, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"{process} failed to start:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, top):
+    """Packages by cumulative import time in ms, including whatever they imported first."""
+    found = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        # Each module is imported once; keep the entries for top-level packages.
+        if match and '.' not in match.group(3):
+            found.append((match.group(3), int(match.group(2)) / 1000))
+    found.sort(key=lambda entry: entry[1], reverse=True)
+    return [(name, round(ms, 1)) for name, ms in found[:top]]
+
+
+def measure(process, repeat=5, top=0):
+    """
+    Median import time, RSS and module count over `repeat` cold starts,
+    plus the `top` slowest packages to import from one extra traced start.
+    """
+    runs = [probe(process)[0] for _ in range(repeat)]
+    result = {
+        'runs': repeat,
+        'import_ms': round(percentile([run['import_ms'] for run in runs], 50), 1),
+        'rss_mb': round(percentile([run['rss_kb'] for run in runs], 50) / 1024, 1),
+        'modules': max(run['modules'] for run in runs),
+    }
+    if top:
+        result['slowest_imports'] = slowest_imports(probe(process, importtime=True)[1], top)
+    return result
@@ -0,0 +1,25 @@
+import math
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 < pct <= 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies, elapsed=None, errors=0):
+    """Latency summary in milliseconds; `latencies` are in seconds."""
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(max(latencies, default=0) * 1000, 2),
+    }
+    if elapsed:
+        summary['throughput_rps'] = round(len(latencies) / elapsed, 1)
+    return summary